@@ -0,0 +1,86 @@
+"""
+Media-group (album) aggregation
+
+Telegram delivers an album as one update per item, all sharing a
+media_group_id. The aggregator buffers those updates until no new item has
+arrived for a short window and then hands the whole album to a callback,
+so it is checked, relayed, logged and mirrored once instead of N times.
+"""
+
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Quiet period after the last item before an album is considered complete
+ALBUM_WINDOW_SECONDS = float(os.getenv('ALBUM_WINDOW_SECONDS', '1.0'))
+
+
+class _PendingAlbum:
+    __slots__ = ('user_id', 'updates', 'context', 'timer')
+
+    def __init__(self, user_id, context):
+        self.user_id = user_id
+        self.updates = []
+        self.context = context
+        self.timer = None
+
+
+class MediaGroupAggregator:
+    def __init__(self, on_album, window=ALBUM_WINDOW_SECONDS):
+        # on_album(updates, context) is awaited once per completed album
+        self.on_album = on_album
+        self.window = window
+        self._albums = {}       # media_group_id -> _PendingAlbum
+        self._flushing = {}     # user_id -> task relaying that user's album right now
+
+    def add(self, update, context):
+        """Buffer one album item; the album is flushed after the quiet window"""
+        group_id = update.message.media_group_id
+        album = self._albums.get(group_id)
+        if album is None:
+            album = self._albums[group_id] = _PendingAlbum(update.effective_user.id, context)
+        album.updates.append(update)
+        if album.timer:
+            album.timer.cancel()
+        loop = asyncio.get_running_loop()
+        album.timer = loop.call_later(self.window, self._expire, group_id)
+
+    def _expire(self, group_id):
+        album = self._albums.pop(group_id, None)
+        if album:
+            self._start_flush(album)
+
+    def _start_flush(self, album):
+        previous = self._flushing.get(album.user_id)
+        task = asyncio.create_task(self._flush(album, previous))
+        self._flushing[album.user_id] = task
+        task.add_done_callback(lambda t, user_id=album.user_id: self._flush_done(user_id, t))
+        return task
+
+    def _flush_done(self, user_id, task):
+        if self._flushing.get(user_id) is task:
+            del self._flushing[user_id]
+
+    async def _flush(self, album, previous):
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        album.updates.sort(key=lambda u: u.message.message_id)
+        try:
+            await self.on_album(album.updates, album.context)
+        except Exception as e:
+            logger.error(f"Error relaying album: {e}")
+
+    async def flush_user(self, user_id):
+        """Relay the user's buffered albums now, so a later message can't overtake them"""
+        for group_id in [g for g, album in self._albums.items() if album.user_id == user_id]:
+            album = self._albums.pop(group_id)
+            album.timer.cancel()
+            self._start_flush(album)
+        task = self._flushing.get(user_id)
+        if task:
+            await asyncio.gather(task, return_exceptions=True)
+
+    def __len__(self):
+        return len(self._albums)
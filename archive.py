@@ -0,0 +1,299 @@
+"""
+Local conversation archive: a full audit trail without mirroring to the log group
+
+Mirroring every relayed message to the log group costs one outbound API
+call per message. With ARCHIVE_MODE=archive the bot instead appends each
+relayed message to segment files on local disk ("both" does both).
+
+Writing: records are buffered and written as one zlib-compressed block
+once ARCHIVE_BLOCK_BYTES have accumulated or ARCHIVE_FLUSH_INTERVAL
+seconds have passed. Blocks are only ever appended to the current segment
+file. A segment is closed once it reaches ARCHIVE_SEGMENT_BYTES and the
+next one is started. Next to each segment an index file records, for every
+block, which conversations it holds: (low user id, high user id, block
+offset), one fixed-size entry per conversation per block. The index is
+loaded into memory at startup, so a conversation maps straight to the few
+blocks that contain it. A conversation is the pair of users, so repeat
+chats between the same two users share one transcript.
+
+Reading: segments are memory-mapped, and a transcript decompresses only
+the blocks listed for its conversation. Nothing goes through Telegram.
+
+A block's index entries are written after the block itself, so a crash
+normally leaves no index entry for a torn block. A block that is still cut
+short or corrupt is logged and skipped when read. Records still in the buffer
+(at most ARCHIVE_FLUSH_INTERVAL seconds of traffic) are lost with the process.
+
+Each process writes to its own subdirectory of ARCHIVE_DIR (ARCHIVE_WRITER,
+set per shard by workers.py). A transcript also reads the other
+subdirectories, so a conversation whose two users live on different shards
+of this node is complete up to their last flush. Their readers are kept
+between lookups and only read the index entries appended since the last
+one.
+
+Configuration:
+    ARCHIVE_MODE            "group" (mirror to the log group, default), "archive" or "both"
+    ARCHIVE_DIR             root directory of the archive (default archive)
+    ARCHIVE_SEGMENT_BYTES   size at which a segment is closed (default 64 MB)
+    ARCHIVE_BLOCK_BYTES     uncompressed bytes per compressed block (default 64 KB)
+    ARCHIVE_FLUSH_INTERVAL  seconds before a partial block is written anyway (default 2)
+"""
+
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import asyncio
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_MODE = os.getenv('ARCHIVE_MODE', 'group').lower()
+
+BLOCK_MAGIC = b'ARB1'
+BLOCK = struct.Struct('<4sII')      # magic, compressed length, uncompressed length
+ENTRY = struct.Struct('<qqQ')       # low user id, high user id, block offset
+
+ArchivedMessage = namedtuple('ArchivedMessage', ['sender_id', 'receiver_id', 'sent_at', 'message_type', 'content', 'file_id'])
+
+
+def conversation_key(user_id, partner_id):
+    return (user_id, partner_id) if user_id < partner_id else (partner_id, user_id)
+
+
+def _decode(line):
+    low, high, sender_id, sent_at, message_type, content, file_id = json.loads(line)
+    receiver_id = high if sender_id == low else low
+    return ArchivedMessage(sender_id, receiver_id, sent_at, message_type, content, file_id)
+
+
+class ArchiveReader:
+    """The index and memory-mapped segments of one archive directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = {}         # (low, high) -> [(segment, block offset)], oldest first
+        self.partners = {}      # user_id -> set of partner ids with archived messages
+        self._maps = {}         # segment -> mmap
+        self._loaded = {}       # index file name -> bytes of it already loaded
+
+    def load(self):
+        """Read the index entries written since the last load (all of them the first time)"""
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.idx'):
+                continue
+            segment = int(name[:-4])
+            path = os.path.join(self.directory, name)
+            start = self._loaded.get(name, 0)
+            try:
+                if os.path.getsize(path) - start < ENTRY.size:
+                    continue
+                size = os.path.getsize(self._segment_path(segment))
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    data = f.read()
+            except OSError as e:
+                logger.error(f"Could not read archive index {name}: {e}")
+                continue
+            # A torn trailing entry is read again next time, once complete
+            data = data[:len(data) - len(data) % ENTRY.size]
+            self._loaded[name] = start + len(data)
+            for low, high, offset in ENTRY.iter_unpack(data):
+                # Ignored: an entry whose block never made it to disk
+                if offset + BLOCK.size <= size:
+                    self._add((low, high), segment, offset)
+
+    def close(self):
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = {}
+
+    def messages(self, key):
+        """Archived messages of a conversation, in write order"""
+        for segment, offset in self.index.get(key, ()):
+            segment_map = self._map(segment, offset + BLOCK.size)
+            magic, compressed, _ = BLOCK.unpack_from(segment_map, offset)
+            if magic != BLOCK_MAGIC:
+                logger.error(f"Corrupt archive block at {segment}:{offset} in {self.directory}")
+                continue
+            start = offset + BLOCK.size
+            # Remapped if the open segment grew; still short means the block was cut off
+            segment_map = self._map(segment, start + compressed)
+            if start + compressed > len(segment_map):
+                logger.error(f"Truncated archive block at {segment}:{offset} in {self.directory}")
+                continue
+            try:
+                data = zlib.decompress(segment_map[start:start + compressed])
+            except zlib.error as e:
+                logger.error(f"Corrupt archive block at {segment}:{offset} in {self.directory}: {e}")
+                continue
+            for line in data.splitlines():
+                if line.startswith(b'[%d,%d,' % key):
+                    yield _decode(line)
+
+    def _add(self, key, segment, offset):
+        self.index.setdefault(key, []).append((segment, offset))
+        self.partners.setdefault(key[0], set()).add(key[1])
+        self.partners.setdefault(key[1], set()).add(key[0])
+
+    def _map(self, segment, end):
+        """mmap of the segment covering at least end bytes (the open segment keeps growing)"""
+        segment_map = self._maps.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return segment_map
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.seg")
+
+
+class ConversationArchive(ArchiveReader):
+    def __init__(self, root='archive', writer='main', segment_bytes=64 * 1024 * 1024,
+                 block_bytes=64 * 1024, flush_interval=2.0):
+        super().__init__(os.path.join(root, writer))
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.block_bytes = block_bytes
+        self.flush_interval = flush_interval
+        self.segment = None
+        self.blocks = 0
+        self.archived = 0
+        self._buffer = []       # (conversation key, encoded record) not yet written
+        self._buffered = 0
+        self._segment_file = None
+        self._index_file = None
+        self._task = None
+        self._readers = {}      # directory -> ArchiveReader of another writer, kept between lookups
+
+    @classmethod
+    def from_env(cls):
+        """Read at call time: each worker of a multi-worker node gets its own writer directory"""
+        return cls(
+            root=os.getenv('ARCHIVE_DIR', 'archive'),
+            writer=os.getenv('ARCHIVE_WRITER', 'main'),
+            segment_bytes=int(os.getenv('ARCHIVE_SEGMENT_BYTES', str(64 * 1024 * 1024))),
+            block_bytes=int(os.getenv('ARCHIVE_BLOCK_BYTES', str(64 * 1024))),
+            flush_interval=float(os.getenv('ARCHIVE_FLUSH_INTERVAL', '2')),
+        )
+
+    # ---- lifecycle -------------------------------------------------------
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+        segments = [int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.seg')]
+        self._open_segment(max(segments, default=0))
+        logger.info(f"Archive {self.directory}: {len(self.index)} conversations, segment {self.segment}")
+
+    async def start(self):
+        self.open()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+        for f in (self._segment_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._segment_file = self._index_file = None
+        self.close()
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f"Archive flush failed: {e}")
+
+    # ---- writing ---------------------------------------------------------
+
+    def append(self, sender_id, receiver_id, message_type, content, file_id=None):
+        key = conversation_key(sender_id, receiver_id)
+        record = json.dumps([key[0], key[1], sender_id, round(time.time(), 3), message_type, content, file_id],
+                            ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+        self._buffer.append((key, record))
+        self._buffered += len(record)
+        self.archived += 1
+        if self._buffered >= self.block_bytes:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records as one compressed block"""
+        if not self._buffer or self._segment_file is None:
+            return
+        if self._segment_file.tell() >= self.segment_bytes:
+            self._open_segment(self.segment + 1)
+        raw = b''.join(record for _, record in self._buffer)
+        data = zlib.compress(raw)
+        offset = self._segment_file.tell()
+        self._segment_file.write(BLOCK.pack(BLOCK_MAGIC, len(data), len(raw)) + data)
+        self._segment_file.flush()
+        # Index entries only after their block, so they never point past the data
+        keys = dict.fromkeys(key for key, _ in self._buffer)
+        self._index_file.write(b''.join(ENTRY.pack(low, high, offset) for low, high in keys))
+        self._index_file.flush()
+        for key in keys:
+            self._add(key, self.segment, offset)
+        self._buffer = []
+        self._buffered = 0
+        self.blocks += 1
+
+    def _open_segment(self, segment):
+        for f in (self._segment_file, self._index_file):
+            if f is not None:
+                f.close()
+        self.segment = segment
+        self._segment_file = open(self._segment_path(segment), 'ab')
+        self._index_file = open(os.path.join(self.directory, f"{segment:08d}.idx"), 'ab')
+
+    # ---- reading ---------------------------------------------------------
+
+    def transcript(self, user_id, partner_id):
+        """Every archived message between the two users, oldest first"""
+        key = conversation_key(user_id, partner_id)
+        messages = list(self.messages(key))
+        messages.extend(_decode(record) for buffered_key, record in self._buffer if buffered_key == key)
+        for reader in self._other_writers():
+            messages.extend(reader.messages(key))
+        messages.sort(key=lambda message: message.sent_at)
+        return messages
+
+    def conversations(self, user_id):
+        """Partners the user has archived messages with"""
+        partners = set(self.partners.get(user_id, ()))
+        partners.update(key[0] if key[1] == user_id else key[1] for key, _ in self._buffer if user_id in key)
+        for reader in self._other_writers():
+            partners.update(reader.partners.get(user_id, ()))
+        return sorted(partners)
+
+    def _other_writers(self):
+        """Readers for the other processes' directories under the same root, brought up to date"""
+        readers = []
+        for name in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, name)
+            if directory != self.directory and os.path.isdir(directory):
+                reader = self._readers.get(directory)
+                if reader is None:
+                    reader = self._readers[directory] = ArchiveReader(directory)
+                reader.load()
+                readers.append(reader)
+        return readers
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Database micro-benchmark suite
+
+Seeds SQLite (and optionally PostgreSQL) with a synthetic user population,
+times the hot Database methods and writes a JSON report.
+
+    python benchmark.py --sizes 10000,100000
+    python benchmark.py --backend postgres --postgres-dsn postgresql://... --allow-truncate
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+GENDERS = ['Male', 'Female']
+COUNTRIES = ['USA', 'UK', 'India', 'Canada', 'Australia', 'Germany', 'France', 'Japan', 'Other']
+AGES = [22, 30, 40, 50]
+MESSAGE_TYPES = ['text', 'text', 'text', 'photo', 'sticker', 'voice', 'video']
+
+# Columns seeded for each table, in insert order
+USER_COLUMNS = (
+    'user_id', 'username', 'first_name', 'gender', 'country', 'age',
+    'agreed_terms', 'profile_completed', 'is_blocked', 'is_vip', 'vip_until',
+    'referral_count', 'chat_partner', 'active_session_id', 'looking_for_chat',
+)
+SESSION_COLUMNS = ('user1_id', 'user2_id', 'started_at', 'is_active')
+MESSAGE_COLUMNS = ('sender_id', 'receiver_id', 'message_type', 'message_content', 'sent_at')
+
+FIRST_USER_ID = 1_000_000_000
+SEED_BATCH_SIZE = 50_000
+
+
+class Population:
+    """Deterministic synthetic population, generated lazily in batches"""
+
+    def __init__(self, size, waiting_share, chat_share, vip_share, blocked_share,
+                 messages_per_user, seed=42):
+        self.size = size
+        self.waiting_share = waiting_share
+        self.chat_share = chat_share
+        self.vip_share = vip_share
+        self.blocked_share = blocked_share
+        self.messages_per_user = messages_per_user
+        self.seed = seed
+        self.now = datetime.now().replace(microsecond=0)
+
+        # Users are laid out as [in chat | waiting | idle] so pairs are adjacent ids
+        self.chat_count = int(size * chat_share) // 2 * 2
+        self.waiting_count = int(size * waiting_share)
+        self.waiting_start = FIRST_USER_ID + self.chat_count
+        self.counts = {
+            'users': size,
+            'in_chat': self.chat_count,
+            'waiting': self.waiting_count,
+            'chat_sessions': self.chat_count // 2,
+            'message_logs': 0,
+        }
+
+    def user_ids(self):
+        return range(FIRST_USER_ID, FIRST_USER_ID + self.size)
+
+    def waiting_ids(self):
+        return range(self.waiting_start, self.waiting_start + self.waiting_count)
+
+    def users(self):
+        rng = random.Random(self.seed)
+        vip_until = self.now + timedelta(days=30)
+        for index, user_id in enumerate(self.user_ids()):
+            in_chat = index < self.chat_count
+            waiting = not in_chat and index < self.chat_count + self.waiting_count
+            partner = session_id = None
+            if in_chat:
+                partner = user_id + 1 if index % 2 == 0 else user_id - 1
+                # Sessions are inserted pair by pair into empty tables, so ids start at 1
+                session_id = index // 2 + 1
+            is_vip = rng.random() < self.vip_share
+            yield (
+                user_id,
+                f"user{user_id}",
+                f"User {index}",
+                rng.choice(GENDERS),
+                rng.choice(COUNTRIES),
+                rng.choice(AGES),
+                True,
+                True,
+                not in_chat and not waiting and rng.random() < self.blocked_share,
+                is_vip,
+                vip_until.isoformat(sep=' ') if is_vip else None,
+                rng.randrange(5) if rng.random() < 0.1 else 0,
+                partner,
+                session_id,
+                waiting,
+            )
+
+    def sessions(self):
+        started = self.now - timedelta(minutes=5)
+        for user_id in range(FIRST_USER_ID, FIRST_USER_ID + self.chat_count, 2):
+            yield (user_id, user_id + 1, started.isoformat(sep=' '), True)
+
+    def messages(self):
+        rng = random.Random(self.seed + 1)
+        total = self.size * self.messages_per_user
+        self.counts['message_logs'] = total
+        for index in range(total):
+            sender = FIRST_USER_ID + rng.randrange(self.size)
+            receiver = FIRST_USER_ID + rng.randrange(self.size)
+            message_type = rng.choice(MESSAGE_TYPES)
+            content = f"message {index} from {sender}" if message_type == 'text' else message_type.title()
+            sent_at = self.now - timedelta(seconds=rng.randrange(30 * 24 * 3600))
+            yield (sender, receiver, message_type, content, sent_at.isoformat(sep=' '))
+
+
+def _batches(rows, size=SEED_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _sqlite_row(row):
+    return tuple(int(value) if isinstance(value, bool) else value for value in row)
+
+
+def seed_sqlite(path, population):
+    """Bulk load the population with executemany inside a single transaction"""
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA synchronous = OFF')
+    tables = (
+        ('users', USER_COLUMNS, population.users()),
+        ('chat_sessions', SESSION_COLUMNS, population.sessions()),
+        ('message_logs', MESSAGE_COLUMNS, population.messages()),
+    )
+    with connection:
+        for table, columns, rows in tables:
+            query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            for batch in _batches(rows):
+                connection.executemany(query, [_sqlite_row(row) for row in batch])
+    connection.close()
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', ' ').replace('\n', ' ')
+
+
+def seed_postgres(connection, population):
+    """Bulk load the population with COPY, one buffer per batch"""
+    cursor = connection.cursor()
+    cursor.execute('TRUNCATE users, chat_sessions, message_logs RESTART IDENTITY')
+    tables = (
+        ('users', USER_COLUMNS, population.users()),
+        ('chat_sessions', SESSION_COLUMNS, population.sessions()),
+        ('message_logs', MESSAGE_COLUMNS, population.messages()),
+    )
+    for table, columns, rows in tables:
+        for batch in _batches(rows):
+            buffer = io.StringIO()
+            for row in batch:
+                buffer.write('\t'.join(_copy_value(value) for value in row))
+                buffer.write('\n')
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+    cursor.execute('ANALYZE users')
+    cursor.execute('ANALYZE chat_sessions')
+    cursor.execute('ANALYZE message_logs')
+    cursor.close()
+
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 4),
+        'min_ms': round(ordered[0] * 1000, 4),
+        'p50_ms': round(percentile(0.50) * 1000, 4),
+        'p95_ms': round(percentile(0.95) * 1000, 4),
+        'p99_ms': round(percentile(0.99) * 1000, 4),
+        'max_ms': round(ordered[-1] * 1000, 4),
+    }
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def run_methods(db, population, iterations, heavy_iterations, seed=7):
+    """Time each Database method against the seeded population"""
+    rng = random.Random(seed)
+    user_ids = population.user_ids()
+    results = {}
+
+    results['get_user'] = summarize([
+        _timed(db.get_user, rng.choice(user_ids)) for _ in range(iterations)
+    ])
+
+    filters = [None, 'Female', 'Male']
+    results['find_chat_partner_by_gender'] = summarize([
+        _timed(db.find_chat_partner_by_gender, rng.choice(user_ids), filters[i % len(filters)])
+        for i in range(iterations)
+    ])
+
+    # Pair up waiting users so sessions start and end on realistic rows
+    waiting = list(population.waiting_ids())
+    rng.shuffle(waiting)
+    pairs = [(waiting[i], waiting[i + 1]) for i in range(0, min(len(waiting) - 1, iterations * 2), 2)]
+    results['start_chat_session'] = summarize([_timed(db.start_chat_session, a, b) for a, b in pairs])
+    results['end_chat_session'] = summarize([_timed(db.end_chat_session, a) for a, _ in pairs])
+
+    results['get_detailed_stats'] = summarize([
+        _timed(db.get_detailed_stats) for _ in range(heavy_iterations)
+    ])
+    results['get_all_users'] = summarize([
+        _timed(db.get_all_users) for _ in range(heavy_iterations)
+    ])
+
+    # Destructive, so it runs last on users nobody else touched
+    victims = rng.sample(user_ids, min(iterations, len(user_ids)))
+    results['delete_user'] = summarize([_timed(db.delete_user, user_id) for user_id in victims])
+    return results
+
+
+def open_database(backend, sqlite_path=None, postgres_dsn=None, sqlite_mode=None):
+    """Build a Database bound to the requested backend via its environment switches"""
+    # "postgres" connects to DATABASE_URL alone: the probe must never fall back to
+    # the PG* settings (possibly production) before seed_postgres truncates tables
+    os.environ['DB_BACKEND'] = 'sqlite' if backend == 'sqlite' else 'postgres'
+    # Probe every run; never reuse (or overwrite) the bot's cached backend choice
+    os.environ['DB_STATE_FILE'] = os.devnull
+    os.environ['WRITE_JOURNAL_PATH'] = ''
+    if sqlite_path:
+        os.environ['SQLITE_PATH'] = sqlite_path
+    if sqlite_mode:
+        os.environ['SQLITE_MODE'] = sqlite_mode
+    if backend != 'sqlite':
+        if not postgres_dsn:
+            raise RuntimeError("The postgres backend needs --postgres-dsn")
+        os.environ['DATABASE_URL'] = postgres_dsn
+
+    import database
+    db = database.Database()
+    if db.connection is None or db.is_sqlite != (backend == 'sqlite'):
+        raise RuntimeError(f"Could not open the {backend} backend")
+    if backend != 'sqlite':
+        # Belt and braces before anything destructive: the server we reached is the one requested
+        requested = database.psycopg2.extensions.parse_dsn(postgres_dsn)
+        connected = db.connection.get_dsn_parameters()
+        if database._chosen_candidate != 'DATABASE_URL' or any(
+                requested.get(key) not in (None, connected.get(key)) for key in ('host', 'port', 'dbname', 'user')):
+            db.close()
+            raise RuntimeError("Connected PostgreSQL server is not the one given by --postgres-dsn")
+    return db
+
+
+def bench_sqlite(population, args, workdir):
+    path = os.path.join(workdir, f"bench_{population.size}.db")
+    db = open_database('sqlite', sqlite_path=path, sqlite_mode=args.sqlite_mode)
+
+    start = time.perf_counter()
+    seed_sqlite(path, population)
+    seed_seconds = time.perf_counter() - start
+
+    methods = run_methods(db, population, args.iterations, args.heavy_iterations)
+    db.close()
+    return seed_seconds, methods
+
+
+def bench_postgres(population, args):
+    db = open_database('postgres', postgres_dsn=args.postgres_dsn)
+
+    start = time.perf_counter()
+    seed_postgres(db.connection, population)
+    seed_seconds = time.perf_counter() - start
+
+    methods = run_methods(db, population, args.iterations, args.heavy_iterations)
+    db.close()
+    return seed_seconds, methods
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Database layer on synthetic populations")
+    parser.add_argument('--backend', choices=['sqlite', 'postgres', 'both'], default='sqlite')
+    parser.add_argument('--postgres-dsn', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="DSN of a scratch PostgreSQL database (its tables are truncated)")
+    parser.add_argument('--allow-truncate', action='store_true',
+                        help="Confirm that the PostgreSQL tables may be truncated")
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help="Comma separated population sizes")
+    parser.add_argument('--waiting-share', type=float, default=0.05)
+    parser.add_argument('--chat-share', type=float, default=0.10)
+    parser.add_argument('--vip-share', type=float, default=0.05)
+    parser.add_argument('--blocked-share', type=float, default=0.02)
+    parser.add_argument('--messages-per-user', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=200,
+                        help="Calls per cheap method")
+    parser.add_argument('--heavy-iterations', type=int, default=5,
+                        help="Calls per full-table method (stats, get_all_users)")
+    parser.add_argument('--sqlite-mode', choices=['tuned', 'basic'], default=os.getenv('SQLITE_MODE', 'tuned'),
+                        help="SQLite backend mode to benchmark (see sqlite_backend.py)")
+    parser.add_argument('--output', default='bench_output.json')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    backends = ['sqlite', 'postgres'] if args.backend == 'both' else [args.backend]
+
+    if 'postgres' in backends and not (args.postgres_dsn and args.allow_truncate):
+        print("PostgreSQL benchmarks need --postgres-dsn and --allow-truncate (tables are wiped)")
+        return 1
+
+    report = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'parameters': {key: value for key, value in vars(args).items() if key != 'postgres_dsn'},
+        'runs': [],
+    }
+
+    workdir = tempfile.mkdtemp(prefix='bot_bench_')
+    try:
+        for backend in backends:
+            for size in sizes:
+                population = Population(size, args.waiting_share, args.chat_share, args.vip_share,
+                                        args.blocked_share, args.messages_per_user)
+                print(f"[{backend}] seeding {size} users...")
+                if backend == 'sqlite':
+                    seed_seconds, methods = bench_sqlite(population, args, workdir)
+                else:
+                    seed_seconds, methods = bench_postgres(population, args)
+                print(f"[{backend}] {size} users seeded in {seed_seconds:.2f}s")
+                report['runs'].append({
+                    'backend': backend if backend != 'sqlite' else f"sqlite-{args.sqlite_mode}",
+                    'population': size,
+                    'seed_seconds': round(seed_seconds, 3),
+                    'rows': dict(population.counts),
+                    'methods': methods,
+                })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
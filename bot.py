@@ -1,13 +1,27 @@
 import os
 import logging
 import asyncio
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+import time
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, PreCheckoutQueryHandler, ExtBot
 from telegram.error import TelegramError
 from telegram import Update
 from database import Database
+from update_processor import OrderedUpdateProcessor
+from albums import MediaGroupAggregator
+from moderation import ModerationPipeline
+from pairing import PairingRegistry, SESSION_IDLE_TIMEOUT, WAITING_TIMEOUT, REAPER_INTERVAL
+from templates import TemplateRegistry
+from referrals import ReferralWorker
+from matching import vip_active, MATCH_MODE, MATCH_TICK
+from callbacks import CallbackRouter, encode as encode_callback
+from outbound import OutboundScheduler, PRIORITY_RELAY, PRIORITY_MATCH, PRIORITY_ADMIN, PRIORITY_LOG, PRIORITY_BROADCAST
+from archive import ConversationArchive, ARCHIVE_MODE
+from exporter import export_parts, FORMATS as EXPORT_FORMATS, TABLES as EXPORT_TABLES
 from datetime import datetime
+from collections import namedtuple, OrderedDict
 import re
+import pathlib
 
 # Configure logging
 logging.basicConfig(
@@ -24,16 +38,175 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 LOG_GROUP_ID = -1002911871934
 INITIAL_ADMIN_ID = 8147394357
 
+# VIP packages on sale: days -> price in Telegram Stars
+VIP_PACKAGES = {1: 10, 5: 25, 12: 50, 30: 100}
+
+# Results per page of the admin /search command
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '10'))
+# Searches kept for paging (most recently used, one per admin) and for how long
+SEARCH_KEEP = 50
+SEARCH_TTL = 1800
+
+# Telegram language codes remembered for notices to users who did not trigger them (partners)
+LANGUAGES_KEEP = 100_000
+
+# Telegram caption limit for media messages
+MAX_CAPTION_LENGTH = 1024
+
+# Relayable content types, checked in order: Telegram also sets `document` on
+# animations and `location` on venues, so the specific type must come first.
+# log_style says how the log group mirror carries the header: "text" (one text
+# message), "caption" (copied with the header as caption) or "button" (copied
+# with the header on an inline button, for types without captions).
+RelayType = namedtuple('RelayType', ['name', 'label', 'log_style'])
+RELAY_TYPES = (
+    RelayType('text', 'Text Message', 'text'),
+    RelayType('animation', 'Animation', 'caption'),
+    RelayType('photo', 'Photo', 'caption'),
+    RelayType('video', 'Video', 'caption'),
+    RelayType('document', 'Document', 'caption'),
+    RelayType('audio', 'Audio', 'caption'),
+    RelayType('voice', 'Voice message', 'caption'),
+    RelayType('video_note', 'Video note', 'button'),
+    RelayType('sticker', 'Sticker', 'button'),
+    RelayType('venue', 'Venue', 'button'),
+    RelayType('location', 'Location', 'button'),
+    RelayType('contact', 'Contact', 'button'),
+    RelayType('dice', 'Dice', 'button'),
+)
+
+def detect_relay_type(message):
+    for relay_type in RELAY_TYPES:
+        if getattr(message, relay_type.name, None):
+            return relay_type
+    return None
+
+# Album item types and the InputMedia class used to mirror them to the log group
+ALBUM_MEDIA = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'document': InputMediaDocument,
+    'audio': InputMediaAudio,
+}
+
+def album_input_media(message, caption=None):
+    relay_type = detect_relay_type(message)
+    if relay_type is None or relay_type.name not in ALBUM_MEDIA:
+        return None
+    media = message.photo[-1] if relay_type.name == 'photo' else getattr(message, relay_type.name)
+    return ALBUM_MEDIA[relay_type.name](media=media.file_id, caption=caption)
+
+def relay_content(message, relay_type):
+    """Text stored in message_logs for a relayed message"""
+    if relay_type.name == 'text':
+        return message.text
+    return message.caption or relay_type.label
+
+def relay_file_id(message):
+    """file_id of the relayed media (largest photo size), kept in the archive; None without a file"""
+    attachment = message.effective_attachment
+    if isinstance(attachment, (tuple, list)):
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, 'file_id', None)
+
 # Initialize database
 db = Database()
 
 class TelegramBot:
     def __init__(self):
-        self.application = Application.builder().token(BOT_TOKEN).concurrent_updates(True).read_timeout(30).write_timeout(30).connect_timeout(30).pool_timeout(30).build()
+        # Set by workers.py when this process serves one shard of a multi-worker deployment
+        self.shard = None
+        # Serial per user, parallel across users (see update_processor.py)
+        self.update_processor = OrderedUpdateProcessor()
+        # Every outbound send to another chat goes through the rate-limited scheduler
+        self.outbound = OutboundScheduler()
+        # Albums arrive as one update per item; relay them as one unit
+        self.albums = MediaGroupAggregator(self.relay_album)
+        # Link/phone/mention/banned-word rules, compiled once (see moderation.py)
+        self.moderation = ModerationPipeline.from_env()
+        # Active pairs and waiting users; the source of truth for routing (see pairing.py)
+        self.pairing = PairingRegistry(db)
+        # Batch mode: searches wait for the next matching round (see matching.py)
+        self.batch_matching = False
+        self.match_task = None
+        self.reaper_task = None
+        # Referral rewards and the referrer leaderboard, off the /start path (see referrals.py)
+        self.referrals = ReferralWorker(db, self.notify_referrer)
+        self.languages = OrderedDict()  # user_id -> language_code, most recently seen last
+        self.searches = OrderedDict()   # admin user_id -> (started, terms, user_id, since) of their last /search
+        # Local audit trail instead of (or besides) mirroring every message to the log group (see archive.py)
+        self.archive = ConversationArchive.from_env() if ARCHIVE_MODE in ('archive', 'both') else None
+        self.mirror_to_group = ARCHIVE_MODE != 'archive'
+        # Texts and keyboards built once per locale (see templates.py)
+        self.templates = TemplateRegistry.from_env()
+        # Inline button actions, dispatched by action code (see callbacks.py)
+        self.callbacks = CallbackRouter()
+        self.register_callbacks()
+        self.application = Application.builder().token(BOT_TOKEN).concurrent_updates(self.update_processor).read_timeout(30).write_timeout(30).connect_timeout(30).pool_timeout(30).post_init(self.post_init).post_shutdown(self.post_shutdown).build()
         self.setup_handlers()
         # Add error handler
         self.application.add_error_handler(self.error_handler)
 
+    def text(self, update, name, **fields):
+        """Template text in the user's language; fields are filled in when given"""
+        language_code = self.remember_language(update)
+        if fields:
+            return self.templates.render(name, language_code, **fields)
+        return self.templates.text(name, language_code)
+
+    def remember_language(self, update):
+        """The language of the update's user, kept for later notices to them"""
+        user = update.effective_user
+        if user is None:
+            return None
+        self.languages.pop(user.id, None)
+        self.languages[user.id] = user.language_code
+        if len(self.languages) > LANGUAGES_KEEP:
+            self.languages.popitem(last=False)
+        return user.language_code
+
+    def user_text(self, user_id, name, **fields):
+        """Template text in the last language seen from user_id (default locale if never seen)"""
+        language_code = self.languages.get(user_id)
+        if fields:
+            return self.templates.render(name, language_code, **fields)
+        return self.templates.text(name, language_code)
+
+    def keyboard(self, update, name):
+        language_code = update.effective_user.language_code if update.effective_user else None
+        return self.templates.keyboard(name, language_code)
+
+    async def post_init(self, application: Application):
+        # Rebuild pairs from active chat sessions before the first update is handled
+        self.pairing.shared = self.shard is not None
+        self.pairing.load()
+        await self.pairing.start()
+        await self.outbound.start()
+        # Shared (multi-worker) mode claims partners in the database, one search at a time
+        self.batch_matching = MATCH_MODE == 'batch' and not self.pairing.shared
+        if not self.pairing.shared:
+            # Batch rounds, or re-checking waiters whose preferences widened (instant mode)
+            self.match_task = asyncio.create_task(self.match_loop())
+        self.reaper_task = asyncio.create_task(self.reap_loop())
+        await self.referrals.start()
+        if self.archive:
+            await self.archive.start()
+
+    async def post_shutdown(self, application: Application):
+        for task in (self.match_task, self.reaper_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.match_task = self.reaper_task = None
+        await self.referrals.stop()
+        if self.archive:
+            await self.archive.stop()
+        await self.outbound.stop()
+        await self.pairing.stop()
+
     async def error_handler(self, update, context):
         logger.error(f"Exception while handling an update: {context.error}")
         # Try to notify user of error
@@ -46,6 +219,56 @@ class TelegramBot:
         except:
             pass
 
+    async def deliver(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, method: str, failure_notice=None, priority=PRIORITY_RELAY, **kwargs):
+        """Call a Bot API method addressed to user_id from the shard that owns that user.
+
+        In single-process mode (or when we own the user) the call is queued on the
+        outbound scheduler and awaited. Otherwise it is published on the shard bus,
+        and failure_notice ({'chat_id', 'text'}) is sent by the owning worker if
+        the call fails there.
+        """
+        if self.shard and not self.shard.owns(user_id):
+            self.shard.publish_event(user_id, {
+                'type': 'deliver',
+                'method': method,
+                'chat_id': user_id,
+                'kwargs': kwargs,
+                'priority': priority,
+                'failure_notice': failure_notice
+            })
+            return None
+        return await self.outbound.call(priority, user_id, getattr(context.bot, method), chat_id=user_id, **kwargs)
+
+    def announce_pairing(self, event_type, user_id, partner_id):
+        """Tell the partner's shard about a pair we created ('pair') or ended ('unpair')"""
+        if self.shard and not self.shard.owns(partner_id):
+            self.shard.publish_event(partner_id, {'type': event_type, 'user_id': partner_id, 'partner_id': user_id})
+
+    async def handle_shard_event(self, event):
+        """Apply an event another shard published for a user we own"""
+        if event.get('type') == 'pair':
+            self.pairing.adopt(event['user_id'], event['partner_id'])
+        elif event.get('type') == 'unpair':
+            self.pairing.drop(event['user_id'])
+        elif event.get('type') == 'deliver':
+            # Relays from a partner on another shard keep our side of the session alive
+            self.pairing.touch(event['chat_id'])
+            try:
+                bot_method = getattr(self.application.bot, event['method'])
+                await self.outbound.call(event.get('priority', PRIORITY_RELAY), event['chat_id'], bot_method,
+                                         chat_id=event['chat_id'], **event['kwargs'])
+            except Exception as e:
+                logger.error(f"Error delivering {event['method']} to {event['chat_id']}: {e}")
+                notice = event.get('failure_notice')
+                if notice:
+                    try:
+                        self.outbound.post(PRIORITY_RELAY, notice['chat_id'], self.application.bot.send_message,
+                                           chat_id=notice['chat_id'], text=notice['text'])
+                    except TelegramError:
+                        pass
+        else:
+            logger.warning(f"Unknown shard event: {event.get('type')}")
+
     def setup_handlers(self):
         # Command handlers
         self.application.add_handler(CommandHandler("start", self.start))
@@ -66,6 +289,10 @@ class TelegramBot:
         self.application.add_handler(CommandHandler("promotevip", self.admin_promote_vip))
         self.application.add_handler(CommandHandler("fjoin", self.admin_fjoin))
         self.application.add_handler(CommandHandler("removefjoin", self.admin_remove_fjoin))
+        self.application.add_handler(CommandHandler("topreferrers", self.admin_top_referrers))
+        self.application.add_handler(CommandHandler("export", self.admin_export))
+        self.application.add_handler(CommandHandler("search", self.admin_search))
+        self.application.add_handler(CommandHandler("transcript", self.admin_transcript))
         
         # Callback query handler
         self.application.add_handler(CallbackQueryHandler(self.button_callback))
@@ -78,6 +305,9 @@ class TelegramBot:
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
+        if not db.available:
+            await update.message.reply_text(self.text(update, 'degraded'))
+            return
         
         # Check if user already exists (to determine if they're new)
         existing_user = db.get_user(user.id)
@@ -88,24 +318,17 @@ class TelegramBot:
         if is_new_user and context.args and len(context.args) > 0:
             try:
                 referred_by = int(context.args[0])
-                if referred_by != user.id:
-                    # Give VIP to referrer for 24 hours
-                    db.set_vip_status(referred_by, 1)
-                    db.update_referral_count(referred_by)
-                    
-                    # Notify referrer
-                    try:
-                        await context.bot.send_message(
-                            chat_id=referred_by,
-                            text="🎉 Someone started the bot through your referral link! You've been granted VIP status for 24 hours."
-                        )
-                    except:
-                        pass
             except ValueError:
                 referred_by = None
+            if referred_by == user.id or (referred_by and db.get_user(referred_by) is None):
+                referred_by = None
         
         # Add user to database (or update if exists)
         db.add_user(user.id, user.username, user.first_name, user.last_name, referred_by)
+        if referred_by:
+            # The VIP reward and the referrer's notification are handled by the referral worker
+            db.record_referral(referred_by, user.id)
+            self.referrals.wake()
         
         # Check if user already agreed to terms
         user_data = db.get_user(user.id)
@@ -117,237 +340,136 @@ class TelegramBot:
             return
         
         # Show Terms and Conditions
-        keyboard = [
-            [InlineKeyboardButton("💎 ✅ JOIN ELITE COMMUNITY", callback_data="terms_agree")],
-            [InlineKeyboardButton("🚫 ❌ DECLINE ACCESS", callback_data="terms_disagree")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        terms_text = """
-╔══════════════════════════════════╗
-║   🌟 **PREMIUM ANONYMOUS CHAT** 🌟   ║
-╚══════════════════════════════════╝
-
-💎 **Welcome to the Elite Dating Experience!** 💎
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃ 📜 **Terms & Conditions** 📜
-┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
-┃ 🔸 Premium anonymous chat platform
-┃ 🔸 Zero tolerance for harassment  
-┃ 🔸 Respectful communication only
-┃ 🔸 No external links permitted
-┃ 🔸 VIP group membership required
-┃ 🔸 Admin decisions are absolute
-┃ 🔸 All chats monitored for safety
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-✨ **By agreeing, you join our exclusive community** ✨
-        """
-        
-        await update.message.reply_text(terms_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(self.text(update, 'terms'), reply_markup=self.keyboard(update, 'terms'), parse_mode='Markdown')
+
+    def register_callbacks(self):
+        """Inline button actions (see callbacks.py for the codes and argument types)"""
+        for name, handler in (
+            ('terms_agree', self.on_terms_agree),
+            ('terms_disagree', self.on_terms_disagree),
+            ('set_gender', self.on_set_gender),
+            ('set_country', self.on_set_country),
+            ('set_age', self.on_set_age),
+            ('vip_refer', lambda update, context: self.show_referral_info(update, context)),
+            ('vip_purchase', lambda update, context: self.show_vip_purchase_options(update, context)),
+            ('buy_vip', self.on_buy_vip),
+            ('update_profile', lambda update, context: self.update_profile_menu(update, context)),
+            ('partner_filter', self.on_partner_filter),
+            ('set_filter', self.on_set_filter),
+            ('edit_gender', self.on_edit('select_gender')),
+            ('edit_country', self.on_edit('select_country')),
+            ('edit_age', self.on_edit('select_age')),
+            ('update_gender', self.on_update_gender),
+            ('update_country', self.on_update_country),
+            ('update_age', self.on_update_age),
+            ('back_to_profile', self.on_back_to_profile),
+            ('match_girls', self.on_match('Female')),
+            ('match_boys', self.on_match('Male')),
+            ('match_random', lambda update, context: self.find_chat_partner_by_gender(update, context, None)),
+            # Header buttons on log group mirrors carry no action
+            ('log_info', self.on_noop),
+            ('search_page', self.on_search_page),
+        ):
+            self.callbacks.register(name, handler)
 
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        await query.answer()
-        
-        user_id = query.from_user.id
-        data = query.data
-        
-        if data == "terms_agree":
-            db.update_user_terms(user_id, True)
-            await query.edit_message_text("🎉 **WELCOME TO THE ELITE!** 🎉\n\n💎 Let's create your premium profile...", parse_mode='Markdown')
-            await self.setup_profile(update, context)
-            
-        elif data == "terms_disagree":
-            await query.edit_message_text("💔 **ACCESS DENIED** 💔\n\n🚫 Elite membership requires agreement to our terms.\n\n👋 See you later!", parse_mode='Markdown')
-            return
-            
-        elif data.startswith("gender_"):
-            gender = data.split("_")[1]
-            db.update_user_profile(user_id, gender=gender)
-            await query.edit_message_text(f"🎉 **PERFECT CHOICE!** 🎉\n\n✨ {gender} profile activated", parse_mode='Markdown')
-            await self.setup_country(update, context)
-            
-        elif data.startswith("country_"):
-            country = data.split("_")[1]
-            db.update_user_profile(user_id, country=country)
-            await query.edit_message_text(f"🌍 **LOCATION CONFIRMED!** 🌍\n\n✨ {country} selected as your territory", parse_mode='Markdown')
-            await self.setup_age(update, context)
-            
-        elif data.startswith("age_"):
-            age = int(data.split("_")[1])
-            # Save age and mark profile as completed
-            db.update_user_profile(user_id, age=age, profile_completed=True)
-            await query.edit_message_text(f"🎂 **AGE VERIFIED!** 🎂\n\n✨ {age} age category locked in", parse_mode='Markdown')
-            await self.check_force_join_compliance(update, context)
-
-            
-        elif data == "vip_refer":
-            await self.show_referral_info(update, context)
-            
-        elif data == "vip_purchase":
-            await self.show_vip_purchase_options(update, context)
-            
-        elif data.startswith("buy_vip_"):
-            days, stars = data.split("_")[2], int(data.split("_")[3])
-            await self.process_vip_purchase(update, context, int(days), stars)
-            
-        elif data == "update_profile":
-            await self.update_profile_menu(update, context)
-            
-        elif data == "partner_filter":
-            user_data = db.get_user(user_id)
-            if user_data and user_data['is_vip'] and user_data['vip_until'] and datetime.fromisoformat(str(user_data['vip_until'])) > datetime.now():
-                await self.partner_filter_menu(update, context)
-            else:
-                await query.edit_message_text("🔒 **VIP EXCLUSIVE** 🔒\n\n👑 This feature requires VIP membership\n💎 Use `/vip` to unlock premium features", parse_mode='Markdown')
-                
-        elif data.startswith("filter_"):
-            gender_filter = data.split("_")[1] if data.split("_")[1] != "any" else None
-            db.update_partner_filter(user_id, gender_filter)
-            filter_text = gender_filter if gender_filter else "Any"
-            await query.edit_message_text(f"🎯 **FILTER UPDATED!** 🎯\n\n✨ Partner preference: **{filter_text}**", parse_mode='Markdown')
-            
-        elif data == "edit_gender":
-            keyboard = [
-                [InlineKeyboardButton("👨 Male", callback_data="update_gender_Male")],
-                [InlineKeyboardButton("👩 Female", callback_data="update_gender_Female")],
-                [InlineKeyboardButton("🔙 Back", callback_data="update_profile")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("🚹 **Select your gender:**", reply_markup=reply_markup, parse_mode='Markdown')
-            
-        elif data == "edit_country":
-            keyboard = [
-                [InlineKeyboardButton("🇵🇰 Pakistan", callback_data="update_country_Pakistan")],
-                [InlineKeyboardButton("🇮🇳 India", callback_data="update_country_India")],
-                [InlineKeyboardButton("🇺🇸 USA", callback_data="update_country_USA")],
-                [InlineKeyboardButton("🇬🇧 UK", callback_data="update_country_UK")],
-                [InlineKeyboardButton("🇨🇦 Canada", callback_data="update_country_Canada")],
-                [InlineKeyboardButton("🌍 Other", callback_data="update_country_Other")],
-                [InlineKeyboardButton("🔙 Back", callback_data="update_profile")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("🌍 **Select your country:**", reply_markup=reply_markup, parse_mode='Markdown')
-            
-        elif data == "edit_age":
-            keyboard = []
-            for age in range(18, 36, 2):
-                keyboard.append([InlineKeyboardButton(f"{age}-{age+1}", callback_data=f"update_age_{age}")])
-            keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="update_profile")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("🎂 **Select your age group:**", reply_markup=reply_markup, parse_mode='Markdown')
-            
-        elif data.startswith("update_gender_"):
-            new_gender = data.split("_")[2]
-            db.update_user_profile(user_id, gender=new_gender)
-            await query.edit_message_text(f"🎭 **PROFILE UPDATED!** 🎭\n\n✨ Gender changed to: **{new_gender}**", parse_mode='Markdown')
-            
-        elif data.startswith("update_country_"):
-            new_country = data.split("_")[2]
-            db.update_user_profile(user_id, country=new_country)
-            await query.edit_message_text(f"🌍 **LOCATION UPDATED!** 🌍\n\n✨ Territory changed to: **{new_country}**", parse_mode='Markdown')
-            
-        elif data.startswith("update_age_"):
-            new_age = int(data.split("_")[2])
-            db.update_user_profile(user_id, age=new_age)
-            await query.edit_message_text(f"🎂 **AGE UPDATED!** 🎂\n\n✨ Age category changed to: **{new_age}**", parse_mode='Markdown')
-            
-        elif data == "back_to_profile":
-            keyboard = [
-                [InlineKeyboardButton("✏️ Update Profile", callback_data="update_profile")],
-                [InlineKeyboardButton("🔍 Partner Filter (VIP)", callback_data="partner_filter")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("👤 **Profile Options:**", reply_markup=reply_markup, parse_mode='Markdown')
-            
-        # New gender-based matching callbacks
-        elif data == "match_girls":
-            user_data = db.get_user(user_id)
-            if user_data and user_data['is_vip'] and user_data['vip_until'] and datetime.fromisoformat(str(user_data['vip_until'])) > datetime.now():
-                await self.find_chat_partner_by_gender(update, context, "Female")
-            else:
-                await query.edit_message_text("🔒 **VIP EXCLUSIVE** 🔒\n\n👑 This feature requires VIP membership\n💎 Use `/vip` to unlock premium features", parse_mode='Markdown')
-                
-        elif data == "match_boys":
-            user_data = db.get_user(user_id)
-            if user_data and user_data['is_vip'] and user_data['vip_until'] and datetime.fromisoformat(str(user_data['vip_until'])) > datetime.now():
-                await self.find_chat_partner_by_gender(update, context, "Male")
+        await self.callbacks.dispatch(update, context)
+
+    async def on_terms_agree(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        db.update_user_terms(update.callback_query.from_user.id, True)
+        await update.callback_query.edit_message_text(self.text(update, 'terms_agreed'), parse_mode='Markdown')
+        await self.setup_profile(update, context)
+
+    async def on_terms_disagree(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.callback_query.edit_message_text(self.text(update, 'terms_declined'), parse_mode='Markdown')
+
+    async def on_set_gender(self, update: Update, context: ContextTypes.DEFAULT_TYPE, gender):
+        db.update_user_profile(update.callback_query.from_user.id, gender=gender)
+        await update.callback_query.edit_message_text(self.text(update, 'gender_set', gender=gender), parse_mode='Markdown')
+        await self.setup_country(update, context)
+
+    async def on_set_country(self, update: Update, context: ContextTypes.DEFAULT_TYPE, country):
+        db.update_user_profile(update.callback_query.from_user.id, country=country)
+        await update.callback_query.edit_message_text(self.text(update, 'country_set', country=country), parse_mode='Markdown')
+        await self.setup_age(update, context)
+
+    async def on_set_age(self, update: Update, context: ContextTypes.DEFAULT_TYPE, age):
+        # Save age and mark profile as completed
+        db.update_user_profile(update.callback_query.from_user.id, age=age, profile_completed=True)
+        await update.callback_query.edit_message_text(self.text(update, 'age_set', age=age), parse_mode='Markdown')
+        await self.check_force_join_compliance(update, context)
+
+    async def on_buy_vip(self, update: Update, context: ContextTypes.DEFAULT_TYPE, days):
+        # The price comes from VIP_PACKAGES, never from the button
+        stars = VIP_PACKAGES.get(days)
+        if stars is not None:
+            await self.process_vip_purchase(update, context, days, stars)
+
+    async def on_partner_filter(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if vip_active(db.get_user(update.callback_query.from_user.id)):
+            await self.partner_filter_menu(update, context)
+        else:
+            await update.callback_query.edit_message_text(self.text(update, 'vip_exclusive'), parse_mode='Markdown')
+
+    async def on_set_filter(self, update: Update, context: ContextTypes.DEFAULT_TYPE, choice):
+        gender_filter = choice if choice != "any" else None
+        db.update_partner_filter(update.callback_query.from_user.id, gender_filter)
+        filter_text = gender_filter if gender_filter else "Any"
+        await update.callback_query.edit_message_text(self.text(update, 'filter_updated', filter=filter_text), parse_mode='Markdown')
+
+    def on_edit(self, menu):
+        """Handler showing one of the profile field menus"""
+        async def show(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            await update.callback_query.edit_message_text(self.text(update, menu), reply_markup=self.keyboard(update, menu), parse_mode='Markdown')
+        return show
+
+    async def on_update_gender(self, update: Update, context: ContextTypes.DEFAULT_TYPE, new_gender):
+        db.update_user_profile(update.callback_query.from_user.id, gender=new_gender)
+        await update.callback_query.edit_message_text(self.text(update, 'gender_updated', gender=new_gender), parse_mode='Markdown')
+
+    async def on_update_country(self, update: Update, context: ContextTypes.DEFAULT_TYPE, new_country):
+        db.update_user_profile(update.callback_query.from_user.id, country=new_country)
+        await update.callback_query.edit_message_text(self.text(update, 'country_updated', country=new_country), parse_mode='Markdown')
+
+    async def on_update_age(self, update: Update, context: ContextTypes.DEFAULT_TYPE, new_age):
+        db.update_user_profile(update.callback_query.from_user.id, age=new_age)
+        await update.callback_query.edit_message_text(self.text(update, 'age_updated', age=new_age), parse_mode='Markdown')
+
+    async def on_back_to_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.callback_query.edit_message_text(self.text(update, 'profile_options'), reply_markup=self.keyboard(update, 'profile_options'), parse_mode='Markdown')
+
+    def on_match(self, gender_filter):
+        """Handler for the VIP gender-filtered match buttons"""
+        async def match(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if vip_active(db.get_user(update.callback_query.from_user.id)):
+                await self.find_chat_partner_by_gender(update, context, gender_filter)
             else:
-                await query.edit_message_text("🔒 **VIP EXCLUSIVE** 🔒\n\n👑 This feature requires VIP membership\n💎 Use `/vip` to unlock premium features", parse_mode='Markdown')
-                
-        elif data == "match_random":
-            await self.find_chat_partner_by_gender(update, context, None)
-
-    async def setup_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
-            [InlineKeyboardButton("💪 👨 GENTLEMAN", callback_data="gender_Male")],
-            [InlineKeyboardButton("💃 👩 LADY", callback_data="gender_Female")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        profile_text = """
-╔═══════════════════════════════╗
-║   🎭 **PROFILE CREATION** 🎭   ║
-╚═══════════════════════════════╝
+                await update.callback_query.edit_message_text(self.text(update, 'vip_exclusive'), parse_mode='Markdown')
+        return match
 
-💫 **Step 1: Choose Your Identity** 💫
+    async def on_noop(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        pass
 
-🌟 Select your gender to begin your premium experience
-        """
-        
+    async def setup_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        text, reply_markup = self.text(update, 'setup_gender'), self.keyboard(update, 'setup_gender')
         if update.callback_query and update.callback_query.message:
-            await update.callback_query.message.reply_text(profile_text, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
         elif update.message:
-            await update.message.reply_text(profile_text, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
     async def setup_country(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
-            [InlineKeyboardButton("🇺🇸 USA", callback_data="country_USA"), InlineKeyboardButton("🇬🇧 UK", callback_data="country_UK")],
-            [InlineKeyboardButton("🇮🇳 India", callback_data="country_India"), InlineKeyboardButton("🇨🇦 Canada", callback_data="country_Canada")],
-            [InlineKeyboardButton("🇦🇺 Australia", callback_data="country_Australia"), InlineKeyboardButton("🇩🇪 Germany", callback_data="country_Germany")],
-            [InlineKeyboardButton("🇫🇷 France", callback_data="country_France"), InlineKeyboardButton("🇯🇵 Japan", callback_data="country_Japan")],
-            [InlineKeyboardButton("🌍 ✨ OTHER LOCATION", callback_data="country_Other")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        country_text = """
-╔═══════════════════════════════╗
-║   🌍 **LOCATION SETUP** 🌍   ║
-╚═══════════════════════════════╝
-
-💫 **Step 2: Choose Your Territory** 💫
-
-🗺️ Select your country for premium matching
-        """
-        
+        text, reply_markup = self.text(update, 'setup_country'), self.keyboard(update, 'setup_country')
         if update.callback_query and update.callback_query.message:
-            await update.callback_query.message.reply_text(country_text, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
         elif update.message:
-            await update.message.reply_text(country_text, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
     async def setup_age(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
-            [InlineKeyboardButton("🌱 18-25 YOUNG", callback_data="age_22"), InlineKeyboardButton("💫 26-35 PRIME", callback_data="age_30")],
-            [InlineKeyboardButton("🌟 36-45 MATURE", callback_data="age_40"), InlineKeyboardButton("👑 46+ ELITE", callback_data="age_50")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        age_text = """
-╔═══════════════════════════════╗
-║   📅 **AGE SELECTION** 📅   ║
-╚═══════════════════════════════╝
-
-💫 **Step 3: Choose Your Era** 💫
-
-🎂 Select your age group for perfect matching
-        """
-        
+        text, reply_markup = self.text(update, 'setup_age'), self.keyboard(update, 'setup_age')
         if update.callback_query and update.callback_query.message:
-            await update.callback_query.message.reply_text(age_text, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
         elif update.message:
-            await update.message.reply_text(age_text, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
     async def check_force_join_compliance(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         force_join_groups = db.get_force_join_groups()
@@ -377,23 +499,13 @@ class TelegramBot:
                     elif not group_link.startswith('http'):
                         group_link = f"https://t.me/{group_link}"
                     
-                    keyboard.append([InlineKeyboardButton(f"🌟 JOIN ELITE GROUP {len(keyboard)+1}", url=group_link)])
+                    keyboard.append([InlineKeyboardButton(self.text(update, 'force_join_button', number=len(keyboard) + 1), url=group_link)])
                 except:
                     # Skip invalid groups
                     continue
             
             reply_markup = InlineKeyboardMarkup(keyboard)
-            message_text = """
-╔══════════════════════════════════╗
-║  🔒 **GROUP ACCESS REQUIRED** 🔒  ║
-╚══════════════════════════════════╝
-
-👑 **ELITE MEMBERSHIP VERIFICATION** 👑
-
-🚫 You must join all premium groups to access the platform
-
-✨ **Click below to join and unlock full access** ✨
-            """
+            message_text = self.text(update, 'force_join')
             
             if update.callback_query and update.callback_query.message:
                 await update.callback_query.message.reply_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -403,25 +515,7 @@ class TelegramBot:
             await self.show_main_menu(update, context)
 
     async def show_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        message_text = """
-╔══════════════════════════════════╗
-║  💎 **PREMIUM DATING PLATFORM** 💎  ║  
-╚══════════════════════════════════╝
-
-🌟 **WELCOME TO YOUR ELITE EXPERIENCE** 🌟
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃          🎯 **MAIN MENU** 🎯          
-┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
-┃ 💬 `/chat` ➤ Find Your Match      
-┃ 🛑 `/end` ➤ End Current Session   
-┃ 👑 `/vip` ➤ Upgrade to Premium    
-┃ 🔗 `/refer` ➤ Invite & Earn       
-┃ 👤 `/profile` ➤ Manage Profile    
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-✨ **Start your premium anonymous dating journey!** ✨
-        """
+        message_text = self.text(update, 'main_menu')
         
         if update.callback_query and update.callback_query.message:
             await update.callback_query.message.reply_text(message_text, parse_mode='Markdown')
@@ -435,32 +529,13 @@ class TelegramBot:
         if not await self.check_user_eligibility(update, context):
             return
         
-        user_data = db.get_user(user_id)
-        
         # Check if already in chat
-        if user_data['chat_partner']:
-            await update.message.reply_text("❌ **ALREADY CONNECTED** ❌\n\n🔗 You are currently in a chat session\n🛑 Use `/end` to terminate current session", parse_mode='Markdown')
+        if self.pairing.partner_of(user_id):
+            await update.message.reply_text(self.text(update, 'already_in_chat'), parse_mode='Markdown')
             return
         
         # Show gender-based matching options
-        keyboard = [
-            [InlineKeyboardButton("💃 👑 MATCH WITH LADIES (VIP)", callback_data="match_girls")],
-            [InlineKeyboardButton("💪 👑 MATCH WITH GENTLEMEN (VIP)", callback_data="match_boys")],
-            [InlineKeyboardButton("🎲 ✨ RANDOM MATCH (FREE)", callback_data="match_random")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        matching_text = """
-╔════════════════════════════════╗
-║  🎯 **ELITE MATCHING SYSTEM** 🎯  ║
-╚════════════════════════════════╝
-
-💫 **Choose Your Premium Experience** 💫
-
-🌟 Select your preferred matching type below
-        """
-        
-        await update.message.reply_text(matching_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(self.text(update, 'matching'), reply_markup=self.keyboard(update, 'matching'), parse_mode='Markdown')
 
     async def find_chat_partner_by_gender(self, update: Update, context: ContextTypes.DEFAULT_TYPE, gender_filter):
         user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
@@ -468,31 +543,26 @@ class TelegramBot:
         user_data = db.get_user(user_id)
         
         # Check if already in chat
-        if user_data and user_data['chat_partner']:
-            message = "❌ **ALREADY CONNECTED** ❌\n\n🔗 You are currently in a premium chat\n🛑 Use `/end` to terminate session"
+        if self.pairing.partner_of(user_id):
+            message = self.text(update, 'already_connected')
             if update.callback_query:
                 await update.callback_query.edit_message_text(message, parse_mode='Markdown')
             else:
                 await update.message.reply_text(message, parse_mode='Markdown')
             return
         
-        # Mark user as looking for chat
-        db.set_user_looking_for_chat(user_id, True)
-        
-        # Find partner with proper gender filter
-        partner_id = db.find_chat_partner_by_gender(user_id, gender_filter)
+        # Best waiting partner: proper gender filter, then same country and age range first (see matching.py)
+        # (in batch mode the next matching round pairs the whole pool instead)
+        vip = vip_active(user_data)
+        partner_id = None if self.batch_matching else self.pairing.find_partner(
+            user_id, user_data['gender'], gender_filter, user_data['country'], user_data['age'], vip)
         
         if not partner_id:
-            # Clear looking status since no partner found
-            db.set_user_looking_for_chat(user_id, False)
+            # Stay in the waiting list; whoever searches next gets matched with us
+            self.pairing.add_waiting(user_id, user_data['gender'], gender_filter, user_data['country'], user_data['age'], vip)
             
-            gender_text = ""
-            if gender_filter == "Female":
-                gender_text = " female"
-            elif gender_filter == "Male":
-                gender_text = " male"
-            
-            message = f"⏳ **SEARCHING...** ⏳\n\n🔍 No{gender_text} chat partner available right now\n💫 Please try again in a moment"
+            gender_text = self.text(update, f'searching.{gender_filter}') if gender_filter else ""
+            message = self.text(update, 'searching', gender_text=gender_text)
             if update.callback_query:
                 await update.callback_query.edit_message_text(message, parse_mode='Markdown')
             else:
@@ -504,63 +574,98 @@ class TelegramBot:
         
         # Verify partner has correct gender (double-check) BEFORE starting session
         if gender_filter and partner_data and partner_data.get('gender') != gender_filter:
-            # Clear looking status and retry without starting session
-            db.set_user_looking_for_chat(user_id, False)
-            db.set_user_looking_for_chat(partner_id, False)  # Reset partner too
-            message = f"❌ **MATCHING ERROR** ❌\n\n🔄 System error occurred\n💫 Please try again"
+            # The partner was already taken off the waiting list; drop the user too
+            self.pairing.remove_waiting(user_id)
+            message = self.text(update, 'matching_error')
             if update.callback_query:
                 await update.callback_query.edit_message_text(message, parse_mode='Markdown')
             else:
                 await update.message.reply_text(message, parse_mode='Markdown')
             return
         
-        # Now start chat session after validation
-        db.start_chat_session(user_id, partner_id)
-        
-        # Notify both users
-        match_type = ""
-        if gender_filter == "Female":
-            match_type = " (You requested girls only)"
-        elif gender_filter == "Male":
-            match_type = " (You requested boys only)"
-        elif gender_filter is None:
-            match_type = " (Random match)"
-            
-        user_message = f"""
-╔══════════════════════════════════╗
-║  🎉 **MATCH FOUND!** 🎉   ║
-╚══════════════════════════════════╝
-
-💫 **CONNECTION ESTABLISHED**{match_type} 💫
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃ 👤 Gender: {partner_data['gender']}
-┃ 📅 Age: {partner_data['age']}
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-✨ **Start your premium conversation now!** ✨
-        """
+        # Now start chat session after validation (persisted in the background)
+        self.pairing.pair(user_id, partner_id)
+        self.announce_pairing('pair', user_id, partner_id)
         
-        partner_message = f"""
-╔══════════════════════════════════╗
-║  🎉 **MATCH FOUND!** 🎉   ║
-╚══════════════════════════════════╝
-
-💫 **CONNECTION ESTABLISHED** 💫
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃ 👤 Gender: {user_data['gender']}
-┃ 📅 Age: {user_data['age']}
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-✨ **Start your premium conversation now!** ✨
-        """
+        # Notify both users (rendered notices are cached: they only vary by gender, age and match type)
+        match_type = self.text(update, f'match_type.{gender_filter or "random"}')
+        user_message = self.text(update, 'match_found', match_type=match_type, gender=partner_data['gender'], age=partner_data['age'])
+        partner_message = self.user_text(partner_id, 'match_found', match_type="", gender=user_data['gender'], age=user_data['age'])
         
         if update.callback_query:
             await update.callback_query.edit_message_text(user_message, parse_mode='Markdown')
         else:
             await update.message.reply_text(user_message, parse_mode='Markdown')
-        await context.bot.send_message(chat_id=partner_id, text=partner_message, parse_mode='Markdown')
+        await self.deliver(context, partner_id, 'send_message', priority=PRIORITY_MATCH, text=partner_message, parse_mode='Markdown')
+
+    async def match_loop(self):
+        """Every MATCH_TICK seconds: pair the whole waiting pool (batch mode), or the
+        waiters whose wait just allowed wider preferences (instant mode)"""
+        while True:
+            await asyncio.sleep(MATCH_TICK)
+            try:
+                pairs = self.pairing.match_waiting() if self.batch_matching else self.pairing.widen_waiting()
+            except Exception as e:
+                logger.error(f"Matching round failed: {e}")
+                continue
+            if pairs:
+                # Notices go out in the background so the next round is not held up by rate limits
+                self.application.create_task(self.notify_matches(pairs))
+
+    async def notify_matches(self, pairs):
+        """Tell both users of every pair made by match_loop, with all the sends in flight at once"""
+        sends = []
+        for user_id, partner_id in pairs:
+            user_data, partner_data = db.get_user(user_id), db.get_user(partner_id)
+            for chat_id, other in ((user_id, partner_data), (partner_id, user_data)):
+                text = self.user_text(chat_id, 'match_found', match_type="", gender=other['gender'], age=other['age'])
+                sends.append(self.deliver(self.application, chat_id, 'send_message', priority=PRIORITY_MATCH, text=text, parse_mode='Markdown'))
+        for result in await asyncio.gather(*sends, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending match notice: {result}")
+
+    async def reap_loop(self):
+        """End idle sessions and expire unanswered searches every REAPER_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(REAPER_INTERVAL)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error(f"Reaper sweep failed: {e}")
+
+    async def reap(self):
+        notices = []
+        ended = 0
+        for user_id, partner_id in self.pairing.idle_pairs(SESSION_IDLE_TIMEOUT):
+            # A cross-shard pair is seen by both shards; the lower user id's shard reaps it
+            if self.shard and not self.shard.owns(user_id):
+                continue
+            async with self.update_processor.pair_lock(user_id, partner_id):
+                # A message may have arrived (or the chat ended) since the sweep looked
+                if self.pairing.partner_of(user_id) != partner_id or not self.pairing.is_idle(user_id, SESSION_IDLE_TIMEOUT):
+                    continue
+                self.pairing.unpair(user_id)
+            self.announce_pairing('unpair', user_id, partner_id)
+            ended += 1
+            notices += [(user_id, 'session_idle'), (partner_id, 'session_idle')]
+        expired = self.pairing.expire_waiting(WAITING_TIMEOUT)
+        # One set-based update for every stale flag, including ones no registry holds
+        cleared = db.clear_stale_waiting(WAITING_TIMEOUT)
+        notices += [(user_id, 'search_expired') for user_id in expired]
+        if ended or expired or cleared:
+            logger.info(f"Reaper: ended {ended} idle sessions, expired {len(expired)} searches, cleared {cleared} stale flags")
+        results = await asyncio.gather(*(
+            self.deliver(self.application, chat_id, 'send_message', priority=PRIORITY_MATCH,
+                         text=self.user_text(chat_id, name), parse_mode='Markdown')
+            for chat_id, name in notices
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error sending reaper notice: {result}")
+
+    async def notify_referrer(self, referrer_id):
+        await self.deliver(self.application, referrer_id, 'send_message', priority=PRIORITY_MATCH,
+                           text=self.user_text(referrer_id, 'referral_reward'))
 
     async def end_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
@@ -568,70 +673,37 @@ class TelegramBot:
         if not await self.check_user_eligibility(update, context):
             return
         
-        partner_id = db.end_chat_session(user_id)
+        partner_id = self.pairing.partner_of(user_id)
+        if partner_id:
+            async with self.update_processor.pair_lock(user_id, partner_id):
+                partner_id = self.pairing.unpair(user_id)
+            if partner_id:
+                self.announce_pairing('unpair', user_id, partner_id)
+        elif self.pairing.remove_waiting(user_id):
+            await update.message.reply_text(self.text(update, 'search_stopped'))
+            return
         
         if partner_id:
-            await update.message.reply_text("🎯 **SESSION ENDED** 🎯\n\n✨ Chat session successfully terminated\n💫 Use `/chat` to find a new premium match!")
-            await context.bot.send_message(chat_id=partner_id, text="💔 **SESSION ENDED** 💔\n\n🌟 Your chat partner has ended the session\n✨ Use `/chat` to find a new premium match!")
+            await update.message.reply_text(self.text(update, 'session_ended'))
+            await self.deliver(context, partner_id, 'send_message', priority=PRIORITY_MATCH, text=self.user_text(partner_id, 'partner_ended'))
         else:
-            await update.message.reply_text("❌ **NO ACTIVE SESSION** ❌\n\n🎯 You are not currently in a chat session\n💫 Use `/chat` to start matching!")
+            await update.message.reply_text(self.text(update, 'no_session'))
 
     async def vip(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await self.check_user_eligibility(update, context):
             return
         
-        keyboard = [
-            [InlineKeyboardButton("🌟 💰 REFER & EARN VIP", callback_data="vip_refer")],
-            [InlineKeyboardButton("💎 🛒 PURCHASE PREMIUM", callback_data="vip_purchase")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        vip_text = """
-╔══════════════════════════════════╗
-║   👑 **EXCLUSIVE VIP LOUNGE** 👑   ║
-╚══════════════════════════════════╝
-
-✨ **UNLOCK PREMIUM FEATURES** ✨
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃ 🎯 **VIP BENEFITS:**
-┃ • 💃 Match with specific genders
-┃ • 🎲 Priority matching algorithm  
-┃ • 🌟 Enhanced profile visibility
-┃ • 💎 Exclusive VIP support
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-💫 **Choose your path to elite status** 💫
-        """
-        
-        await update.message.reply_text(vip_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(self.text(update, 'vip'), reply_markup=self.keyboard(update, 'vip'), parse_mode='Markdown')
 
     async def show_referral_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
         user_data = db.get_user(user_id)
         
         referral_link = f"https://t.me/BoysGirlsChatBot?start={user_id}"
-        message_text = f"""
-╔══════════════════════════════════╗
-║  🌟 **REFERRAL EMPIRE** 🌟   ║
-╚══════════════════════════════════╝
-
-💰 **YOUR EXCLUSIVE INVITE LINK** 💰
-🔗 `{referral_link}`
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃ 📊 **REFERRAL DASHBOARD:**
-┃ 👥 Elite Members Invited: {user_data['referral_count']}
-┃ 💎 VIP Hours Earned: {user_data['referral_count'] * 24}
-┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
-┃ 🎯 **REFERRAL REWARDS:**
-┃ • 24 Hours VIP per invite
-┃ • Unlimited earning potential
-┃ • Instant VIP activation
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-✨ **Share and earn your way to permanent VIP!** ✨
-        """
+        rank = self.referrals.leaderboard.rank(user_id)
+        message_text = self.text(update, 'referral', link=referral_link, count=user_data['referral_count'],
+                                 hours=user_data['referral_count'] * 24,
+                                 rank=f"#{rank} of {len(self.referrals.leaderboard)}" if rank else "Not ranked yet")
         
         if update.callback_query:
             await update.callback_query.edit_message_text(message_text, parse_mode='Markdown')
@@ -639,31 +711,7 @@ class TelegramBot:
             await update.message.reply_text(message_text, parse_mode='Markdown')
 
     async def show_vip_purchase_options(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
-            [InlineKeyboardButton("⚡ 1 DAY TRIAL - 10 ⭐", callback_data="buy_vip_1_10")],
-            [InlineKeyboardButton("🌟 5 DAYS POPULAR - 25 ⭐", callback_data="buy_vip_5_25")],
-            [InlineKeyboardButton("💫 12 DAYS PREMIUM - 50 ⭐", callback_data="buy_vip_12_50")],
-            [InlineKeyboardButton("👑 1 MONTH ELITE - 100 ⭐", callback_data="buy_vip_30_100")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        purchase_text = """
-╔══════════════════════════════════╗
-║  💎 **PREMIUM PACKAGES** 💎   ║
-╚══════════════════════════════════╝
-
-🌟 **CHOOSE YOUR ELITE EXPERIENCE** 🌟
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃ 💫 **ALL PACKAGES INCLUDE:**
-┃ • 💃 Gender-specific matching
-┃ • 🎯 Priority algorithm access
-┃ • 🌟 Enhanced profile features
-┃ • 💎 Exclusive VIP support
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-✨ **Select your premium duration below** ✨
-        """
+        purchase_text, reply_markup = self.text(update, 'vip_purchase'), self.keyboard(update, 'vip_purchase')
         
         if update.callback_query:
             await update.callback_query.edit_message_text(purchase_text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -706,9 +754,10 @@ class TelegramBot:
             db.set_vip_status(user_id, days)
             
             # Send confirmation
-            await context.bot.send_message(
+            await self.outbound.call(
+                PRIORITY_MATCH, user_id, context.bot.send_message,
                 chat_id=user_id,
-                text=f"🎉 Payment successful! You now have VIP access for {days} days."
+                text=self.text(update, 'payment_success', days=days)
             )
         else:
             await query.answer(ok=False, error_message="Invalid payment")
@@ -720,96 +769,137 @@ class TelegramBot:
         if not await self.check_user_eligibility(update, context):
             return
         
-        keyboard = [
-            [InlineKeyboardButton("✏️ Update Profile", callback_data="update_profile")],
-            [InlineKeyboardButton("🔍 Partner Filter (VIP)", callback_data="partner_filter")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text("👤 **Profile Options:**", reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(self.text(update, 'profile_options'), reply_markup=self.keyboard(update, 'profile_options'), parse_mode='Markdown')
 
     async def update_profile_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
-            [InlineKeyboardButton("🚹 Change Gender", callback_data="edit_gender")],
-            [InlineKeyboardButton("🌍 Change Country", callback_data="edit_country")],
-            [InlineKeyboardButton("🎂 Change Age", callback_data="edit_age")],
-            [InlineKeyboardButton("🔙 Back to Profile", callback_data="back_to_profile")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+        text, reply_markup = self.text(update, 'update_menu'), self.keyboard(update, 'update_menu')
         if update.callback_query:
-            await update.callback_query.edit_message_text("✏️ **Choose what to update:**", reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
         elif update.message:
-            await update.message.reply_text("✏️ **Choose what to update:**", reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
     async def partner_filter_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
-            [InlineKeyboardButton("🧑🏻‍🦰 Male Only", callback_data="filter_Male")],
-            [InlineKeyboardButton("👱🏻‍♀ Female Only", callback_data="filter_Female")],
-            [InlineKeyboardButton("🔄 Any Gender", callback_data="filter_any")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+        text, reply_markup = self.text(update, 'filter_menu'), self.keyboard(update, 'filter_menu')
         if update.callback_query:
-            await update.callback_query.edit_message_text("🔍 **Select Partner Filter:**", reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
         elif update.message:
-            await update.message.reply_text("🔍 **Select Partner Filter:**", reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         
+        if update.message and update.message.media_group_id:
+            self.albums.add(update, context)
+            return
+        # Relay any album this user sent just before, so this message can't overtake it
+        await self.albums.flush_user(user_id)
+        
         if not await self.check_user_eligibility(update, context):
             return
         
-        user_data = db.get_user(user_id)
+        partner_id = self.pairing.partner_of(user_id)
+        if not partner_id:
+            await update.message.reply_text(self.text(update, 'not_in_chat'))
+            return
+        
+        failure_notice = {'chat_id': user_id, 'text': self.text(update, 'send_failed')}
         
-        if not user_data['chat_partner']:
-            await update.message.reply_text("❌ You are not in a chat session. Use /chat to find a partner.")
+        # Check text or caption against the moderation rules
+        rule = self.moderation.check_message(update.message)
+        if rule:
+            await update.message.reply_text(rule.message)
             return
         
-        partner_id = user_data['chat_partner']
+        relay_type = detect_relay_type(update.message)
+        if relay_type is None:
+            await update.message.reply_text(self.text(update, 'unsupported_type'))
+            return
         
-        # Check for links
-        if update.message.text and any(url in update.message.text.lower() for url in ['http', 'www.', '.com', '.org', '.net']):
-            await update.message.reply_text("❌ Links are not allowed in chats.")
+        self.pairing.touch(user_id)
+        self.pairing.touch(partner_id)
+        
+        # Forward message to partner; the pair lock keeps relays ordered against /end
+        async with self.update_processor.pair_lock(user_id, partner_id):
+            try:
+                # copy_message relays any content type in one call, without re-uploading media
+                await self.deliver(context, partner_id, 'copy_message', failure_notice,
+                                   from_chat_id=update.effective_chat.id, message_id=update.message.message_id)
+                content = relay_content(update.message, relay_type)
+                db.log_message(user_id, partner_id, relay_type.name, content)
+                if self.archive:
+                    self.archive.append(user_id, partner_id, relay_type.name, content, relay_file_id(update.message))
+                if self.mirror_to_group:
+                    context.application.create_task(self.log_to_group(context, user_id, partner_id, relay_type, update.message))
+            except Exception as e:
+                logger.error(f"Error forwarding message: {e}")
+                await update.message.reply_text(failure_notice['text'])
+
+    async def relay_album(self, updates, context: ContextTypes.DEFAULT_TYPE):
+        """Relay a complete album: one eligibility check, one copy, one log batch, one mirror"""
+        first = updates[0]
+        user_id = first.effective_user.id
+        
+        if not await self.check_user_eligibility(first, context):
             return
         
-        # Forward message to partner
+        partner_id = self.pairing.partner_of(user_id)
+        if not partner_id:
+            await first.message.reply_text(self.text(first, 'not_in_chat'))
+            return
+        
+        failure_notice = {'chat_id': user_id, 'text': self.text(first, 'send_failed')}
+        messages = [u.message for u in updates]
+        
+        # Every item can carry its own caption; one bad caption blocks the album
+        for message in messages:
+            rule = self.moderation.check_message(message)
+            if rule:
+                await first.message.reply_text(rule.message)
+                return
+        
+        self.pairing.touch(user_id)
+        self.pairing.touch(partner_id)
+        
+        async with self.update_processor.pair_lock(user_id, partner_id):
+            try:
+                # copy_messages keeps the album grouping and needs no re-upload
+                await self.deliver(context, partner_id, 'copy_messages', failure_notice,
+                                   from_chat_id=first.effective_chat.id,
+                                   message_ids=[message.message_id for message in messages])
+                entries = []
+                for message in messages:
+                    relay_type = detect_relay_type(message)
+                    entries.append((user_id, partner_id, relay_type.name, relay_content(message, relay_type)))
+                    if self.archive:
+                        self.archive.append(*entries[-1], relay_file_id(message))
+                db.log_messages(entries)
+                if self.mirror_to_group:
+                    context.application.create_task(self.log_album_to_group(context, user_id, partner_id, messages))
+            except Exception as e:
+                logger.error(f"Error forwarding album: {e}")
+                await first.message.reply_text(failure_notice['text'])
+
+    async def log_album_to_group(self, context: ContextTypes.DEFAULT_TYPE, sender_id: int, receiver_id: int, messages):
+        """Mirror an album to the log group as one media group, header on the first item"""
         try:
-            if update.message.text:
-                await context.bot.send_message(chat_id=partner_id, text=update.message.text)
-                db.log_message(user_id, partner_id, "text", update.message.text)
-                await self.log_to_group(context, user_id, partner_id, "text", update.message.text)
-                
-            elif update.message.photo:
-                photo_file_id = update.message.photo[-1].file_id
-                await context.bot.send_photo(chat_id=partner_id, photo=photo_file_id, caption=update.message.caption)
-                db.log_message(user_id, partner_id, "photo", update.message.caption or "Photo")
-                await self.log_to_group(context, user_id, partner_id, "photo", "Photo", file_id=photo_file_id, caption=update.message.caption)
-                
-            elif update.message.video:
-                video_file_id = update.message.video.file_id
-                await context.bot.send_video(chat_id=partner_id, video=video_file_id, caption=update.message.caption)
-                db.log_message(user_id, partner_id, "video", update.message.caption or "Video")
-                await self.log_to_group(context, user_id, partner_id, "video", "Video", file_id=video_file_id, caption=update.message.caption)
-                
-            elif update.message.sticker:
-                sticker_file_id = update.message.sticker.file_id
-                await context.bot.send_sticker(chat_id=partner_id, sticker=sticker_file_id)
-                db.log_message(user_id, partner_id, "sticker", "Sticker")
-                await self.log_to_group(context, user_id, partner_id, "sticker", "Sticker", file_id=sticker_file_id)
-                
-            elif update.message.voice:
-                voice_file_id = update.message.voice.file_id
-                await context.bot.send_voice(chat_id=partner_id, voice=voice_file_id)
-                db.log_message(user_id, partner_id, "voice", "Voice message")
-                await self.log_to_group(context, user_id, partner_id, "voice", "Voice message", file_id=voice_file_id)
-                
+            sender_data = db.get_user(sender_id)
+            receiver_data = db.get_user(receiver_id)
+            captions = [m.caption for m in messages if m.caption]
+            header = f"""📝 Message Log
+👤 Sender: {sender_id} (@{sender_data['username'] or 'N/A'}) - {sender_data['gender']}
+👤 Receiver: {receiver_id} (@{receiver_data['username'] or 'N/A'}) - {receiver_data['gender']}
+⏰ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+📱 Type: Album ({len(messages)} items)
+💬 Caption: {' | '.join(captions) if captions else 'No caption'}"""
+            media = [album_input_media(m, header[:MAX_CAPTION_LENGTH] if i == 0 else None) for i, m in enumerate(messages)]
+            media = [item for item in media if item is not None]
+            if media:
+                await self.outbound.call(PRIORITY_LOG, LOG_GROUP_ID, context.bot.send_media_group, chat_id=LOG_GROUP_ID, media=media)
         except Exception as e:
-            logger.error(f"Error forwarding message: {e}")
-            await update.message.reply_text("❌ Failed to send message. Your partner may have left the chat.")
+            logger.error(f"Error logging album to group: {e}")
 
-    async def log_to_group(self, context: ContextTypes.DEFAULT_TYPE, sender_id: int, receiver_id: int, message_type: str, content: str, file_id=None, caption=None):
+    async def log_to_group(self, context: ContextTypes.DEFAULT_TYPE, sender_id: int, receiver_id: int, relay_type, message):
+        """Mirror a relayed message to the log group with a single API call"""
         try:
             sender_data = db.get_user(sender_id)
             receiver_data = db.get_user(receiver_id)
@@ -817,65 +907,45 @@ class TelegramBot:
             log_header = f"""📝 Message Log
 👤 Sender: {sender_id} (@{sender_data['username'] or 'N/A'}) - {sender_data['gender']}
 👤 Receiver: {receiver_id} (@{receiver_data['username'] or 'N/A'}) - {receiver_data['gender']}
-⏰ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"""
+⏰ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+📱 Type: {relay_type.label}"""
             
-            # Send actual content based on message type
-            if message_type == "text":
-                full_message = f"""{log_header}
-📱 Type: Text Message
-💬 Content: {content}"""
-                await context.bot.send_message(chat_id=LOG_GROUP_ID, text=full_message)
-                
-            elif message_type == "photo" and file_id:
-                await context.bot.send_photo(
-                    chat_id=LOG_GROUP_ID, 
-                    photo=file_id, 
-                    caption=f"""{log_header}
-📱 Type: Photo
-💬 Caption: {caption or 'No caption'}"""
+            if relay_type.log_style == "text":
+                await self.outbound.call(
+                    PRIORITY_LOG, LOG_GROUP_ID, context.bot.send_message,
+                    chat_id=LOG_GROUP_ID, text=f"{log_header}\n💬 Content: {message.text}"
                 )
-                
-            elif message_type == "video" and file_id:
-                await context.bot.send_video(
-                    chat_id=LOG_GROUP_ID, 
-                    video=file_id, 
-                    caption=f"""{log_header}
-📱 Type: Video
-💬 Caption: {caption or 'No caption'}"""
-                )
-                
-            elif message_type == "sticker" and file_id:
-                await context.bot.send_sticker(chat_id=LOG_GROUP_ID, sticker=file_id)
-                await context.bot.send_message(
-                    chat_id=LOG_GROUP_ID, 
-                    text=f"""{log_header}
-📱 Type: Sticker"""
-                )
-                
-            elif message_type == "voice" and file_id:
-                await context.bot.send_voice(chat_id=LOG_GROUP_ID, voice=file_id)
-                await context.bot.send_message(
-                    chat_id=LOG_GROUP_ID, 
-                    text=f"""{log_header}
-📱 Type: Voice Message"""
+            elif relay_type.log_style == "caption":
+                caption = f"{log_header}\n💬 Caption: {message.caption or 'No caption'}"
+                await self.outbound.call(
+                    PRIORITY_LOG, LOG_GROUP_ID, context.bot.copy_message,
+                    chat_id=LOG_GROUP_ID, from_chat_id=message.chat_id, message_id=message.message_id,
+                    caption=caption[:MAX_CAPTION_LENGTH]
                 )
-                
             else:
-                # Fallback for other types
-                full_message = f"""{log_header}
-📱 Type: {message_type}
-💬 Content: {content}"""
-                await context.bot.send_message(chat_id=LOG_GROUP_ID, text=full_message)
+                # No caption support (stickers, video notes, locations...): the header rides on a button
+                summary = f"👤 {sender_id} ({sender_data['gender']}) ➜ {receiver_id} ({receiver_data['gender']}) · {relay_type.label}"
+                await self.outbound.call(
+                    PRIORITY_LOG, LOG_GROUP_ID, context.bot.copy_message,
+                    chat_id=LOG_GROUP_ID, from_chat_id=message.chat_id, message_id=message.message_id,
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(summary, callback_data=encode_callback('log_info'))]])
+                )
                 
         except Exception as e:
             logger.error(f"Error logging to group: {e}")
 
     async def check_user_eligibility(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
+        if not db.available:
+            # Database outage: chats already running keep going (routing is in memory)
+            if self.pairing.partner_of(user_id) is not None:
+                return True
+            await update.message.reply_text(self.text(update, 'degraded'))
+            return False
         user_data = db.get_user(user_id)
         
         if not user_data:
-            await update.message.reply_text("❌ Please start the bot first with /start")
+            await update.message.reply_text(self.text(update, 'start_first'))
             return False
         
         # Normalize boolean values to handle SQLite (0/1) vs PostgreSQL (bool) differences
@@ -884,15 +954,15 @@ class TelegramBot:
         profile_completed = bool(user_data['profile_completed'])
         
         if is_blocked:
-            await update.message.reply_text("❌ You are blocked from using this bot.")
+            await update.message.reply_text(self.text(update, 'blocked'))
             return False
         
         if not agreed_terms:
-            await update.message.reply_text("❌ Please agree to terms first with /start")
+            await update.message.reply_text(self.text(update, 'agree_first'))
             return False
         
         if not profile_completed:
-            await update.message.reply_text("❌ Please complete your profile first.")
+            await update.message.reply_text(self.text(update, 'complete_profile'))
             return False
         
         # Optimized VIP expiry check - only run if needed
@@ -964,7 +1034,8 @@ class TelegramBot:
             
             # Notify user
             try:
-                await context.bot.send_message(
+                await self.outbound.call(
+                    PRIORITY_ADMIN, target_user_id, context.bot.send_message,
                     chat_id=target_user_id,
                     text=f"🎉 You have been granted VIP status for {duration} days by an admin!"
                 )
@@ -981,41 +1052,24 @@ class TelegramBot:
         
         stats = db.get_detailed_stats()
         force_join_groups = db.get_force_join_groups()
-        
-        stats_message = f"""
-╔══════════════════════════════════╗
-║  📊 **ADMIN DASHBOARD** 📊   ║
-╚══════════════════════════════════╝
-
-🎯 **SYSTEM OVERVIEW** 🎯
-
-┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
-┃ 👥 **USER STATISTICS:**
-┃ • Total Users: {stats['total_users']}
-┃ • 👨 Male Users: {stats['male_users']}
-┃ • 👩 Female Users: {stats['female_users']}
-┃ • ✅ Completed Profiles: {stats['completed_profiles']}
-┃ • ❌ Blocked Users: {stats['blocked_users']}
-┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
-┃ 🟢 **LIVE ACTIVITY:**
-┃ • 👨 Live Male Users: {stats['live_male_users']}
-┃ • 👩 Live Female Users: {stats['live_female_users']}
-┃ • 📱 Total Online: {stats['live_male_users'] + stats['live_female_users']}
-┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
-┃ 💬 **CHAT METRICS:**
-┃ • Active Sessions: {stats['active_chats']}
-┃ • Total Messages: {stats['total_messages']}
-┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
-┃ 👑 **PREMIUM DATA:**
-┃ • VIP Users: {stats['vip_users']}
-┃ • Total Referrals: {stats['total_referrals']}
-┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
-┃ 🔒 **SYSTEM CONFIG:**
-┃ • Force Join Groups: {len(force_join_groups)}
-┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
-
-⏰ **Last Updated:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-        """
+        moderation_hits = ', '.join(f"{name} {count}" for name, count in self.moderation.hits.most_common()) or 'None'
+        time_to_match = ', '.join(
+            f"{queue} {p50:.0f}s/{p95:.0f}s ({count})"
+            for queue, (count, p50, p95) in self.pairing.waiting.stats.summary().items()
+        ) or 'None'
+        
+        stats_message = self.templates.render(
+            'admin_stats', **stats,
+            live_users=stats['live_male_users'] + stats['live_female_users'],
+            force_join_groups=len(force_join_groups),
+            moderation_hits=moderation_hits,
+            time_to_match=time_to_match,
+            circuit_state=db.breaker.state,
+            circuit_trips=db.breaker.trips,
+            journal_recorded=db.journal.recorded if db.journal else 0,
+            journal_replayed=db.journal.replayed if db.journal else 0,
+            updated=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        )
         
         await update.message.reply_text(stats_message, parse_mode='Markdown')
 
@@ -1032,36 +1086,47 @@ class TelegramBot:
         if not users:
             await update.message.reply_text("❌ No users found in database.")
             return
-            
+        
+        # Run in the background so the admin's later commands aren't queued behind it
+        context.application.create_task(self.run_broadcast(update, context, users))
+
+    async def run_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE, users):
         sent_count = 0
         failed_count = 0
         total_users = len(users)
         
         progress_msg = await update.message.reply_text(f"📢 Starting broadcast to {total_users} users...")
         
-        for i, user in enumerate(users):
-            try:
-                await context.bot.copy_message(
+        # Broadcast sends run at the lowest priority, so live chats always go first
+        for start in range(0, total_users, 50):
+            batch = users[start:start + 50]
+            results = await asyncio.gather(*[
+                self.outbound.submit(
+                    PRIORITY_BROADCAST, user['user_id'], context.bot.copy_message,
                     chat_id=user['user_id'],
                     from_chat_id=update.message.chat_id,
                     message_id=update.message.reply_to_message.message_id
                 )
-                sent_count += 1
-            except Exception as e:
+                for user in batch
+            ], return_exceptions=True)
+            
+            for user, result in zip(batch, results):
+                if not isinstance(result, Exception):
+                    sent_count += 1
+                    continue
                 failed_count += 1
                 # Remove users who blocked the bot to keep database clean
-                if "Forbidden" in str(e) or "blocked" in str(e).lower():
+                if "Forbidden" in str(result) or "blocked" in str(result).lower():
                     try:
                         db.delete_user(user['user_id'])
                     except:
                         pass
             
             # Update progress every 50 users
-            if (i + 1) % 50 == 0:
-                try:
-                    await progress_msg.edit_text(f"📢 Broadcasting... {i + 1}/{total_users} users processed\n✅ Sent: {sent_count} | ❌ Failed: {failed_count}")
-                except:
-                    pass
+            try:
+                await progress_msg.edit_text(f"📢 Broadcasting... {start + len(batch)}/{total_users} users processed\n✅ Sent: {sent_count} | ❌ Failed: {failed_count}")
+            except:
+                pass
         
         final_message = f"""
 ╔══════════════════════════════════╗
@@ -1093,6 +1158,12 @@ class TelegramBot:
         try:
             user_id = int(context.args[0])
             db.block_user(user_id)
+            # A blocked user leaves the waiting list and any running chat
+            self.pairing.remove_waiting(user_id)
+            partner_id = self.pairing.unpair(user_id)
+            if partner_id:
+                self.announce_pairing('unpair', user_id, partner_id)
+                await self.deliver(context, partner_id, 'send_message', priority=PRIORITY_MATCH, text=self.user_text(partner_id, 'partner_ended'))
             await update.message.reply_text(f"✅ User {user_id} has been blocked.")
         except ValueError:
             await update.message.reply_text("❌ Invalid user ID.")
@@ -1130,6 +1201,202 @@ class TelegramBot:
         
         await update.message.reply_text(admin_list, parse_mode='Markdown')
 
+    async def admin_top_referrers(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        top = self.referrals.leaderboard.top(10)
+        
+        if not top:
+            await update.message.reply_text("❌ No referrals yet.")
+            return
+        
+        leaderboard = "🏆 **Top Referrers:**\n\n"
+        for position, (user_id, count) in enumerate(top, 1):
+            leaderboard += f"{position}. {user_id} — {count} referrals\n"
+        
+        await update.message.reply_text(leaderboard, parse_mode='Markdown')
+
+    async def admin_export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        usage = ("❌ Usage: /export <users|chat_sessions|message_logs|all> [csv|jsonl] "
+                 "[since=YYYY-MM-DD] [until=YYYY-MM-DD] [user=ID]")
+        if not context.args or context.args[0] not in EXPORT_TABLES + ('all',):
+            await update.message.reply_text(usage)
+            return
+        
+        tables = EXPORT_TABLES if context.args[0] == 'all' else (context.args[0],)
+        fmt = 'csv'
+        criteria = {}
+        try:
+            for arg in context.args[1:]:
+                if arg in EXPORT_FORMATS:
+                    fmt = arg
+                    continue
+                name, _, value = arg.partition('=')
+                if name in ('since', 'until'):
+                    criteria[name] = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+                elif name == 'user':
+                    criteria['user_id'] = int(value)
+                else:
+                    raise ValueError(arg)
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        
+        # Run in the background: a large export takes a while and must not hold up other updates
+        context.application.create_task(self.run_export(update, context, tables, fmt, criteria))
+
+    async def run_export(self, update: Update, context: ContextTypes.DEFAULT_TYPE, tables, fmt, criteria):
+        chat_id = update.effective_chat.id
+        await update.message.reply_text(f"📦 Exporting {', '.join(tables)} as {fmt}...")
+        files = 0
+        total_rows = 0
+        for table in tables:
+            parts = export_parts(db, table, fmt, **criteria)
+            try:
+                while True:
+                    # Each part is read and compressed off the event loop
+                    part = await asyncio.to_thread(next, parts, None)
+                    if part is None:
+                        break
+                    path, rows = part
+                    try:
+                        # A path (not an open file) so a rate-limited upload can be retried
+                        await self.outbound.call(
+                            PRIORITY_ADMIN, chat_id, context.bot.send_document,
+                            chat_id=chat_id, document=pathlib.Path(path),
+                            filename=os.path.basename(path), caption=f"{table}: {rows} rows"
+                        )
+                    finally:
+                        os.remove(path)
+                    files += 1
+                    total_rows += rows
+            except Exception as e:
+                logger.error(f"Export of {table} failed: {e}")
+                await update.message.reply_text(f"❌ Export of {table} failed: {e}")
+                return
+            finally:
+                await asyncio.to_thread(parts.close)
+        
+        if not files:
+            await update.message.reply_text("❌ Database unavailable, nothing exported.")
+            return
+        await update.message.reply_text(f"✅ Export finished: {total_rows} rows in {files} files.")
+
+    async def admin_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        usage = "❌ Usage: /search <terms> [user=ID] [since=YYYY-MM-DD]"
+        words = []
+        user_id = since = None
+        try:
+            for arg in context.args or ():
+                name, _, value = arg.partition('=')
+                if name == 'user' and value:
+                    user_id = int(value)
+                elif name == 'since' and value:
+                    since = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+                else:
+                    words.append(arg)
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        if not words:
+            await update.message.reply_text(usage)
+            return
+        
+        # Pages are fetched on demand; the buttons only carry the page number
+        self.searches.pop(update.effective_user.id, None)
+        self.searches[update.effective_user.id] = (time.monotonic(), ' '.join(words), user_id, since)
+        while len(self.searches) > SEARCH_KEEP:
+            self.searches.popitem(last=False)
+        text, keyboard = self.search_page(update.effective_user.id, 0)
+        await update.message.reply_text(text, reply_markup=keyboard)
+
+    async def on_search_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+        admin_id = update.callback_query.from_user.id
+        if page < 0 or not db.is_admin(admin_id):
+            return
+        search = self.searches.get(admin_id)
+        if search is None or time.monotonic() - search[0] > SEARCH_TTL:
+            self.searches.pop(admin_id, None)
+            await update.callback_query.edit_message_text("❌ This search has expired, run /search again.")
+            return
+        self.searches.move_to_end(admin_id)
+        text, keyboard = self.search_page(admin_id, page)
+        await update.callback_query.edit_message_text(text, reply_markup=keyboard)
+
+    def search_page(self, admin_id, page):
+        """Text and navigation buttons for one page of the admin's current search"""
+        _, terms, user_id, since = self.searches[admin_id]
+        # One extra row tells whether there is a next page
+        rows = db.search_messages(terms, user_id, since, limit=SEARCH_PAGE_SIZE + 1, offset=page * SEARCH_PAGE_SIZE)
+        if not rows and not page:
+            return f"🔍 No messages found for: {terms}", None
+        
+        lines = [f"🔍 Results for: {terms} (page {page + 1})", ""]
+        for message_id, sender_id, receiver_id, message_type, snippet, sent_at in rows[:SEARCH_PAGE_SIZE]:
+            lines.append(f"#{message_id} {str(sent_at)[:16]} {sender_id} → {receiver_id} [{message_type}]")
+            lines.append(f"{snippet}\n")
+        buttons = []
+        if page:
+            buttons.append(InlineKeyboardButton("◀️ Previous", callback_data=encode_callback('search_page', page - 1)))
+        if len(rows) > SEARCH_PAGE_SIZE:
+            buttons.append(InlineKeyboardButton("Next ▶️", callback_data=encode_callback('search_page', page + 1)))
+        # Snippets are short, but one page must still fit in a single message
+        return '\n'.join(lines)[:4096], InlineKeyboardMarkup([buttons]) if buttons else None
+
+    async def admin_transcript(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not db.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ You are not authorized to use this command.")
+            return
+        
+        if not self.archive:
+            await update.message.reply_text("❌ The conversation archive is off (set ARCHIVE_MODE to archive or both).")
+            return
+        
+        try:
+            user_id = int(context.args[0])
+            partner_id = int(context.args[1]) if len(context.args) > 1 else None
+        except (IndexError, ValueError):
+            await update.message.reply_text("❌ Usage: /transcript <user_id> [partner_id]")
+            return
+        
+        if partner_id is None:
+            partners = self.archive.conversations(user_id)
+            if not partners:
+                await update.message.reply_text(f"❌ No archived conversations for {user_id}.")
+                return
+            listing = '\n'.join(f"/transcript {user_id} {partner}" for partner in partners)
+            await update.message.reply_text(f"🗂 Archived conversations of {user_id}:\n\n{listing}"[:4096])
+            return
+        
+        messages = self.archive.transcript(user_id, partner_id)
+        if not messages:
+            await update.message.reply_text(f"❌ No archived messages between {user_id} and {partner_id}.")
+            return
+        
+        lines = []
+        for message in messages:
+            sent_at = datetime.fromtimestamp(message.sent_at).strftime('%Y-%m-%d %H:%M:%S')
+            line = f"[{sent_at}] {message.sender_id} → {message.receiver_id} ({message.message_type}): {message.content}"
+            if message.file_id:
+                line += f" [file_id {message.file_id}]"
+            lines.append(line)
+        await self.outbound.call(
+            PRIORITY_ADMIN, update.effective_chat.id, context.bot.send_document,
+            chat_id=update.effective_chat.id, document='\n'.join(lines).encode(),
+            filename=f"transcript-{min(user_id, partner_id)}-{max(user_id, partner_id)}.txt",
+            caption=f"🗂 {len(messages)} messages between {user_id} and {partner_id}"
+        )
+
     async def admin_promote(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not db.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ You are not authorized to use this command.")
@@ -0,0 +1,207 @@
+"""
+Inline button callbacks: a compact typed codec and an O(1) router
+
+Every button action has a one-character code and typed arguments:
+
+    int               written in base 36
+    tuple of choices  written as the index of the choice (so "Female" costs one character)
+    str               written as is (must not contain the separator)
+
+Encoded data is VERSION + code + ":arg" per argument, e.g. set_age(30) is
+"1e:u". Decoding validates the version, the code, the argument count and
+every argument, so a forged or stale payload is rejected instead of
+reaching a handler half-parsed. Everything fits well inside Telegram's
+64-byte callback_data limit (checked when encoding).
+
+Buttons sent before this encoding existed carry the old underscore
+strings ("update_gender_Male"); they are still understood through the
+LEGACY table, with prefixes matched longest first so "update_gender_" is
+never read as "gender_".
+"""
+
+from collections import namedtuple
+
+VERSION = '1'
+SEPARATOR = ':'
+MAX_CALLBACK_DATA = 64
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+GENDERS = ('Male', 'Female')
+FILTERS = ('Male', 'Female', 'any')
+
+Action = namedtuple('Action', ['name', 'code', 'arg_types'])
+
+# Codes are part of the wire format: never reuse or renumber one
+ACTIONS = (
+    Action('terms_agree', 'a', ()),
+    Action('terms_disagree', 'b', ()),
+    Action('set_gender', 'c', (GENDERS,)),
+    Action('set_country', 'd', (str,)),
+    Action('set_age', 'e', (int,)),
+    Action('vip_refer', 'f', ()),
+    Action('vip_purchase', 'g', ()),
+    Action('buy_vip', 'h', (int,)),
+    Action('update_profile', 'i', ()),
+    Action('partner_filter', 'j', ()),
+    Action('set_filter', 'k', (FILTERS,)),
+    Action('edit_gender', 'l', ()),
+    Action('edit_country', 'm', ()),
+    Action('edit_age', 'n', ()),
+    Action('update_gender', 'o', (GENDERS,)),
+    Action('update_country', 'p', (str,)),
+    Action('update_age', 'q', (int,)),
+    Action('back_to_profile', 'r', ()),
+    Action('match_girls', 's', ()),
+    Action('match_boys', 't', ()),
+    Action('match_random', 'u', ()),
+    Action('log_info', 'v', ()),
+    Action('search_page', 'w', (int,)),
+)
+BY_NAME = {action.name: action for action in ACTIONS}
+BY_CODE = {action.code: action for action in ACTIONS}
+
+# Pre-codec callback data: exact strings, then "prefix" + underscore separated args
+LEGACY_EXACT = {name: name for name in (
+    'terms_agree', 'terms_disagree', 'vip_refer', 'vip_purchase', 'update_profile', 'partner_filter',
+    'edit_gender', 'edit_country', 'edit_age', 'back_to_profile', 'match_girls', 'match_boys',
+    'match_random', 'log_info',
+)}
+LEGACY_PREFIXES = sorted((
+    ('gender_', 'set_gender'),
+    ('country_', 'set_country'),
+    ('age_', 'set_age'),
+    ('buy_vip_', 'buy_vip'),
+    ('filter_', 'set_filter'),
+    ('update_gender_', 'update_gender'),
+    ('update_country_', 'update_country'),
+    ('update_age_', 'update_age'),
+), key=lambda item: -len(item[0]))
+
+
+class CallbackDataError(ValueError):
+    pass
+
+
+def encode(name, *args):
+    action = BY_NAME[name]
+    if len(args) != len(action.arg_types):
+        raise CallbackDataError(f"{name} takes {len(action.arg_types)} arguments, got {len(args)}")
+    data = VERSION + action.code + ''.join(SEPARATOR + _encode_arg(t, a) for t, a in zip(action.arg_types, args))
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise CallbackDataError(f"callback data for {name} is longer than {MAX_CALLBACK_DATA} bytes")
+    return data
+
+
+def decode(data):
+    """Return (action name, args) for callback data in the current or the legacy format"""
+    if not data:
+        raise CallbackDataError("empty callback data")
+    if data[0] != VERSION:
+        return _decode_legacy(data)
+    parts = data[2:].split(SEPARATOR) if len(data) > 2 else []
+    if len(data) < 2 or (parts and parts[0] != ''):
+        raise CallbackDataError(f"malformed callback data {data!r}")
+    action = BY_CODE.get(data[1])
+    if action is None:
+        raise CallbackDataError(f"unknown action code in {data!r}")
+    args = parts[1:]
+    if len(args) != len(action.arg_types):
+        raise CallbackDataError(f"{action.name} expects {len(action.arg_types)} arguments in {data!r}")
+    return action.name, tuple(_decode_arg(t, a) for t, a in zip(action.arg_types, args))
+
+
+def _decode_legacy(data):
+    name = LEGACY_EXACT.get(data)
+    if name is not None:
+        return name, ()
+    for prefix, name in LEGACY_PREFIXES:
+        if data.startswith(prefix):
+            action = BY_NAME[name]
+            if name == 'buy_vip':
+                # buy_vip_<days>_<stars>: the price now comes from the server side
+                raw = data[len(prefix):].split('_')[:len(action.arg_types)]
+            else:
+                # The last argument keeps its underscores ("country_United_States")
+                raw = data[len(prefix):].split('_', len(action.arg_types) - 1)
+            if len(raw) != len(action.arg_types):
+                break
+            try:
+                return name, tuple(_parse_legacy_arg(t, a) for t, a in zip(action.arg_types, raw))
+            except ValueError:
+                break
+    raise CallbackDataError(f"unrecognised callback data {data!r}")
+
+
+def _encode_arg(arg_type, value):
+    if arg_type is int:
+        return _to_base36(int(value))
+    if isinstance(arg_type, tuple):
+        return _to_base36(arg_type.index(value))
+    value = str(value)
+    if SEPARATOR in value or not value:
+        raise CallbackDataError(f"cannot encode {value!r}")
+    return value
+
+
+def _decode_arg(arg_type, raw):
+    if arg_type is int or isinstance(arg_type, tuple):
+        # int() would also take a sign, whitespace, underscores and upper case
+        if not raw or raw.strip(BASE36_DIGITS):
+            raise CallbackDataError(f"invalid argument {raw!r}")
+    try:
+        if arg_type is int:
+            return int(raw, 36)
+        if isinstance(arg_type, tuple):
+            return arg_type[int(raw, 36)]
+    except (ValueError, IndexError):
+        raise CallbackDataError(f"invalid argument {raw!r}") from None
+    if not raw:
+        raise CallbackDataError("empty argument")
+    return raw
+
+
+def _parse_legacy_arg(arg_type, raw):
+    if arg_type is int:
+        # int() would also accept "30_1"
+        if not raw.isdigit():
+            raise ValueError(raw)
+        return int(raw)
+    if isinstance(arg_type, tuple) and raw not in arg_type:
+        raise ValueError(raw)
+    return raw
+
+
+def _to_base36(number):
+    if number < 0:
+        raise CallbackDataError("negative numbers are not encodable")
+    encoded = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = BASE36_DIGITS[remainder] + encoded
+        if not number:
+            return encoded
+
+
+class CallbackRouter:
+    """Dispatches callback queries to handler(update, context, *args) by action"""
+
+    def __init__(self):
+        self.handlers = {}
+        self.rejected = 0
+
+    def register(self, name, handler):
+        if name not in BY_NAME:
+            raise KeyError(f"unknown callback action {name}")
+        self.handlers[name] = handler
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        try:
+            name, args = decode(query.data)
+            handler = self.handlers[name]
+        except (CallbackDataError, KeyError):
+            self.rejected += 1
+            await query.answer()
+            return
+        await query.answer()
+        await handler(update, context, *args)
@@ -0,0 +1,96 @@
+"""
+Circuit breaker for the database connection
+
+closed     requests use the database normally
+open       the connection was lost: requests fail fast (no connect attempts,
+           no timeouts on the request path) while a background thread retries
+half-open  the background thread is trying a reconnect right now; requests
+           still fail fast until it succeeds
+
+Reconnect attempts back off exponentially (with jitter) between
+BREAKER_BASE_DELAY and BREAKER_MAX_DELAY seconds; the first one is immediate.
+The Database layer is synchronous and also used outside the event loop
+(workers, scripts), so the retry loop runs in a daemon thread.
+
+Configuration:
+    BREAKER_BASE_DELAY  seconds before the second reconnect attempt (default 0.5)
+    BREAKER_MAX_DELAY   longest wait between attempts (default 30)
+"""
+
+import os
+import time
+import random
+import threading
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+BREAKER_BASE_DELAY = float(os.getenv('BREAKER_BASE_DELAY', '0.5'))
+BREAKER_MAX_DELAY = float(os.getenv('BREAKER_MAX_DELAY', '30'))
+
+
+class CircuitBreaker:
+    def __init__(self, reconnect, base_delay=BREAKER_BASE_DELAY, max_delay=BREAKER_MAX_DELAY):
+        self.reconnect = reconnect      # raises while the database is still unreachable
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = CLOSED
+        self.trips = 0
+        self.attempts = 0               # failed reconnect attempts since the last trip
+        self.opened_at = None
+        self.on_close = []              # callables run (in the retry thread) after the circuit closes
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def allow(self):
+        return self.state == CLOSED
+
+    def trip(self, reason=None):
+        """Open the circuit (if closed) and start reconnecting in the background"""
+        with self._lock:
+            if self.state != CLOSED or self._stopping.is_set():
+                return
+            self.state = OPEN
+            self.trips += 1
+            self.attempts = 0
+            self.opened_at = time.monotonic()
+            print(f"Database circuit opened{f': {reason}' if reason else ''}")
+            self._thread = threading.Thread(target=self._reconnect_loop, name='db-reconnect', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop retrying (shutdown); the state is left as it is"""
+        self._stopping.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+
+    def delay(self):
+        """Seconds to wait before the next reconnect attempt"""
+        if self.attempts == 0:
+            return 0
+        delay = min(self.max_delay, self.base_delay * 2 ** (self.attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    @property
+    def open_for(self):
+        """Seconds since the circuit opened, 0 while closed"""
+        return time.monotonic() - self.opened_at if self.state != CLOSED else 0
+
+    def _reconnect_loop(self):
+        while not self._stopping.wait(self.delay()):
+            self.state = HALF_OPEN
+            try:
+                self.reconnect()
+            except Exception as e:
+                self.attempts += 1
+                self.state = OPEN
+                print(f"Database reconnect attempt {self.attempts} failed: {e}")
+                continue
+            print(f"Database circuit closed after {self.open_for:.1f}s and {self.attempts + 1} attempt(s)")
+            self.state = CLOSED
+            for callback in self.on_close:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Circuit close callback failed: {e}")
+            return
@@ -1,118 +1,498 @@
-import psycopg2
-import psycopg2.extras
 import sqlite3
 import os
+import time
+import hashlib
+import threading
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import json
 
+from queries import CATALOGS, SQLITE, POSTGRES, DEFERRABLE
+from sqlite_backend import SQLITE_MODE, SQLiteWriter, SQLiteReaderPool, open_connection
+from circuit_breaker import CircuitBreaker
+from write_journal import WRITE_JOURNAL_PATH, WriteJournal
+
+# Backend selection: "auto" tries PostgreSQL first and falls back to SQLite,
+# "sqlite" skips PostgreSQL entirely (benchmarks, local development),
+# "postgres" connects to DATABASE_URL only: no PG* candidate, no SQLite fallback
+DB_BACKEND = os.getenv('DB_BACKEND', 'auto').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'bot_database.db')
+
+# Startup: every PostgreSQL connect attempt gives up after DB_CONNECT_TIMEOUT
+# seconds, and the backend that won is remembered in DB_STATE_FILE so the next
+# start connects to it directly. A remembered "no PostgreSQL" is trusted for
+# DB_STATE_TTL seconds before the candidates are probed again.
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '3'))
+DB_STATE_FILE = os.getenv('DB_STATE_FILE', '.db_backend_state.json')
+DB_STATE_TTL = int(os.getenv('DB_STATE_TTL', '600'))
+
+# Bump whenever create_tables changes; an up-to-date schema skips the DDL
+SCHEMA_VERSION = 5
+
+# Writes kept in the journal while the database is down (see write_journal.py);
+# all of them are safe to replay twice
+JOURNALED = frozenset((
+    'add_user', 'update_user_terms', 'update_user_profile', 'block_user', 'unblock_user',
+    'set_vip_until', 'set_user_looking_for_chat', 'update_partner_filter',
+    'start_chat_session', 'start_chat_sessions', 'end_chat_session',
+))
+
+# Journaled writes that are one catalog statement: method -> (statement, params
+# from the journaled args), so a replay can run a whole run of them at once
+JOURNAL_STATEMENTS = {
+    'add_user': ('add_user', lambda db, *args: args),
+    'block_user': ('block_user', lambda db, user_id: (user_id,)),
+    'unblock_user': ('unblock_user', lambda db, user_id: (user_id,)),
+    'set_vip_until': ('set_vip', lambda db, user_id, vip_until: (
+        vip_until if db.is_sqlite else datetime.fromisoformat(vip_until), user_id)),
+    'set_user_looking_for_chat': ('set_looking_for_chat', lambda db, user_id, looking: (looking, user_id)),
+    'update_partner_filter': ('update_partner_filter', lambda db, user_id, gender_filter: (gender_filter, user_id)),
+}
+
+# Tables the admin export may stream: (key column for ordering, date column,
+# columns matched by a user filter)
+EXPORT_TABLES = {
+    'users': ('user_id', 'created_at', ('user_id',)),
+    'chat_sessions': ('id', 'started_at', ('user1_id', 'user2_id')),
+    'message_logs': ('id', 'sent_at', ('sender_id', 'receiver_id')),
+}
+EXPORT_BATCH = int(os.getenv('EXPORT_BATCH', '1000'))
+
+# Connections inherited from a parent process after fork. They are kept
+# referenced (never closed) so the child does not tear down the parent's session.
+_inherited_connections = []
+
+# Loaded by _load_psycopg2() on the first PostgreSQL connection, so nodes
+# running on SQLite never pay for importing the driver
+psycopg2 = None
+_chosen_candidate = None
+
+def _load_psycopg2():
+    global psycopg2
+    if psycopg2 is None:
+        driver = importlib.import_module('psycopg2')
+        importlib.import_module('psycopg2.extras')
+        importlib.import_module('psycopg2.errors')
+        psycopg2 = driver
+    return psycopg2
+
+def postgres_candidates():
+    """PostgreSQL connection settings to try, in order of preference: (label, kwargs)"""
+    candidates = []
+    database_url = os.getenv('DATABASE_URL')
+    if os.getenv('DB_BACKEND', DB_BACKEND).lower() == 'postgres':
+        # Exactly the server that was asked for
+        return [('DATABASE_URL', {'dsn': database_url})] if database_url else []
+    # Skip the old Neon database completely
+    if database_url and 'neon' not in database_url:
+        candidates.append(('DATABASE_URL', {'dsn': database_url}))
+    candidates.append(('PG parameters', {
+        'host': os.getenv('PGHOST', 'db.local'),
+        'database': os.getenv('PGDATABASE', 'replit'),
+        'user': os.getenv('PGUSER', 'replit'),
+        'password': os.getenv('PGPASSWORD', ''),
+        'port': os.getenv('PGPORT', '5432'),
+    }))
+    return candidates
+
+def _connect_candidate(kwargs):
+    return _load_psycopg2().connect(connect_timeout=DB_CONNECT_TIMEOUT, **kwargs)
+
+def connect_postgres():
+    """Open a PostgreSQL connection with the candidate chosen at startup (or the preferred one)"""
+    candidates = dict(postgres_candidates())
+    kwargs = candidates.get(_chosen_candidate) or next(iter(candidates.values()))
+    return _connect_candidate(kwargs)
+
+def _config_fingerprint():
+    """Hash of the settings that decide the backend; a changed config invalidates the cache"""
+    keys = ('DB_BACKEND', 'DATABASE_URL', 'PGHOST', 'PGDATABASE', 'PGUSER', 'PGPASSWORD', 'PGPORT')
+    config = '\0'.join(os.getenv(key, '') for key in keys)
+    return hashlib.sha256(config.encode()).hexdigest()
+
+def _load_backend_state():
+    try:
+        with open(DB_STATE_FILE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('fingerprint') != _config_fingerprint():
+        return None
+    return state
+
+def _save_backend_state(backend):
+    state = {'fingerprint': _config_fingerprint(), 'backend': backend, 'checked_at': time.time()}
+    try:
+        with open(DB_STATE_FILE, 'w') as f:
+            json.dump(state, f)
+    except OSError as e:
+        print(f"Could not save backend state: {e}")
+
+def probe_postgres():
+    """Connect to the best reachable PostgreSQL candidate, or return (None, None)
+
+    The cached backend is tried alone first. Otherwise all candidates are
+    probed at once, so startup takes at most one connect timeout, and the
+    most preferred one that answered wins.
+    """
+    global _chosen_candidate
+    candidates = postgres_candidates()
+    if not candidates:
+        return None, None
+    state = _load_backend_state()
+    if state:
+        if state['backend'] == 'sqlite' and time.time() - state['checked_at'] < DB_STATE_TTL:
+            return None, None
+        for label, kwargs in candidates:
+            if label == state['backend']:
+                try:
+                    _chosen_candidate = label
+                    return _connect_candidate(kwargs), label
+                except Exception as e:
+                    print(f"Cached backend {label} failed: {e}")
+
+    _load_psycopg2()
+    chosen = (None, None)
+    with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+        futures = [(label, pool.submit(_connect_candidate, kwargs)) for label, kwargs in candidates]
+        for label, future in futures:
+            try:
+                connection = future.result()
+            except Exception as e:
+                print(f"PostgreSQL via {label} unavailable: {e}")
+                continue
+            if chosen[0] is None:
+                chosen = (connection, label)
+            else:
+                connection.close()
+    _chosen_candidate = chosen[1]
+    _save_backend_state(chosen[1] or 'sqlite')
+    return chosen
+
+def _fetch(cursor, fetch):
+    if fetch is None:
+        return cursor.rowcount
+    if fetch == 'one':
+        return cursor.fetchone()
+    if fetch == 'all':
+        return cursor.fetchall()
+    if fetch == 'value':
+        row = cursor.fetchone()
+        return row[0] if row else None
+    if fetch == 'dict':
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    return [dict(row) for row in cursor.fetchall()]
+
 class Database:
     def __init__(self):
         self.is_sqlite = False
-        # Try DATABASE_URL first (if available and working), then individual params
-        database_url = os.getenv('DATABASE_URL')
-        
-        # Skip the old Neon database completely and use new connection
-        if database_url and 'neon' not in database_url:
-            try:
-                self.connection = psycopg2.connect(database_url)
-                self.connection.autocommit = True
-                print("Connected using DATABASE_URL")
-                self.create_tables()
-                return
-            except Exception as e:
-                print(f"Failed to connect with DATABASE_URL: {e}")
-        
-        # Try connecting to Replit PostgreSQL with default parameters
+        self._pid = os.getpid()
+        self._prepared_on = None
+        # Tuned SQLite mode only (see sqlite_backend.py)
+        self._writer = None
+        self._readers = None
+        # Fails requests fast while the connection is down (see circuit_breaker.py)
+        self.breaker = CircuitBreaker(self._reconnect)
+        self.journal = None
+        journal_path = os.getenv('WRITE_JOURNAL_PATH', WRITE_JOURNAL_PATH)
+        if journal_path:
+            self.journal = WriteJournal(journal_path)
+            self.breaker.on_close.append(self.replay_journal)
+        self._open()
+        if self.connection is None:
+            self.breaker.trip("no database reachable at startup")
+        elif self.journal is not None and self.journal.pending:
+            # Writes journaled before the last shutdown
+            threading.Thread(target=self.replay_journal, name='journal-replay', daemon=True).start()
+
+    def _open(self):
+        """Pick a backend and connect (startup, or reconnecting when nothing was ever connected)"""
+        backend = os.getenv('DB_BACKEND', DB_BACKEND).lower()
+
+        if backend == 'sqlite':
+            self._connect_sqlite()
+            return
+
         try:
-            # Use Replit PostgreSQL defaults
-            self.connection = psycopg2.connect(
-                host=os.getenv('PGHOST', 'db.local'),
-                database=os.getenv('PGDATABASE', 'replit'),
-                user=os.getenv('PGUSER', 'replit'),
-                password=os.getenv('PGPASSWORD', ''),
-                port=os.getenv('PGPORT', '5432')
-            )
+            self.connection, label = probe_postgres()
+        except Exception as e:
+            # Driver missing or unusable
+            print(f"PostgreSQL unavailable: {e}")
+            self.connection = None
+        if self.connection is not None:
             self.connection.autocommit = True
-            print("Connected to Replit PostgreSQL")
+            print(f"Connected to PostgreSQL using {label}")
             self.create_tables()
-        except Exception as e:
-            print(f"PostgreSQL connection failed: {e}")
-            print("Falling back to SQLite database")
-            try:
-                # Fallback to SQLite
-                self.connection = sqlite3.connect('bot_database.db', check_same_thread=False)
+            return
+
+        if backend == 'postgres':
+            print("PostgreSQL at DATABASE_URL unavailable (DB_BACKEND=postgres, no fallback)")
+            return
+        print("Falling back to SQLite database")
+        self._connect_sqlite()
+
+    def _connect_sqlite(self):
+        try:
+            path = os.getenv('SQLITE_PATH', SQLITE_PATH)
+            mode = os.getenv('SQLITE_MODE', SQLITE_MODE).lower()
+            if mode == 'tuned':
+                # WAL + one batching writer thread + read-only connection pool
+                self._writer = SQLiteWriter(path)
+                self._readers = SQLiteReaderPool(path)
+                self.connection = self._writer.connection
+            else:
+                self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
                 self.connection.row_factory = sqlite3.Row
-                self.is_sqlite = True
-                print("Connected to SQLite database")
-                self.create_tables()
-            except Exception as e2:
-                print(f"SQLite connection also failed: {e2}")
-                print("Running bot without database - functionality will be limited")
-                self.connection = None
-                self.is_sqlite = False
+            self.is_sqlite = True
+            print(f"Connected to SQLite database ({mode} mode)")
+            self.create_tables()
+            if self._writer:
+                self._writer.start()
+        except Exception as e2:
+            print(f"SQLite connection also failed: {e2}")
+            print("Running bot without database - functionality will be limited")
+            self.connection = None
+            self.is_sqlite = False
 
     def _connect(self):
         """Reconnect to the database using current environment variables"""
         try:
             if self.connection:
                 self.connection.close()
-            # Try DATABASE_URL first, then individual parameters
-            database_url = os.getenv('DATABASE_URL')
-            if database_url and 'neon' not in database_url:
-                self.connection = psycopg2.connect(database_url)
-            else:
-                self.connection = psycopg2.connect(
-                    host=os.getenv('PGHOST', 'db.local'),
-                    database=os.getenv('PGDATABASE', 'replit'),
-                    user=os.getenv('PGUSER', 'replit'),
-                    password=os.getenv('PGPASSWORD', ''),
-                    port=os.getenv('PGPORT', '5432')
-                )
+            # Same candidate (DATABASE_URL or PG parameters) as at startup
+            self.connection = connect_postgres()
             self.connection.autocommit = True
         except Exception as e:
             print(f"Database connection error: {e}")
             raise
 
     def _ensure_connection(self):
+        """True when the database can be used now; never blocks on reconnecting"""
+        if self._pid != os.getpid():
+            # Forked worker process: never share the parent's connection, open its own
+            _inherited_connections.append(self.connection)
+            self.__init__()
+        if not self.breaker.allow():
+            return False
+        try:
+            if self.connection is None:
+                raise ConnectionError("no connection")
+            if not self.is_sqlite:
+                # Skip a ping for PostgreSQL to improve speed; a dropped session shows as closed
+                if self.connection.closed:
+                    raise ConnectionError("connection closed")
+            elif self._writer is not None:
+                # The writer thread owns the connection; don't touch it from here
+                if not self._writer.is_usable():
+                    raise ConnectionError("SQLite writer stopped")
+            else:
+                self._ping()
+            return True
+        except Exception as e:
+            self.breaker.trip(e)
+            return False
+
+    def _ping(self):
+        if self._writer is not None:
+            if not self._writer.is_usable():
+                raise ConnectionError("SQLite writer stopped")
+            with self._readers.connection() as connection:
+                connection.execute('SELECT 1')
+            return
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+
+    def _reconnect(self):
+        """Circuit breaker probe, run in its thread: reconnect, then prove the connection works"""
         if self.connection is None:
+            self._open()
+        elif self.is_sqlite:
             try:
-                self.__init__()  # Reinitialize connection
-                return self.connection is not None
-            except:
+                self._ping()
+                return
+            except Exception:
+                if self._readers is not None:
+                    self._readers.close()
+                self._connect_sqlite()
+        else:
+            self._connect()
+        if self.connection is None:
+            raise ConnectionError("no database reachable")
+        self._ping()
+
+    def _check_failure(self, error):
+        """Open the circuit when a failed statement means the connection itself is gone"""
+        if not self.is_sqlite and self.connection is not None and self.connection.closed:
+            self.breaker.trip(error)
+
+    def _deferred(self, method, *args):
+        """True when a JOURNALED write must not run now: it was journaled (or, without a journal, dropped)"""
+        if self.journal is None:
+            return not self._ensure_connection()
+        return self.journal.defer(method, args, self._ensure_connection)
+
+    def replay_journal(self):
+        """Apply the writes journaled during an outage, in order"""
+        def apply(method, args_list):
+            if not self._ensure_connection():
                 return False
-        try:
-            if hasattr(self.connection, 'closed') and self.connection.closed:
-                # Connection is closed, try to reconnect
-                try:
-                    self._connect()
+            if method not in JOURNALED:
+                print(f"Skipping {len(args_list)} journaled {method}: not a journaled write")
+                return True
+            try:
+                if self._replay_many(method, args_list):
                     return True
-                except:
+            except Exception as e:
+                if not self.available:
+                    return False
+                print(f"Batch replay of {len(args_list)} journaled {method} failed, applying one by one: {e}")
+            for args in args_list:
+                try:
+                    getattr(self, method)(*args)
+                except Exception as e:
+                    if not self.available:
+                        return False
+                    print(f"Dropping journaled {method}{tuple(args)}: {e}")
+                if not self.available:
                     return False
-            # Quick connection test without full query
-            if not self.is_sqlite:
-                return True  # Skip ping test for PostgreSQL to improve speed
-            # Test connection only for SQLite
-            cursor = self.connection.cursor()
-            cursor.execute('SELECT 1')
-            cursor.close()
             return True
-        except:
-            # Connection failed, try to reconnect
-            try:
-                self._connect()
-                return True
-            except:
-                return False
-    
+
+        if self.journal is None:
+            return 0
+        return self.journal.replay(apply)
+
+    def _replay_many(self, method, args_list):
+        """Apply a run of one journaled write in a single round trip; False if it has no bulk form"""
+        if method in ('start_chat_session', 'start_chat_sessions'):
+            if method == 'start_chat_session':
+                pairs = [tuple(args) for args in args_list]
+            else:
+                pairs = [tuple(pair) for args in args_list for pair in args[0]]
+            # A start journaled twice would otherwise get two sessions in one PostgreSQL statement
+            self.start_chat_sessions(list(dict.fromkeys(pairs)))
+            return True
+        if len(args_list) == 1 or method not in JOURNAL_STATEMENTS:
+            return False
+        name, params = JOURNAL_STATEMENTS[method]
+        self._execute_many(name, [params(self, *args) for args in args_list])
+        return True
+
+    def _execute_many(self, name, params_list):
+        """Run a catalog statement once per params, in one round trip (one transaction on SQLite)"""
+        sql = self.queries.sql[name]
+        if self.is_sqlite:
+            self._transaction(lambda connection: connection.executemany(sql, params_list))
+            return
+        cursor = self.connection.cursor()
+        try:
+            psycopg2.extras.execute_batch(cursor, sql, params_list, page_size=len(params_list))
+        except Exception as e:
+            self._check_failure(e)
+            raise
+        finally:
+            cursor.close()
+
+    @property
+    def available(self):
+        """False while the circuit is open; handlers use it to degrade right away"""
+        return self.breaker.allow()
+
     def _placeholder(self):
         """Return the correct parameter placeholder for the database type"""
         return '?' if self.is_sqlite else '%s'
 
+    @property
+    def queries(self):
+        """Statement catalog compiled for the connected dialect (see queries.py)"""
+        return CATALOGS[SQLITE if self.is_sqlite else POSTGRES]
+
+    def _execute(self, name, params=(), fetch=None):
+        """Run a catalog statement by name.
+
+        fetch: None returns the rowcount; 'one'/'all' return raw rows,
+        'value' the first column of the first row, 'dict'/'dicts' dict rows.
+        """
+        if self.is_sqlite:
+            return self._execute_sqlite(self.queries.sql[name], params, fetch, deferred=name in DEFERRABLE)
+        cursor = self._postgres_cursor(fetch)
+        try:
+            self._execute_postgres(cursor, name, params)
+            return _fetch(cursor, fetch)
+        except Exception as e:
+            self._check_failure(e)
+            raise
+        finally:
+            cursor.close()
+
+    def _execute_sql(self, sql, params=(), fetch=None):
+        """Run a statement that is built at call time (not in the catalog)"""
+        if self.is_sqlite:
+            return self._execute_sqlite(sql, params, fetch)
+        cursor = self._postgres_cursor(fetch)
+        try:
+            cursor.execute(sql, params)
+            return _fetch(cursor, fetch)
+        except Exception as e:
+            self._check_failure(e)
+            raise
+        finally:
+            cursor.close()
+
+    def _execute_sqlite(self, sql, params, fetch, deferred=False):
+        if self._writer is None:
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(sql, params)
+                return _fetch(cursor, fetch)
+            finally:
+                cursor.close()
+        if fetch is not None:
+            with self._readers.connection() as connection:
+                return _fetch(connection.execute(sql, params), fetch)
+        if deferred:
+            # Nothing reads these back right away; let them share a later commit
+            self._writer.post(lambda connection: connection.execute(sql, params))
+            return None
+        return self._writer.run(lambda connection: connection.execute(sql, params).rowcount)
+
+    def _postgres_cursor(self, fetch):
+        if fetch in ('dict', 'dicts'):
+            return self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        return self.connection.cursor()
+
+    def _execute_postgres(self, cursor, name, params):
+        queries = self.queries
+        if not queries.is_prepared(name):
+            cursor.execute(queries.sql[name], params)
+            return
+        # Prepared statements live on the server connection: prepare again after any reconnect
+        if self._prepared_on is not self.connection:
+            self._prepare_statements(cursor)
+        try:
+            cursor.execute(queries.execute_sql[name], params)
+        except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.FeatureNotSupported):
+            # Statement dropped, or its plan went stale after a schema change
+            self._prepared_on = None
+            cursor.execute(queries.sql[name], params)
+
+    def _prepare_statements(self, cursor):
+        cursor.execute('DEALLOCATE ALL')
+        for statement in self.queries.prepare_sql.values():
+            cursor.execute(statement)
+        self._prepared_on = self.connection
+
     def create_tables(self):
-        if not self._ensure_connection():
+        # Runs while connecting (possibly in the breaker's reconnect thread), so no _ensure_connection
+        if self.connection is None:
             print("Database not available - skipping table creation")
             return
         cursor = self.connection.cursor()
+        if self._schema_version(cursor) >= SCHEMA_VERSION:
+            cursor.close()
+            return
         
         # Users table - compatible with both PostgreSQL and SQLite
         if self.is_sqlite:
@@ -133,8 +513,10 @@ class Database:
                     referred_by INTEGER,
                     referral_count INTEGER DEFAULT 0,
                     chat_partner INTEGER,
+                    active_session_id INTEGER,
                     partner_filter TEXT,
                     looking_for_chat INTEGER DEFAULT 0,
+                    search_started_at TEXT,
                     created_at TEXT DEFAULT CURRENT_TIMESTAMP,
                     updated_at TEXT DEFAULT CURRENT_TIMESTAMP
                 )
@@ -157,8 +539,10 @@ class Database:
                     referred_by BIGINT,
                     referral_count INTEGER DEFAULT 0,
                     chat_partner BIGINT,
+                    active_session_id INTEGER,
                     partner_filter VARCHAR(10),
                     looking_for_chat BOOLEAN DEFAULT FALSE,
+                    search_started_at TIMESTAMP,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
@@ -274,6 +658,87 @@ class Database:
                 )
             ''')
 
+        # Referral ledger: one row per referred user, processed by referrals.ReferralWorker
+        if self.is_sqlite:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS referral_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    referrer_id INTEGER NOT NULL,
+                    referred_id INTEGER NOT NULL UNIQUE,
+                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    processed_at TEXT
+                )
+            ''')
+        else:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS referral_events (
+                    id SERIAL PRIMARY KEY,
+                    referrer_id BIGINT NOT NULL,
+                    referred_id BIGINT NOT NULL UNIQUE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    processed_at TIMESTAMP
+                )
+            ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_referral_events_pending
+            ON referral_events (id) WHERE processed_at IS NULL
+        ''')
+        # Leaderboard loads read only the (few) users with referrals
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_referral_count
+            ON users (referral_count) WHERE referral_count > 0
+        ''')
+
+        # Full-text index over message_logs.message_content for /search. On SQLite an
+        # external-content FTS5 table kept current by triggers (so batched log
+        # inserts index themselves in the same transaction); on PostgreSQL a GIN
+        # index on the same to_tsvector expression the search_messages query uses.
+        if self.is_sqlite:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_logs_fts'")
+            existed = cursor.fetchone() is not None
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS message_logs_fts USING fts5(
+                    message_content, content='message_logs', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS message_logs_fts_insert AFTER INSERT ON message_logs BEGIN
+                    INSERT INTO message_logs_fts (rowid, message_content) VALUES (new.id, new.message_content);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS message_logs_fts_delete AFTER DELETE ON message_logs BEGIN
+                    INSERT INTO message_logs_fts (message_logs_fts, rowid, message_content)
+                    VALUES ('delete', old.id, old.message_content);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS message_logs_fts_update AFTER UPDATE ON message_logs BEGIN
+                    INSERT INTO message_logs_fts (message_logs_fts, rowid, message_content)
+                    VALUES ('delete', old.id, old.message_content);
+                    INSERT INTO message_logs_fts (rowid, message_content) VALUES (new.id, new.message_content);
+                END
+            ''')
+            if not existed:
+                # Index the messages logged before the table existed
+                cursor.execute("INSERT INTO message_logs_fts (message_logs_fts) VALUES ('rebuild')")
+        else:
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_message_logs_content_fts ON message_logs
+                USING GIN (to_tsvector('simple', COALESCE(message_content, '')))
+            ''')
+
+        # Sessions are ended by primary key through users.active_session_id
+        if not self._has_column(cursor, 'users', 'active_session_id'):
+            cursor.execute('ALTER TABLE users ADD COLUMN active_session_id INTEGER')
+            cursor.execute(self.queries.sql['backfill_active_sessions'])
+
+        # When the current search started; updated_at also moves on profile and terms writes
+        if not self._has_column(cursor, 'users', 'search_started_at'):
+            cursor.execute(f"ALTER TABLE users ADD COLUMN search_started_at {'TEXT' if self.is_sqlite else 'TIMESTAMP'}")
+            cursor.execute(self.queries.sql['backfill_search_started'])
+
         # Insert initial admin
         placeholder = self._placeholder()
         if self.is_sqlite:
@@ -297,38 +762,49 @@ class Database:
                 ON CONFLICT (id) DO NOTHING
             ''')
 
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_meta (version INTEGER NOT NULL)')
+        cursor.execute('DELETE FROM schema_meta')
+        cursor.execute(f'INSERT INTO schema_meta (version) VALUES ({placeholder})', (SCHEMA_VERSION,))
         cursor.close()
 
+    def _schema_version(self, cursor):
+        """Version recorded by the last create_tables run, 0 if it never completed"""
+        try:
+            cursor.execute('SELECT MAX(version) FROM schema_meta')
+            row = cursor.fetchone()
+        except Exception:
+            return 0
+        return (row[0] or 0) if row else 0
+
+    def _has_column(self, cursor, table, column):
+        if self.is_sqlite:
+            cursor.execute(f'PRAGMA table_info({table})')
+            return any(row[1] == column for row in cursor.fetchall())
+        cursor.execute('''
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+        ''', (table, column))
+        return cursor.fetchone() is not None
+
+    def _transaction(self, op):
+        """Run op(connection) on SQLite as one transaction with a single commit"""
+        if self._writer is not None:
+            return self._writer.run(op)
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = op(self.connection)
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        return result
+
     def add_user(self, user_id, username=None, first_name=None, last_name=None, referred_by=None):
-        if not self._ensure_connection():
-            print(f"Database not available - skipping add_user for {user_id}")
+        if self._deferred('add_user', user_id, username, first_name, last_name, referred_by):
             return
         try:
-            cursor = self.connection.cursor()
-            placeholder = self._placeholder()
-            if self.is_sqlite:
-                # First try to insert new user, then update existing user info without affecting other columns
-                cursor.execute(f'''
-                    INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, referred_by)
-                    VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
-                ''', (user_id, username, first_name, last_name, referred_by))
-                # Update existing user info while preserving other columns
-                cursor.execute(f'''
-                    UPDATE users SET username = {placeholder}, first_name = {placeholder}, 
-                    last_name = {placeholder}, updated_at = CURRENT_TIMESTAMP 
-                    WHERE user_id = {placeholder}
-                ''', (username, first_name, last_name, user_id))
-            else:
-                cursor.execute(f'''
-                    INSERT INTO users (user_id, username, first_name, last_name, referred_by)
-                    VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
-                    ON CONFLICT (user_id) DO UPDATE SET
-                        username = EXCLUDED.username,
-                        first_name = EXCLUDED.first_name,
-                        last_name = EXCLUDED.last_name,
-                        updated_at = CURRENT_TIMESTAMP
-                ''', (user_id, username, first_name, last_name, referred_by))
-            cursor.close()
+            # Insert new user, or update existing user info without affecting other columns
+            self._execute('add_user', (user_id, username, first_name, last_name, referred_by))
         except Exception as e:
             print(f"Error in add_user: {e}")
 
@@ -357,70 +833,26 @@ class Database:
                 'updated_at': None
             }
         try:
-            placeholder = self._placeholder()
-            if self.is_sqlite:
-                cursor = self.connection.cursor()
-                cursor.execute(f'SELECT * FROM users WHERE user_id = {placeholder}', (user_id,))
-                user = cursor.fetchone()
-                if user:
-                    # Convert SQLite row to dict
-                    columns = [description[0] for description in cursor.description]
-                    result = dict(zip(columns, user))
-                    cursor.close()
-                    return result
-                cursor.close()
-                return None
-            else:
-                cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                cursor.execute(f'SELECT * FROM users WHERE user_id = {placeholder}', (user_id,))
-                user = cursor.fetchone()
-                cursor.close()
-                return dict(user) if user else None
+            return self._execute('get_user', (user_id,), fetch='dict')
         except Exception as e:
             print(f"Error in get_user: {e}")
             return None
 
     def update_user_terms(self, user_id, agreed):
-        if not self._ensure_connection():
-            print(f"Database not available - skipping update_user_terms for {user_id}")
+        if self._deferred('update_user_terms', user_id, agreed):
             return
             
         try:
-            cursor = self.connection.cursor()
-            placeholder = self._placeholder()
-
-            # Try update first
-            cursor.execute(f'''
-                UPDATE users 
-                SET agreed_terms = {placeholder}, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (agreed, user_id))
-
-            # If user does not exist → insert new record
-            if cursor.rowcount == 0:
-                if self.is_sqlite:
-                    cursor.execute(f'''
-                        INSERT INTO users (user_id, agreed_terms, profile_completed, created_at, updated_at)
-                        VALUES ({placeholder}, {placeholder}, 0, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                    ''', (user_id, agreed))
-                else:
-                    cursor.execute(f'''
-                        INSERT INTO users (user_id, agreed_terms, profile_completed, created_at, updated_at)
-                        VALUES ({placeholder}, {placeholder}, FALSE, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                        ON CONFLICT (user_id) DO NOTHING
-                    ''', (user_id, agreed))
-                    
-            self.connection.commit()
-            cursor.close()
+            # Try update first; if user does not exist → insert new record
+            if self._execute('update_terms', (agreed, user_id)) == 0:
+                self._execute('insert_user_terms', (user_id, agreed))
         except Exception as e:
             print(f"Error in update_user_terms: {e}")
 
     def update_user_profile(self, user_id, gender=None, country=None, age=None, profile_completed=None):
-        if not self._ensure_connection():
-            print(f"Database not available - skipping update_user_profile for {user_id}")
+        if self._deferred('update_user_profile', user_id, gender, country, age, profile_completed):
             return
         try:
-            cursor = self.connection.cursor()
             placeholder = self._placeholder()
             updates = []
             values = []
@@ -444,25 +876,12 @@ class Database:
                 updates.append('updated_at = CURRENT_TIMESTAMP')
                 values.append(user_id)
 
+                # The column list varies per call, so this one is built here
                 query = f'UPDATE users SET {", ".join(updates)} WHERE user_id = {placeholder}'
-                cursor.execute(query, values)
 
                 # If no rows were updated → insert new row
-                if cursor.rowcount == 0:
-                    if self.is_sqlite:
-                        cursor.execute(f'''
-                            INSERT INTO users (user_id, gender, country, age, profile_completed, created_at, updated_at)
-                            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                        ''', (user_id, gender, country, age))
-                    else:
-                        cursor.execute(f'''
-                            INSERT INTO users (user_id, gender, country, age, profile_completed, created_at, updated_at)
-                            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, TRUE, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                            ON CONFLICT (user_id) DO NOTHING
-                        ''', (user_id, gender, country, age))
-                        
-            self.connection.commit()
-            cursor.close()
+                if self._execute_sql(query, values) == 0:
+                    self._execute('insert_user_profile', (user_id, gender, country, age))
         except Exception as e:
             print(f"Error in update_user_profile: {e}")
 
@@ -473,467 +892,313 @@ class Database:
             
         if not self._ensure_connection():
             return False
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        cursor.execute(f'SELECT 1 FROM admins WHERE user_id = {placeholder}', (user_id,))
-        result = cursor.fetchone()
-        cursor.close()
-        return result is not None
+        return self._execute('is_admin', (user_id,), fetch='one') is not None
 
     def add_admin(self, user_id, promoted_by):
         if not self._ensure_connection():
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        if self.is_sqlite:
-            cursor.execute(f'''
-                INSERT OR IGNORE INTO admins (user_id, promoted_by) VALUES ({placeholder}, {placeholder})
-            ''', (user_id, promoted_by))
-        else:
-            cursor.execute(f'''
-                INSERT INTO admins (user_id, promoted_by) VALUES ({placeholder}, {placeholder})
-                ON CONFLICT (user_id) DO NOTHING
-            ''', (user_id, promoted_by))
-        cursor.close()
+        self._execute('add_admin', (user_id, promoted_by))
 
     def remove_admin(self, user_id):
         if not self._ensure_connection():
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        cursor.execute(f'DELETE FROM admins WHERE user_id = {placeholder}', (user_id,))
-        cursor.close()
+        self._execute('remove_admin', (user_id,))
 
     def get_admins(self):
         if not self._ensure_connection():
             return []
-        if self.is_sqlite:
-            cursor = self.connection.cursor()
-            cursor.execute('SELECT * FROM admins')
-            admins = cursor.fetchall()
-            if admins:
-                columns = [description[0] for description in cursor.description]
-                result = [dict(zip(columns, admin)) for admin in admins]
-                cursor.close()
-                return result
-            cursor.close()
-            return []
-        else:
-            cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cursor.execute('SELECT * FROM admins')
-            admins = cursor.fetchall()
-            cursor.close()
-            return [dict(admin) for admin in admins]
+        return self._execute('get_admins', fetch='dicts')
 
     def add_force_join_group(self, group_id, group_link, added_by):
         if not self._ensure_connection():
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        if self.is_sqlite:
-            cursor.execute(f'''
-                INSERT OR REPLACE INTO force_join_groups (group_id, group_link, added_by)
-                VALUES ({placeholder}, {placeholder}, {placeholder})
-            ''', (group_id, group_link, added_by))
-        else:
-            cursor.execute(f'''
-                INSERT INTO force_join_groups (group_id, group_link, added_by)
-                VALUES ({placeholder}, {placeholder}, {placeholder})
-                ON CONFLICT (group_id) DO UPDATE SET
-                    group_link = EXCLUDED.group_link,
-                    added_by = EXCLUDED.added_by,
-                    added_at = CURRENT_TIMESTAMP
-            ''', (group_id, group_link, added_by))
-        cursor.close()
+        self._execute('add_force_join_group', (group_id, group_link, added_by))
 
     def remove_force_join_group(self, group_id):
         if not self._ensure_connection():
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        cursor.execute(f'DELETE FROM force_join_groups WHERE group_id = {placeholder}', (group_id,))
-        cursor.close()
+        self._execute('remove_force_join_group', (group_id,))
 
     def get_force_join_groups(self):
         if not self._ensure_connection():
             return []
-        if self.is_sqlite:
-            cursor = self.connection.cursor()
-            cursor.execute('SELECT * FROM force_join_groups')
-            groups = cursor.fetchall()
-            if groups:
-                columns = [description[0] for description in cursor.description]
-                result = [dict(zip(columns, group)) for group in groups]
-                cursor.close()
-                return result
-            cursor.close()
-            return []
-        else:
-            cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cursor.execute('SELECT * FROM force_join_groups')
-            groups = cursor.fetchall()
-            cursor.close()
-            return [dict(group) for group in groups]
+        return self._execute('get_force_join_groups', fetch='dicts')
 
     def block_user(self, user_id):
-        if not self._ensure_connection():
+        if self._deferred('block_user', user_id):
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        if self.is_sqlite:
-            cursor.execute(f'''
-                UPDATE users SET is_blocked = 1, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (user_id,))
-        else:
-            cursor.execute(f'''
-                UPDATE users SET is_blocked = TRUE, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (user_id,))
-        cursor.close()
+        self._execute('block_user', (user_id,))
 
     def unblock_user(self, user_id):
-        if not self._ensure_connection():
+        if self._deferred('unblock_user', user_id):
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        if self.is_sqlite:
-            cursor.execute(f'''
-                UPDATE users SET is_blocked = 0, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (user_id,))
-        else:
-            cursor.execute(f'''
-                UPDATE users SET is_blocked = FALSE, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (user_id,))
-        cursor.close()
+        self._execute('unblock_user', (user_id,))
 
     def set_vip_status(self, user_id, days):
-        if not self._ensure_connection():
+        self.set_vip_until(user_id, datetime.now() + timedelta(days=days))
+
+    def set_vip_until(self, user_id, vip_until):
+        """Grant VIP up to an absolute time, so a replayed grant keeps its original expiry"""
+        if isinstance(vip_until, str):
+            vip_until = datetime.fromisoformat(vip_until)
+        if self._deferred('set_vip_until', user_id, vip_until.isoformat()):
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        vip_until = datetime.now() + timedelta(days=days)
-        if self.is_sqlite:
-            cursor.execute(f'''
-                UPDATE users SET is_vip = 1, vip_until = {placeholder}, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (vip_until.isoformat(), user_id))
-        else:
-            cursor.execute(f'''
-                UPDATE users SET is_vip = TRUE, vip_until = {placeholder}, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (vip_until, user_id))
-        cursor.close()
+        self._execute('set_vip', (vip_until.isoformat() if self.is_sqlite else vip_until, user_id))
 
     def check_vip_expired(self, user_id):
         if not self._ensure_connection():
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        if self.is_sqlite:
-            cursor.execute(f'''
-                UPDATE users SET is_vip = 0 
-                WHERE user_id = {placeholder} AND datetime(vip_until) < datetime('now')
-            ''', (user_id,))
-        else:
-            cursor.execute(f'''
-                UPDATE users SET is_vip = FALSE 
-                WHERE user_id = {placeholder} AND vip_until < CURRENT_TIMESTAMP
-            ''', (user_id,))
-        cursor.close()
+        self._execute('expire_vip', (user_id,))
 
     def update_referral_count(self, user_id):
         if not self._ensure_connection():
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        cursor.execute(f'''
-            UPDATE users SET referral_count = referral_count + 1, updated_at = CURRENT_TIMESTAMP 
-            WHERE user_id = {placeholder}
-        ''', (user_id,))
-        cursor.close()
+        self._execute('increment_referrals', (user_id,))
 
-    def set_user_looking_for_chat(self, user_id, looking):
+    def record_referral(self, referrer_id, referred_id):
+        """Add a referral to the ledger; a user can only ever be referred once"""
         if not self._ensure_connection():
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        if self.is_sqlite:
-            cursor.execute(f'''
-                UPDATE users SET looking_for_chat = {placeholder}, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (looking, user_id))
-        else:
-            cursor.execute(f'''
-                UPDATE users SET looking_for_chat = {placeholder}, updated_at = CURRENT_TIMESTAMP 
-                WHERE user_id = {placeholder}
-            ''', (looking, user_id))
-        cursor.close()
+        self._execute('insert_referral_event', (referrer_id, referred_id))
+
+    def get_pending_referrals(self, limit):
+        """(event id, referrer_id) of unprocessed referrals, oldest first"""
+        if not self._ensure_connection():
+            return []
+        return [(row[0], row[1]) for row in self._execute('get_pending_referrals', (limit,), fetch='all')]
+
+    def apply_referral(self, event_id, referrer_id):
+        """Mark the event processed and count it for the referrer, atomically; False if already processed"""
+        if not self._ensure_connection():
+            return False
+        if not self.is_sqlite:
+            return self._execute('apply_referral', (event_id,)) == 1
+        sql = self.queries.sql
+
+        def apply(connection):
+            if connection.execute(sql['claim_referral_event'], (event_id,)).rowcount != 1:
+                return False
+            connection.execute(sql['increment_referrals'], (referrer_id,))
+            return True
+
+        return self._transaction(apply)
+
+    def get_referral_counts(self):
+        """(user_id, referral_count) of every user with referrals"""
+        if not self._ensure_connection():
+            return []
+        return [(row[0], row[1]) for row in self._execute('get_referral_counts', fetch='all')]
+
+    def set_user_looking_for_chat(self, user_id, looking):
+        if self._deferred('set_user_looking_for_chat', user_id, looking):
+            return
+        self._execute('set_looking_for_chat', (looking, user_id))
 
     def find_chat_partner_by_gender(self, user_id, gender_filter=None):
         if not self._ensure_connection():
             return None
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        
-        # Build query based on gender filter - only match users actively looking for chat
+        # Only match users actively looking for chat
         if gender_filter:
-            if self.is_sqlite:
-                query = f'''
-                    SELECT user_id FROM users 
-                    WHERE user_id != {placeholder} 
-                    AND chat_partner IS NULL 
-                    AND looking_for_chat = 1 
-                    AND is_blocked = 0 
-                    AND profile_completed = 1 
-                    AND gender = {placeholder}
-                    AND agreed_terms = 1
-                    AND gender IS NOT NULL
-                    ORDER BY user_id 
-                    LIMIT 1
-                '''
-            else:
-                query = f'''
-                    SELECT user_id FROM users 
-                    WHERE user_id != {placeholder} 
-                    AND chat_partner IS NULL 
-                    AND looking_for_chat = TRUE 
-                    AND is_blocked = FALSE 
-                    AND profile_completed = TRUE 
-                    AND gender = {placeholder}
-                    AND agreed_terms = TRUE
-                    AND gender IS NOT NULL
-                    ORDER BY user_id 
-                    LIMIT 1
-                '''
-            cursor.execute(query, (user_id, gender_filter))
-        else:
-            if self.is_sqlite:
-                query = f'''
-                    SELECT user_id FROM users 
-                    WHERE user_id != {placeholder} 
-                    AND chat_partner IS NULL 
-                    AND looking_for_chat = 1 
-                    AND is_blocked = 0 
-                    AND profile_completed = 1 
-                    AND agreed_terms = 1
-                    AND gender IS NOT NULL
-                    ORDER BY user_id 
-                    LIMIT 1
-                '''
-            else:
-                query = f'''
-                    SELECT user_id FROM users 
-                    WHERE user_id != {placeholder} 
-                    AND chat_partner IS NULL 
-                    AND looking_for_chat = TRUE 
-                    AND is_blocked = FALSE 
-                    AND profile_completed = TRUE 
-                    AND agreed_terms = TRUE
-                    AND gender IS NOT NULL
-                    ORDER BY user_id 
-                    LIMIT 1
-                '''
-            cursor.execute(query, (user_id,))
-        
-        result = cursor.fetchone()
-        cursor.close()
-        return result[0] if result else None
+            return self._execute('find_partner_by_gender', (user_id, gender_filter), fetch='value')
+        return self._execute('find_partner', (user_id,), fetch='value')
 
     def find_chat_partner(self, user_id, gender_filter=None):
         if not self._ensure_connection():
             return None
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        
-        if self.is_sqlite:
-            query = f'''
-                SELECT user_id FROM users 
-                WHERE user_id != {placeholder} 
-                AND profile_completed = 1 
-                AND agreed_terms = 1 
-                AND is_blocked = 0 
-                AND chat_partner IS NULL
-                AND looking_for_chat = 1
-            '''
-            params = [user_id]
-            
-            if gender_filter:
-                query += f' AND gender = {placeholder}'
-                params.append(gender_filter)
-                
-            query += ' ORDER BY RANDOM() LIMIT 1'
-        else:
-            query = f'''
-                SELECT user_id FROM users 
-                WHERE user_id != {placeholder} 
-                AND profile_completed = TRUE 
-                AND agreed_terms = TRUE 
-                AND is_blocked = FALSE 
-                AND chat_partner IS NULL
-                AND looking_for_chat = TRUE
-            '''
-            params = [user_id]
-            
-            if gender_filter:
-                query += f' AND gender = {placeholder}'
-                params.append(gender_filter)
-                
-            query += ' ORDER BY RANDOM() LIMIT 1'
-        
-        cursor.execute(query, params)
-        partner = cursor.fetchone()
-        cursor.close()
-        return partner[0] if partner else None
+        if gender_filter:
+            return self._execute('find_random_partner_by_gender', (user_id, gender_filter), fetch='value')
+        return self._execute('find_random_partner', (user_id,), fetch='value')
 
-    def start_chat_session(self, user1_id, user2_id):
+    def claim_chat_partner(self, user_id, gender_filter=None):
+        """Find a waiting partner and take them out of the pool, safe against concurrent workers"""
+        if self.journal is not None and self.journal.pending:
+            # The pool in the database is stale until the journal is replayed: keep waiting
+            return None
+        for _ in range(3):
+            partner_id = self.find_chat_partner_by_gender(user_id, gender_filter)
+            if not partner_id:
+                return None
+            if self._execute('claim_waiting_user', (partner_id,)) == 1:
+                return partner_id
+        return None
+
+    def clear_stale_waiting(self, seconds):
+        """Clear looking_for_chat for every search older than seconds; returns how many"""
         if not self._ensure_connection():
-            return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        
-        # Update both users' chat_partner field
-        cursor.execute(f'''
-            UPDATE users SET chat_partner = {placeholder}, looking_for_chat = {self._boolean_value(False)}, updated_at = CURRENT_TIMESTAMP 
-            WHERE user_id = {placeholder}
-        ''', (user2_id, user1_id))
-        
-        cursor.execute(f'''
-            UPDATE users SET chat_partner = {placeholder}, looking_for_chat = {self._boolean_value(False)}, updated_at = CURRENT_TIMESTAMP 
-            WHERE user_id = {placeholder}
-        ''', (user1_id, user2_id))
-        
-        # Create chat session record
-        cursor.execute(f'''
-            INSERT INTO chat_sessions (user1_id, user2_id) 
-            VALUES ({placeholder}, {placeholder})
-        ''', (user1_id, user2_id))
-        
-        cursor.close()
+            return 0
+        return self._execute('clear_stale_waiting', (int(seconds),))
 
-    def end_chat_session(self, user_id):
+    def get_waiting_users(self):
         if not self._ensure_connection():
+            return []
+        return self._execute('get_waiting_users', fetch='dicts')
+
+    def get_active_sessions(self):
+        """(user1_id, user2_id) of every active chat session, oldest first"""
+        if not self._ensure_connection():
+            return []
+        return [(row[0], row[1]) for row in self._execute('get_active_sessions', fetch='all')]
+
+    def start_chat_session(self, user1_id, user2_id):
+        if self._deferred('start_chat_session', user1_id, user2_id):
+            return
+        # Session row plus both users' chat_partner and active_session_id, atomically;
+        # a pair that is already linked (a replayed start) gets no second session
+        if not self.is_sqlite:
+            self._execute('start_chat_session', (user1_id, user2_id, user1_id, user2_id))
+            return
+        sql = self.queries.sql
+
+        def start(connection):
+            row = connection.execute(sql['get_chat_session'], (user1_id,)).fetchone()
+            if row and row[0] == user2_id:
+                return
+            session_id = connection.execute(sql['insert_chat_session'], (user1_id, user2_id)).lastrowid
+            connection.execute(sql['set_chat_session'], (user2_id, session_id, user1_id))
+            connection.execute(sql['set_chat_session'], (user1_id, session_id, user2_id))
+
+        self._transaction(start)
+
+    def start_chat_sessions(self, pairs):
+        """Start a session for every (user1_id, user2_id) pair in one round trip (one transaction on SQLite)"""
+        if not pairs or self._deferred('start_chat_sessions', pairs):
+            return
+        if not self.is_sqlite:
+            cursor = self.connection.cursor()
+            try:
+                psycopg2.extras.execute_values(cursor, '''
+                    WITH pairs (user1_id, user2_id) AS (VALUES %s),
+                    session AS (
+                        INSERT INTO chat_sessions (user1_id, user2_id)
+                        SELECT user1_id, user2_id FROM pairs
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM users
+                            WHERE users.user_id = pairs.user1_id AND users.chat_partner = pairs.user2_id
+                        )
+                        RETURNING id, user1_id, user2_id
+                    )
+                    UPDATE users SET
+                        chat_partner = CASE WHEN users.user_id = session.user1_id
+                                            THEN session.user2_id ELSE session.user1_id END,
+                        active_session_id = session.id,
+                        looking_for_chat = FALSE,
+                        updated_at = CURRENT_TIMESTAMP
+                    FROM session
+                    WHERE users.user_id IN (session.user1_id, session.user2_id)
+                ''', pairs, page_size=len(pairs))
+            except Exception as e:
+                self._check_failure(e)
+                raise
+            finally:
+                cursor.close()
+            return
+        sql = self.queries.sql
+
+        def start(connection):
+            for user1_id, user2_id in pairs:
+                row = connection.execute(sql['get_chat_session'], (user1_id,)).fetchone()
+                if row and row[0] == user2_id:
+                    continue
+                session_id = connection.execute(sql['insert_chat_session'], (user1_id, user2_id)).lastrowid
+                connection.execute(sql['set_chat_session'], (user2_id, session_id, user1_id))
+                connection.execute(sql['set_chat_session'], (user1_id, session_id, user2_id))
+
+        self._transaction(start)
+
+    def end_chat_session(self, user_id, partner_id=None):
+        """End the user's chat; with partner_id, only while the user is still chatting with that partner
+
+        The registry passes the partner it ended the chat with, so a replayed
+        end never closes a session the user started after it.
+        """
+        if self._deferred('end_chat_session', user_id, partner_id):
             return None
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        
-        # Get current chat partner
-        cursor.execute(f'SELECT chat_partner FROM users WHERE user_id = {placeholder}', (user_id,))
-        result = cursor.fetchone()
-        
-        if not result or not result[0]:
-            cursor.close()
-            return None
-        
-        partner_id = result[0]
-        
-        # End chat session in database
-        if self.is_sqlite:
-            cursor.execute(f'''
-                UPDATE chat_sessions 
-                SET ended_at = CURRENT_TIMESTAMP, is_active = 0 
-                WHERE (user1_id = {placeholder} OR user2_id = {placeholder}) 
-                AND is_active = 1
-            ''', (user_id, user_id))
-        else:
-            cursor.execute(f'''
-                UPDATE chat_sessions 
-                SET ended_at = CURRENT_TIMESTAMP, is_active = FALSE 
-                WHERE (user1_id = {placeholder} OR user2_id = {placeholder}) 
-                AND is_active = TRUE
-            ''', (user_id, user_id))
-        
-        # Clear chat_partner for both users
-        cursor.execute(f'''
-            UPDATE users SET chat_partner = NULL, looking_for_chat = {self._boolean_value(False)}, updated_at = CURRENT_TIMESTAMP 
-            WHERE user_id = {placeholder}
-        ''', (user_id,))
-        
-        cursor.execute(f'''
-            UPDATE users SET chat_partner = NULL, looking_for_chat = {self._boolean_value(False)}, updated_at = CURRENT_TIMESTAMP 
-            WHERE user_id = {placeholder}
-        ''', (partner_id,))
-        
-        cursor.close()
-        return partner_id
+        if not self.is_sqlite:
+            row = self._execute('end_chat_session', (user_id, partner_id), fetch='one')
+            if not row:
+                return None
+            partner_id, session_id = row
+            if session_id is None:
+                self._execute('close_chat_sessions', (user_id, user_id))
+            return partner_id
+        sql = self.queries.sql
+
+        def end(connection):
+            row = connection.execute(sql['get_chat_session'], (user_id,)).fetchone()
+            if not row or not row[0] or (partner_id is not None and row[0] != partner_id):
+                return None
+            current_partner_id, session_id = row[0], row[1]
+            # End chat session by primary key (legacy sessions have no id on the user row)
+            if session_id:
+                connection.execute(sql['close_chat_session'], (session_id,))
+            else:
+                connection.execute(sql['close_chat_sessions'], (user_id, user_id))
+            # Clear chat_partner for both users
+            connection.execute(sql['clear_chat_partner'], (user_id,))
+            connection.execute(sql['release_chat_partner'], (current_partner_id, user_id))
+            return current_partner_id
 
-    def _boolean_value(self, value):
-        return 1 if value and self.is_sqlite else value
+        return self._transaction(end)
 
     def update_partner_filter(self, user_id, gender_filter):
-        if not self._ensure_connection():
+        if self._deferred('update_partner_filter', user_id, gender_filter):
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        cursor.execute(f'''
-            UPDATE users SET partner_filter = {placeholder}, updated_at = CURRENT_TIMESTAMP 
-            WHERE user_id = {placeholder}
-        ''', (gender_filter, user_id))
-        cursor.close()
+        self._execute('update_partner_filter', (gender_filter, user_id))
 
     def log_message(self, sender_id, receiver_id, message_type, content):
         if not self._ensure_connection():
             return
+        self._execute('log_message', (sender_id, receiver_id, message_type, content))
+
+    def log_messages(self, entries):
+        """Insert several (sender_id, receiver_id, message_type, content) rows in one round trip"""
+        if not entries or not self._ensure_connection():
+            return
+        if self._writer is not None:
+            self._writer.post(lambda connection: connection.executemany(self.queries.sql['log_message'], entries))
+            return
         cursor = self.connection.cursor()
-        placeholder = self._placeholder()
-        cursor.execute(f'''
-            INSERT INTO message_logs (sender_id, receiver_id, message_type, message_content)
-            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder})
-        ''', (sender_id, receiver_id, message_type, content))
-        cursor.close()
+        try:
+            if self.is_sqlite:
+                cursor.executemany(self.queries.sql['log_message'], entries)
+            else:
+                psycopg2.extras.execute_values(cursor, '''
+                    INSERT INTO message_logs (sender_id, receiver_id, message_type, message_content)
+                    VALUES %s
+                ''', entries)
+        except Exception as e:
+            self._check_failure(e)
+            raise
+        finally:
+            cursor.close()
+
+    def search_messages(self, terms, user_id=None, since=None, limit=10, offset=0):
+        """Logged messages containing every word of terms, best match first
+
+        Rows are (id, sender_id, receiver_id, message_type, snippet, sent_at);
+        user_id matches either side, since is a 'YYYY-MM-DD' lower bound.
+        """
+        words = terms.split()
+        if not words or not self._ensure_connection():
+            return []
+        if self.is_sqlite:
+            # Each word as an FTS5 string, so user input is never read as query syntax
+            query = ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+        else:
+            query = ' '.join(words)
+        params = (query, user_id, user_id, user_id, since, since, limit, offset)
+        return [tuple(row) for row in self._execute('search_messages', params, fetch='all')]
 
     def get_stats(self):
         if not self._ensure_connection():
             return {'total_users': 0, 'active_chats': 0, 'total_messages': 0, 'vip_users': 0}
         
-        if self.is_sqlite:
-            cursor = self.connection.cursor()
-            # Get user counts with SQLite syntax
-            cursor.execute('SELECT COUNT(*) as total_users FROM users WHERE agreed_terms = 1')
-            result = cursor.fetchone()
-            total_users = result[0] if result else 0
-            
-            cursor.execute('SELECT COUNT(*) as active_chats FROM users WHERE chat_partner IS NOT NULL')
-            result = cursor.fetchone()
-            active_chats = result[0] if result else 0
-            
-            cursor.execute('SELECT COUNT(*) as total_messages FROM message_logs')
-            result = cursor.fetchone()
-            total_messages = result[0] if result else 0
-            
-            cursor.execute("SELECT COUNT(*) as vip_users FROM users WHERE is_vip = 1 AND datetime(vip_until) > datetime('now')")
-            result = cursor.fetchone()
-            vip_users = result[0] if result else 0
-            
-            cursor.close()
-        else:
-            cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            # Get user counts with PostgreSQL syntax
-            cursor.execute('SELECT COUNT(*) as total_users FROM users WHERE agreed_terms = TRUE')
-            result = cursor.fetchone()
-            total_users = result['total_users'] if result else 0
-            
-            cursor.execute('SELECT COUNT(*) as active_chats FROM users WHERE chat_partner IS NOT NULL')
-            result = cursor.fetchone()
-            active_chats = result['active_chats'] if result else 0
-            
-            cursor.execute('SELECT COUNT(*) as total_messages FROM message_logs')
-            result = cursor.fetchone()
-            total_messages = result['total_messages'] if result else 0
-            
-            cursor.execute('SELECT COUNT(*) as vip_users FROM users WHERE is_vip = TRUE AND vip_until > CURRENT_TIMESTAMP')
-            result = cursor.fetchone()
-            vip_users = result['vip_users'] if result else 0
-            
-            cursor.close()
-        
         return {
-            'total_users': total_users,
-            'active_chats': active_chats // 2,  # Divide by 2 since each chat involves 2 users
-            'total_messages': total_messages,
-            'vip_users': vip_users
+            'total_users': self._execute('count_agreed_users', fetch='value') or 0,
+            # Divide by 2 since each chat involves 2 users
+            'active_chats': (self._execute('count_users_in_chat', fetch='value') or 0) // 2,
+            'total_messages': self._execute('count_messages', fetch='value') or 0,
+            'vip_users': self._execute('count_vip_users', fetch='value') or 0
         }
 
     def get_detailed_stats(self):
@@ -946,146 +1211,99 @@ class Database:
                 'completed_profiles': 0, 'total_referrals': 0
             }
         
-        if self.is_sqlite:
-            cursor = self.connection.cursor()
-            
-            # Total users who agreed to terms
-            cursor.execute('SELECT COUNT(*) FROM users WHERE agreed_terms = 1')
-            total_users = cursor.fetchone()[0] or 0
-            
-            # Male and Female users
-            cursor.execute('SELECT COUNT(*) FROM users WHERE gender = "Male" AND agreed_terms = 1')
-            male_users = cursor.fetchone()[0] or 0
-            
-            cursor.execute('SELECT COUNT(*) FROM users WHERE gender = "Female" AND agreed_terms = 1') 
-            female_users = cursor.fetchone()[0] or 0
-            
-            # Active chats
-            cursor.execute('SELECT COUNT(*) FROM users WHERE chat_partner IS NOT NULL')
-            active_chats = cursor.fetchone()[0] or 0
-            
-            # Total messages
-            cursor.execute('SELECT COUNT(*) FROM message_logs')
-            total_messages = cursor.fetchone()[0] or 0
-            
-            # VIP users
-            cursor.execute("SELECT COUNT(*) FROM users WHERE is_vip = 1 AND datetime(vip_until) > datetime('now')")
-            vip_users = cursor.fetchone()[0] or 0
-            
-            # Blocked users
-            cursor.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 1')
-            blocked_users = cursor.fetchone()[0] or 0
-            
-            # Live users (looking for chat)
-            cursor.execute('SELECT COUNT(*) FROM users WHERE looking_for_chat = 1 AND gender = "Male"')
-            live_male_users = cursor.fetchone()[0] or 0
-            
-            cursor.execute('SELECT COUNT(*) FROM users WHERE looking_for_chat = 1 AND gender = "Female"')
-            live_female_users = cursor.fetchone()[0] or 0
-            
-            # Completed profiles
-            cursor.execute('SELECT COUNT(*) FROM users WHERE profile_completed = 1')
-            completed_profiles = cursor.fetchone()[0] or 0
-            
-            # Total referrals made
-            cursor.execute('SELECT SUM(referral_count) FROM users')
-            result = cursor.fetchone()
-            total_referrals = result[0] if result and result[0] else 0
-            
-            cursor.close()
-        else:
-            cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            
-            # Total users who agreed to terms
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE agreed_terms = TRUE')
-            total_users = cursor.fetchone()['count'] or 0
-            
-            # Male and Female users
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE gender = %s AND agreed_terms = TRUE', ('Male',))
-            male_users = cursor.fetchone()['count'] or 0
-            
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE gender = %s AND agreed_terms = TRUE', ('Female',))
-            female_users = cursor.fetchone()['count'] or 0
-            
-            # Active chats
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE chat_partner IS NOT NULL')
-            active_chats = cursor.fetchone()['count'] or 0
-            
-            # Total messages
-            cursor.execute('SELECT COUNT(*) as count FROM message_logs')
-            total_messages = cursor.fetchone()['count'] or 0
-            
-            # VIP users
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE is_vip = TRUE AND vip_until > CURRENT_TIMESTAMP')
-            vip_users = cursor.fetchone()['count'] or 0
-            
-            # Blocked users
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE is_blocked = TRUE')
-            blocked_users = cursor.fetchone()['count'] or 0
-            
+        count = lambda name, *params: self._execute(name, params, fetch='value') or 0
+        return {
+            # Users who agreed to terms
+            'total_users': count('count_agreed_users'),
+            'male_users': count('count_agreed_users_by_gender', 'Male'),
+            'female_users': count('count_agreed_users_by_gender', 'Female'),
+            # Divide by 2 since each chat involves 2 users
+            'active_chats': count('count_users_in_chat') // 2,
+            'total_messages': count('count_messages'),
+            'vip_users': count('count_vip_users'),
+            'blocked_users': count('count_blocked_users'),
             # Live users (looking for chat)
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE looking_for_chat = TRUE AND gender = %s', ('Male',))
-            live_male_users = cursor.fetchone()['count'] or 0
-            
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE looking_for_chat = TRUE AND gender = %s', ('Female',))
-            live_female_users = cursor.fetchone()['count'] or 0
-            
-            # Completed profiles
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE profile_completed = TRUE')
-            completed_profiles = cursor.fetchone()['count'] or 0
-            
+            'live_male_users': count('count_looking_by_gender', 'Male'),
+            'live_female_users': count('count_looking_by_gender', 'Female'),
+            'completed_profiles': count('count_completed_profiles'),
             # Total referrals made
-            cursor.execute('SELECT SUM(referral_count) as total FROM users')
-            result = cursor.fetchone()
-            total_referrals = result['total'] if result and result['total'] else 0
-            
-            cursor.close()
-        
-        return {
-            'total_users': total_users,
-            'male_users': male_users,
-            'female_users': female_users,
-            'active_chats': active_chats // 2,  # Divide by 2 since each chat involves 2 users
-            'total_messages': total_messages,
-            'vip_users': vip_users,
-            'blocked_users': blocked_users,
-            'live_male_users': live_male_users,
-            'live_female_users': live_female_users,
-            'completed_profiles': completed_profiles,
-            'total_referrals': total_referrals
+            'total_referrals': count('sum_referrals')
         }
 
     def get_all_users(self):
         if not self._ensure_connection():
             return []
+        return self._execute('get_all_users', fetch='dicts')
+
+    def export_rows(self, table, since=None, until=None, user_id=None, batch_size=EXPORT_BATCH):
+        """Stream a table: yields its column names, then lists of at most batch_size rows
+
+        Runs on a connection of its own so a long export never holds the shared
+        one. PostgreSQL uses a server-side (named) cursor, SQLite a read-only
+        connection, so only one batch is ever in memory. since/until are
+        'YYYY-MM-DD' bounds on the table's date column (until exclusive).
+        """
+        order_column, date_column, user_columns = EXPORT_TABLES[table]
+        if not self._ensure_connection():
+            return
+        p = self._placeholder()
+        conditions, params = [], []
+        if since:
+            conditions.append(f"{date_column} >= {p}")
+            params.append(since)
+        if until:
+            conditions.append(f"{date_column} < {p}")
+            params.append(until)
+        if user_id is not None:
+            conditions.append('(' + ' OR '.join(f"{column} = {p}" for column in user_columns) + ')')
+            params.extend([user_id] * len(user_columns))
+        sql = f"SELECT * FROM {table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {order_column}"
+
         if self.is_sqlite:
-            cursor = self.connection.cursor()
-            cursor.execute('SELECT user_id FROM users WHERE is_blocked = 0')
-            users = cursor.fetchall()
-            result = [{'user_id': user[0]} for user in users]
-            cursor.close()
-            return result
+            connection = open_connection(os.getenv('SQLITE_PATH', SQLITE_PATH), readonly=True)
+            cursor = connection.cursor()
         else:
-            cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cursor.execute('SELECT user_id FROM users WHERE is_blocked = FALSE')
-            users = cursor.fetchall()
+            # Named cursors need a transaction, so no autocommit here
+            connection = connect_postgres()
+            cursor = connection.cursor(name=f'export_{table}')
+            cursor.itersize = batch_size
+        try:
+            cursor.execute(sql, params)
+            # A named cursor only has a description after the first fetch
+            rows = cursor.fetchmany(batch_size)
+            yield [column[0] for column in cursor.description]
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(batch_size)
+        finally:
             cursor.close()
-            return [dict(user) for user in users]
+            connection.close()
 
     def delete_user(self, user_id):
         """Delete user and all related data"""
         if not self._ensure_connection():
             return
-        cursor = self.connection.cursor()
-        placeholder = self._placeholder()
         
         # End any active chat first
         self.end_chat_session(user_id)
         
         # Delete from all tables
-        cursor.execute(f'DELETE FROM message_logs WHERE sender_id = {placeholder} OR receiver_id = {placeholder}', (user_id, user_id))
-        cursor.execute(f'DELETE FROM chat_sessions WHERE user1_id = {placeholder} OR user2_id = {placeholder}', (user_id, user_id))
-        cursor.execute(f'DELETE FROM admins WHERE user_id = {placeholder}', (user_id,))
-        cursor.execute(f'DELETE FROM users WHERE user_id = {placeholder}', (user_id,))
-        
-        cursor.close()
+        self._execute('delete_user_messages', (user_id, user_id))
+        self._execute('delete_user_sessions', (user_id, user_id))
+        self._execute('remove_admin', (user_id,))
+        self._execute('delete_user', (user_id,))
+
+    def close(self):
+        """Commit queued writes and close every connection"""
+        self.breaker.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if self._writer is not None:
+            self._writer.close()
+            self._readers.close()
+        elif self.connection is not None:
+            self.connection.close()
+        self.connection = None
@@ -0,0 +1,107 @@
+"""
+Streaming admin export of users, chat sessions and message logs
+
+Rows come from Database.export_rows one batch at a time and go straight
+into a gzip-compressed CSV or JSONL file, so memory stays at one batch
+whatever the table size. Once a file's compressed size reaches
+EXPORT_PART_BYTES it is closed and handed over, and the export continues
+in a new part. Every part is a complete gzip file (CSV parts repeat the
+header), so each one can be opened on its own.
+
+The generator is synchronous; the bot pulls parts from a worker thread and
+uploads each one as a Telegram document before the next is written.
+
+Configuration:
+    EXPORT_PART_BYTES  compressed size at which a part is closed (default 45 MB,
+                       under Telegram's 50 MB bot upload limit)
+    EXPORT_BATCH       rows fetched per round trip (default 1000, see database.py)
+    EXPORT_DIR         directory for parts while they are uploaded (default: system temp)
+"""
+
+import os
+import csv
+import gzip
+import json
+import tempfile
+from datetime import datetime
+
+from database import EXPORT_TABLES
+
+EXPORT_PART_BYTES = int(os.getenv('EXPORT_PART_BYTES', str(45 * 1024 * 1024)))
+EXPORT_DIR = os.getenv('EXPORT_DIR') or tempfile.gettempdir()
+FORMATS = ('csv', 'jsonl')
+TABLES = tuple(EXPORT_TABLES)
+
+
+class ExportPart:
+    """One gzip file of the export; rows are written as they arrive"""
+
+    def __init__(self, path, fmt, columns):
+        self.path = path
+        self.fmt = fmt
+        self.columns = columns
+        self.rows = 0
+        self._raw = open(path, 'wb')
+        self._text = gzip.open(self._raw, 'wt', encoding='utf-8', newline='')
+        if fmt == 'csv':
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(columns)
+
+    def write(self, rows):
+        if self.fmt == 'csv':
+            self._csv.writerows(rows)
+        else:
+            for row in rows:
+                self._text.write(json.dumps(dict(zip(self.columns, row)), default=str, ensure_ascii=False))
+                self._text.write('\n')
+        self.rows += len(rows)
+
+    @property
+    def size(self):
+        """Compressed bytes on disk so far (trails the input by the compressor's buffer)"""
+        return self._raw.tell()
+
+    def close(self):
+        self._text.close()
+        self._raw.close()
+
+
+def export_parts(db, table, fmt='csv', since=None, until=None, user_id=None,
+                 part_bytes=EXPORT_PART_BYTES, directory=EXPORT_DIR):
+    """Export one table; yields (path, rows) for every finished part
+
+    The caller owns each yielded file and should delete it once delivered.
+    Nothing is yielded when the database is unavailable; an empty table
+    still gives one part holding just the header.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}")
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    batches = db.export_rows(table, since=since, until=until, user_id=user_id)
+    columns = next(batches, None)
+    if columns is None:
+        return
+    number = 0
+    part = None
+    try:
+        for rows in batches:
+            if part is None:
+                number += 1
+                part = ExportPart(os.path.join(directory, f"{table}-{stamp}.part{number}.{fmt}.gz"), fmt, columns)
+            part.write(rows)
+            if part.size >= part_bytes:
+                part.close()
+                yield part.path, part.rows
+                part = None
+        if part is None and number == 0:
+            part = ExportPart(os.path.join(directory, f"{table}-{stamp}.part1.{fmt}.gz"), fmt, columns)
+        if part is not None:
+            part.close()
+            yield part.path, part.rows
+            part = None
+    finally:
+        batches.close()
+        if part is not None:
+            # Abandoned midway (error or the caller stopped): drop the partial file
+            part.close()
+            os.remove(part.path)
@@ -77,6 +77,18 @@ try:
         except Exception as e:
             print(f"Unhandled error: {e}")
 
+    # -----------------------------
+    # Multi-worker mode (BOT_WORKERS > 1): ingress + sharded worker processes
+    # -----------------------------
+    from workers import BOT_WORKERS, run_sharded
+
+    if BOT_WORKERS > 1:
+        print(f"Starting bot in sharded mode with {BOT_WORKERS} workers...")
+        # Workers fork hone ke baad hi Flask thread start karo
+        run_sharded(extra_error_handlers=[error_handler],
+                    on_started=lambda: threading.Thread(target=run_flask).start())
+        sys.exit(0)
+
     # -----------------------------
     # Start bot
     # -----------------------------
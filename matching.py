@@ -0,0 +1,337 @@
+"""
+Matching index over the waiting pool: gender, country and age bucket
+
+Waiting users are kept in buckets keyed by (gender, gender filter,
+country, age bucket, VIP). Each bucket is a dict in arrival order, so its
+first entry is its longest waiter and compatibility is decided by the key
+alone.
+A lookup probes a bounded set of buckets and looks only at their heads, so
+its cost depends on the number of attribute combinations, never on how
+many users are waiting.
+
+Preferences widen in steps:
+
+    0  same country, same age bucket
+    1  same country, neighbouring age bucket
+    2  anyone compatible on gender
+
+A pair may use step N once either side has waited MATCH_WIDEN_AFTER[N - 1]
+seconds. Step 0 is always allowed, and the best step wins over an older
+waiter at a wider one.
+
+A search only sees the steps allowed at that moment, so two users already
+waiting can become a valid pair just by waiting longer. In instant mode the
+bot therefore calls MatchIndex.sweep every MATCH_TICK seconds. It re-runs
+the lookup only for users who crossed a widening threshold since the
+previous sweep. Any other newly possible pair involves a new search, which
+does its own lookup.
+
+Within a step the waiter with the highest score wins: seconds waited, plus
+MATCH_VIP_BOOST for active VIPs, plus MATCH_STRICT_BOOST for users with a
+gender filter (their pool is smaller). The boost is the same for everyone
+in a bucket, so each bucket's head still has its best score. Everyone ages
+at the same rate, so comparing "arrival minus boost" gives the same order
+as comparing scores, and nothing has to be re-sorted as time passes.
+
+Candidates the searcher recently chatted with are skipped (the avoid
+predicate, see recent_partners.py); a bucket's head is then its longest
+waiter the searcher may meet, which costs at most a few extra steps.
+
+Time to match is recorded for both sides of every match, per queue
+(partner filter, VIP or not). When the p95 over recent matches exceeds
+MATCH_P95_TARGET, the widening thresholds shrink in proportion until it is
+back under target.
+
+In batch mode (MATCH_MODE=batch) searches only join the index, and every
+MATCH_TICK seconds the bot pairs the whole pool at once (MatchIndex.batch).
+Compatibility depends only on (gender, gender filter), so the pool collapses
+into a handful of classes. Users with a filter are paired with each other
+first, then with unfiltered users, and unfiltered users with each other
+last. With two genders this gives a maximum matching, so a filtered search
+is no longer starved by random searches taking its only possible partners.
+Within that, the best-scored users are served first, and partners from the
+same country and age range are preferred. Wait-based widening does not
+apply in batch mode because the tick pairs everyone it can.
+
+Configuration:
+    MATCH_WIDEN_AFTER   seconds of waiting before steps 1 and 2 (default "15,45")
+    MATCH_VIP_BOOST     seconds of extra wait credited to VIPs (default 30)
+    MATCH_STRICT_BOOST  seconds of extra wait credited to filtered searches (default 10)
+    MATCH_P95_TARGET    target p95 time to match in seconds (default 60)
+    MATCH_MODE          "instant" (match on each search, default) or "batch"
+    MATCH_TICK          seconds between matching rounds: batch pairing, or the widening sweep (default 0.3)
+"""
+
+import os
+import time
+from bisect import bisect_right
+from collections import deque
+from datetime import datetime
+
+MATCH_WIDEN_AFTER = tuple(float(s) for s in os.getenv('MATCH_WIDEN_AFTER', '15,45').split(','))
+MATCH_VIP_BOOST = float(os.getenv('MATCH_VIP_BOOST', '30'))
+MATCH_STRICT_BOOST = float(os.getenv('MATCH_STRICT_BOOST', '10'))
+MATCH_P95_TARGET = float(os.getenv('MATCH_P95_TARGET', '60'))
+MATCH_MODE = os.getenv('MATCH_MODE', 'instant')
+MATCH_TICK = float(os.getenv('MATCH_TICK', '0.3'))
+
+# Recent time-to-match samples kept per queue, and how often the pace is recomputed
+MATCH_SAMPLES = 1000
+PACE_EVERY = 50
+
+# Lower edges of the profile age ranges after the first: 18-25, 26-35, 36-45, 46+
+AGE_BUCKET_EDGES = (26, 36, 46)
+
+
+def age_bucket(age):
+    return bisect_right(AGE_BUCKET_EDGES, age) if age is not None else None
+
+
+def vip_active(user):
+    return bool(user and user['is_vip'] and user['vip_until']
+                and datetime.fromisoformat(str(user['vip_until'])) > datetime.now())
+
+
+def compatible(a, b):
+    """Whether users of classes a and b, each (gender, gender filter), may be paired"""
+    return (a[1] is None or a[1] == b[0]) and (b[1] is None or b[1] == a[0])
+
+
+def queue_name(gender_filter, vip):
+    return f"{gender_filter or 'random'}{' VIP' if vip else ''}"
+
+
+class MatchStats:
+    """Recent time-to-match samples per queue"""
+
+    def __init__(self, samples=MATCH_SAMPLES):
+        self.samples = samples
+        self.queues = {}        # queue name -> deque of seconds
+        self.matches = 0
+
+    def record(self, queue, seconds):
+        self.queues.setdefault(queue, deque(maxlen=self.samples)).append(seconds)
+        self.matches += 1
+
+    def p95(self, queue=None):
+        waits = sorted(self.queues.get(queue, ()) if queue else (w for q in self.queues.values() for w in q))
+        return waits[int(len(waits) * 0.95)] if waits else 0
+
+    def summary(self):
+        """{queue: (samples, p50, p95)}, busiest queue first"""
+        result = {}
+        for queue, waits in sorted(self.queues.items(), key=lambda item: -len(item[1])):
+            ordered = sorted(waits)
+            result[queue] = (len(ordered), ordered[len(ordered) // 2], ordered[int(len(ordered) * 0.95)])
+        return result
+
+
+class MatchIndex:
+    def __init__(self, widen_after=MATCH_WIDEN_AFTER, vip_boost=MATCH_VIP_BOOST,
+                 strict_boost=MATCH_STRICT_BOOST, p95_target=MATCH_P95_TARGET, avoid=None):
+        self.widen_after = widen_after
+        self.avoid = avoid      # avoid(user_id, candidate_id) -> True to skip the candidate
+        self.vip_boost = vip_boost
+        self.strict_boost = strict_boost
+        self.p95_target = p95_target
+        self.buckets = {}       # (gender, gender_filter, country, age bucket, vip) -> {user_id: waiting since}
+        self.keys = {}          # user_id -> bucket key
+        self.genders = set()    # genders seen, for probing when the searcher has no filter
+        self.stats = MatchStats()
+        self.pace = 1.0         # scales widen_after; below 1 while p95 time to match is over target
+        self.probes = 0
+        # Per widening threshold, (since, user_id) in arrival order: users who have not crossed it yet.
+        # Entries of users who left are dropped when they reach the front. None until the first
+        # sweep, so batch and shared mode (which never sweep) keep nothing here.
+        self._crossing = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, user_id):
+        return user_id in self.keys
+
+    def add(self, user_id, gender, gender_filter=None, country=None, age=None, vip=False, since=None):
+        key = (gender, gender_filter, country, age_bucket(age), bool(vip))
+        if self.keys.get(user_id) == key:
+            return  # searching again: keeps the place in the bucket
+        previous = self.remove(user_id)
+        since = previous or since or time.monotonic()
+        self._insert(key, user_id, since)
+        self.keys[user_id] = key
+        if previous is None and self._crossing is not None:
+            for queue in self._crossing:
+                queue.append((since, user_id))
+        self.genders.add(gender)
+
+    def _insert(self, key, user_id, since):
+        """Put the user in the bucket keeping it in order of waiting since"""
+        waiters = self.buckets.setdefault(key, {})
+        if not waiters or next(reversed(waiters.values())) <= since:
+            waiters[user_id] = since
+            return
+        # An older search moving to another bucket (profile changed while waiting): rare, so rebuild
+        entries = sorted([*waiters.items(), (user_id, since)], key=lambda entry: entry[1])
+        waiters.clear()
+        waiters.update(entries)
+
+    def waiting_since(self, user_id):
+        key = self.keys.get(user_id)
+        return self.buckets[key][user_id] if key is not None else None
+
+    def remove(self, user_id):
+        """Take a user out of the index; returns when they started waiting, or None"""
+        key = self.keys.pop(user_id, None)
+        if key is None:
+            return None
+        bucket = self.buckets[key]
+        since = bucket.pop(user_id)
+        if not bucket:
+            del self.buckets[key]
+        return since
+
+    def expired(self, cutoff):
+        """Users waiting since before cutoff (a monotonic time)"""
+        stale = []
+        for waiters in self.buckets.values():
+            for user_id, since in waiters.items():
+                if since >= cutoff:
+                    break   # arrival order: everyone after waited less
+                stale.append(user_id)
+        return stale
+
+    def record_match(self, user_id, gender_filter=None, vip=False, now=None):
+        """Record how long the user waited for this match (0 if they were not waiting)"""
+        key = self.keys.get(user_id)
+        if key is None:
+            self.stats.record(queue_name(gender_filter, vip), 0.0)
+        else:
+            now = time.monotonic() if now is None else now
+            self.stats.record(queue_name(key[1], key[4]), now - self.buckets[key][user_id])
+        if self.stats.matches % PACE_EVERY == 0:
+            p95 = self.stats.p95()
+            self.pace = min(1.0, self.p95_target / p95) if p95 else 1.0
+
+    def find(self, user_id, gender, gender_filter=None, country=None, age=None, since=None, now=None):
+        """Best waiting partner for the user, or None; the partner stays in the index"""
+        now = time.monotonic() if now is None else now
+        own_wait = now - since if since is not None else 0
+        return self._find(user_id, gender, gender_filter, country, age_bucket(age), own_wait, now)
+
+    def sweep(self, now=None):
+        """Pairs for waiters who crossed a widening threshold since the last sweep
+
+        Returns [(user_id, partner_id)] with nobody in two pairs; the index is
+        left untouched, like batch().
+        """
+        now = time.monotonic() if now is None else now
+        if self._crossing is None:
+            # First sweep: everyone already waiting, oldest first
+            waiting = sorted((since, user_id) for waiters in self.buckets.values() for user_id, since in waiters.items())
+            self._crossing = [deque(waiting) for _ in self.widen_after]
+        pairs = []
+        taken = set()
+        for after, queue in zip(self.widen_after, self._crossing):
+            reached = now - after * self.pace
+            while queue and queue[0][0] <= reached:
+                since, user_id = queue.popleft()
+                key = self.keys.get(user_id)
+                if key is None or user_id in taken or self.buckets[key][user_id] != since:
+                    continue    # left (or searched again) since this entry was queued
+                partner_id = self._find(user_id, key[0], key[1], key[2], key[3], now - since, now, taken)
+                if partner_id is not None:
+                    taken.update((user_id, partner_id))
+                    pairs.append((user_id, partner_id))
+        return pairs
+
+    def _find(self, user_id, gender, gender_filter, country, bucket, own_wait, now, taken=()):
+        for step in range(len(self.widen_after) + 1):
+            best, best_priority = None, None
+            for key in self._keys_for(step, gender, gender_filter, country, bucket):
+                waiters = self.buckets.get(key)
+                self.probes += 1
+                if not waiters:
+                    continue
+                for candidate, candidate_since in waiters.items():
+                    # Only the searcher, users paired earlier in this sweep and the
+                    # searcher's recent partners can be ahead of the real head
+                    if (candidate != user_id and candidate not in taken
+                            and not (self.avoid and self.avoid(user_id, candidate))):
+                        break
+                else:
+                    continue
+                priority = candidate_since - self._boost(key)
+                if best_priority is not None and priority >= best_priority:
+                    continue
+                if step and max(own_wait, now - candidate_since) < self.widen_after[step - 1] * self.pace:
+                    # The head is the longest waiter: nobody behind it qualifies either
+                    continue
+                best, best_priority = candidate, priority
+            if best is not None:
+                return best
+        return None
+
+    def batch(self):
+        """Pair as many waiting users as possible; returns [(user_id, partner_id)], index untouched"""
+        # Per class: everyone by priority, and the same split by (country, age bucket)
+        ranked = {}
+        for key, waiters in self.buckets.items():
+            boost = self._boost(key)
+            ranked.setdefault(key[:2], []).extend((since - boost, user_id, key[2:4]) for user_id, since in waiters.items())
+        classes = {}
+        for cls, entries in ranked.items():
+            entries.sort()
+            local = {}
+            for _, user_id, place in entries:
+                local.setdefault(place, deque()).append(user_id)
+            classes[cls] = (deque(user_id for _, user_id, _ in entries), local)
+
+        matched = set()
+        pairs = []
+
+        def take(queue, user_id):
+            while queue and queue[0] in matched:
+                queue.popleft()
+            for candidate in queue:
+                if candidate not in matched and not (self.avoid and self.avoid(user_id, candidate)):
+                    return candidate
+            return None
+
+        # Filtered users first with each other, then with unfiltered ones, then unfiltered
+        # with each other: a filtered user's few partners are never spent on someone who
+        # could have paired with anybody
+        for own_filtered, partner_filtered in ((True, True), (True, False), (False, False)):
+            options = {a: [b for b in classes if (b[1] is not None) == partner_filtered and compatible(a, b)]
+                       for a in classes if (a[1] is not None) == own_filtered}
+            for _, user_id, _ in sorted(entry for cls in options for entry in ranked[cls]):
+                if user_id in matched:
+                    continue
+                matched.add(user_id)
+                place = self.keys[user_id][2:4]
+                for other in options[self.keys[user_id][:2]]:
+                    other_everyone, other_local = classes[other]
+                    partner_id = take(other_local.get(place, ()), user_id) or take(other_everyone, user_id)
+                    if partner_id is not None:
+                        matched.add(partner_id)
+                        pairs.append((user_id, partner_id))
+                        break
+                else:
+                    # Nobody left for this user in this round
+                    matched.discard(user_id)
+        return pairs
+
+    def _boost(self, key):
+        return (self.vip_boost if key[4] else 0) + (self.strict_boost if key[1] else 0)
+
+    def _keys_for(self, step, gender, gender_filter, country, bucket):
+        genders = (gender_filter,) if gender_filter else self.genders
+        filters = (None, gender)
+        if step == 0:
+            return [(g, f, country, bucket, v) for g in genders for f in filters for v in (False, True)]
+        if step == 1:
+            if bucket is None:
+                return []
+            return [(g, f, country, b, v) for g in genders for f in filters
+                    for b in (bucket - 1, bucket + 1) for v in (False, True)]
+        # Anyone compatible: every bucket on the right gender and filter (bounded by attribute combinations)
+        return [key for key in self.buckets if key[0] in genders and key[1] in filters]
@@ -0,0 +1,160 @@
+"""
+Moderation pipeline for relayed messages
+
+Rules are compiled once at startup:
+  * pattern rules (links, phone numbers, @mentions) become a single regex
+    with one named group per rule, so one search covers all of them;
+  * banned words become an Aho-Corasick automaton, so scanning costs the
+    same whether 10 or 100,000 words are loaded;
+  * Telegram's own message entities (url, text_link, mention, ...) are
+    mapped to rules, which also catches links hidden behind text.
+
+Text and captions are checked in one pass each; every hit is counted per rule.
+
+Configuration:
+    MODERATION_RULES   comma separated rules to enable (default: links)
+    BANNED_WORDS_FILE  one word or phrase per line; enables banned_words
+"""
+
+import os
+import re
+from collections import Counter, deque, namedtuple
+
+Rule = namedtuple('Rule', ['name', 'message'])
+
+RULES = {
+    'links': Rule('links', "❌ Links are not allowed in chats."),
+    'phones': Rule('phones', "❌ Sharing phone numbers is not allowed in chats."),
+    'mentions': Rule('mentions', "❌ Sharing usernames is not allowed in chats."),
+    'banned_words': Rule('banned_words', "❌ Your message contains words that are not allowed."),
+}
+
+PATTERNS = {
+    'links': r'https?://|www\.|t\.me/|\b[a-z0-9-]+\.(?:com|org|net|io|me|ly|xyz|in|ru)\b',
+    'phones': r'(?<!\d)\+?\d(?:[\s-]?\d){8,14}(?!\d)',
+    'mentions': r'(?<![\w@])@[a-z][a-z0-9_]{4,31}\b',
+}
+
+# Telegram entity types and the rule each one trips
+ENTITY_RULES = {
+    'url': 'links',
+    'text_link': 'links',
+    'email': 'links',
+    'phone_number': 'phones',
+    'mention': 'mentions',
+    'text_mention': 'mentions',
+}
+
+
+class _WordAutomaton:
+    """Aho-Corasick automaton over lowercased words; matches must sit on word boundaries"""
+
+    def __init__(self, words):
+        self._goto = [{}]
+        self._fail = [0]
+        self._length = [0]      # length of the word ending exactly at this state (0 = none)
+        self._output = [0]      # nearest suffix state that ends a word (0 = none)
+        for word in words:
+            self._add(word)
+        self._build()
+
+    def _add(self, word):
+        state = 0
+        for char in word:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._length.append(0)
+                self._output.append(0)
+            state = nxt
+        self._length[state] = len(word)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0) if state else 0
+                self._fail[nxt] = target
+                self._output[nxt] = target if self._length[target] else self._output[target]
+
+    def search(self, text):
+        goto, fail = self._goto, self._fail
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            match = state if self._length[state] else self._output[state]
+            while match:
+                if self._on_boundary(text, index, self._length[match]):
+                    return True
+                match = self._output[match]
+        return False
+
+    @staticmethod
+    def _on_boundary(text, end, size):
+        start = end - size + 1
+        return ((start == 0 or not text[start - 1].isalnum())
+                and (end + 1 == len(text) or not text[end + 1].isalnum()))
+
+
+class ModerationPipeline:
+    def __init__(self, rules=('links',), banned_words=()):
+        self.rules = {name: RULES[name] for name in rules if name in RULES}
+        self.hits = Counter()
+        self._pattern = None
+        self._words = None
+        self._entity_rules = {t: r for t, r in ENTITY_RULES.items() if r in self.rules}
+        self.compile(banned_words)
+
+    @classmethod
+    def from_env(cls):
+        rules = [r.strip() for r in os.getenv('MODERATION_RULES', 'links').split(',') if r.strip()]
+        words = []
+        path = os.getenv('BANNED_WORDS_FILE')
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                words = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            if 'banned_words' not in rules:
+                rules.append('banned_words')
+        return cls(rules, words)
+
+    def compile(self, banned_words=()):
+        """Build the combined regex and the word automaton; call again after changing rules"""
+        groups = [f"(?P<{name}>{PATTERNS[name]})" for name in self.rules if name in PATTERNS]
+        self._pattern = re.compile('|'.join(groups), re.IGNORECASE) if groups else None
+        words = {w.lower() for w in banned_words}
+        self._words = _WordAutomaton(words) if words and 'banned_words' in self.rules else None
+
+    def check_text(self, text, entities=()):
+        """Return the first Rule the text (or its entities) violates, or None"""
+        for entity in entities or ():
+            name = self._entity_rules.get(entity.type)
+            if name:
+                return self._hit(name)
+        if not text:
+            return None
+        if self._pattern is not None:
+            match = self._pattern.search(text)
+            if match:
+                return self._hit(match.lastgroup)
+        if self._words is not None and self._words.search(text.lower()):
+            return self._hit('banned_words')
+        return None
+
+    def check_message(self, message):
+        if message.text:
+            return self.check_text(message.text, message.entities)
+        return self.check_text(message.caption, message.caption_entities)
+
+    def _hit(self, name):
+        self.hits[name] += 1
+        return self.rules[name]
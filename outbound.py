@@ -0,0 +1,324 @@
+"""
+Outbound Telegram send scheduler
+
+Every send goes through one scheduler that respects Telegram's limits:
+a global token bucket (~30 msg/s per bot) plus a bucket per chat (~1 msg/s
+in private chats, 20 msg/min in groups). Sends are ordered by priority class
+(relay > match notices > admin replies > log group > broadcast), lower classes
+must leave part of the global bucket free for higher ones, and RetryAfter (429)
+or transient network errors are retried with backoff.
+
+A 429 does not say which limit was hit. In a group it is most likely the
+group's own limit, so only that chat waits. Private chats are already paced
+well under their limit, so a 429 there means the bot as a whole is flooding.
+The global bucket then waits out retry_after and its rate is halved, and
+each successful send wins back a little of the configured rate.
+
+Within one chat, sends of the same priority are delivered in submission order.
+"""
+
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_RELAY = 0
+PRIORITY_MATCH = 1
+PRIORITY_ADMIN = 2
+PRIORITY_LOG = 3
+PRIORITY_BROADCAST = 4
+
+# Share of the global bucket each class must leave untouched for higher classes
+PRIORITY_RESERVE = {
+    PRIORITY_RELAY: 0.0,
+    PRIORITY_MATCH: 0.0,
+    PRIORITY_ADMIN: 0.2,
+    PRIORITY_LOG: 0.4,
+    PRIORITY_BROADCAST: 0.6,
+}
+
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))        # messages per second
+OUTBOUND_PRIVATE_RATE = float(os.getenv('OUTBOUND_PRIVATE_RATE', '1'))      # per private chat, per second
+OUTBOUND_GROUP_RATE = float(os.getenv('OUTBOUND_GROUP_RATE', '20')) / 60    # per group, per second
+OUTBOUND_MAX_IN_FLIGHT = int(os.getenv('OUTBOUND_MAX_IN_FLIGHT', '64'))
+OUTBOUND_MAX_PENDING_PER_CHAT = int(os.getenv('OUTBOUND_MAX_PENDING_PER_CHAT', '5000'))
+OUTBOUND_MAX_ATTEMPTS = 5
+
+# Global rate after a flood wait: never below this share of the configured rate,
+# and this share of it recovered per successful send
+OUTBOUND_MIN_RATE_SHARE = 0.1
+OUTBOUND_RECOVERY_SHARE = 0.01
+
+
+class OutboundQueueFull(Exception):
+    pass
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:     # a block moves updated into the future
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, reserve=0.0):
+        """Seconds until one token can be taken while leaving `reserve` tokens behind"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        needed = 1 + reserve
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Take no token for `seconds`; refilling starts from empty when the block lifts"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.blocked_until
+
+    def is_idle(self):
+        now = time.monotonic()
+        self._refill(now)
+        return now >= self.blocked_until and self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'chat_id', 'func', 'args', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, priority, seq, chat_id, func, args, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler:
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, private_rate=OUTBOUND_PRIVATE_RATE,
+                 group_rate=OUTBOUND_GROUP_RATE, max_in_flight=OUTBOUND_MAX_IN_FLIGHT):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.max_in_flight = max_in_flight
+        self._seq = itertools.count()
+        self._pending = {}      # chat_id -> heap of jobs
+        self._buckets = {}      # chat_id -> TokenBucket
+        self._timers = {}       # chat_id -> TimerHandle while its bucket refills
+        self._in_flight = set()
+        self._ready = []        # heap of (priority, seq, chat_id) for chats that may send now
+        self._wakeup = None
+        self._dispatcher = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.flood_waits = 0
+
+    # ---- lifecycle -------------------------------------------------------
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        for chat_id in list(self._pending):
+            self._schedule_chat(chat_id)
+
+    async def stop(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for jobs in self._pending.values():
+            for job in jobs:
+                if not job.future.done():
+                    job.future.cancel()
+        self._pending.clear()
+        self._ready.clear()
+
+    # ---- public API ------------------------------------------------------
+
+    def submit(self, priority, chat_id, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) as a send to chat_id; returns a Future with its result"""
+        future = asyncio.get_running_loop().create_future()
+        jobs = self._pending.setdefault(chat_id, [])
+        if len(jobs) >= OUTBOUND_MAX_PENDING_PER_CHAT:
+            future.set_exception(OutboundQueueFull(f"Too many pending sends for chat {chat_id}"))
+            return future
+        heapq.heappush(jobs, _Job(priority, next(self._seq), chat_id, func, args, kwargs, future))
+        self._schedule_chat(chat_id)
+        return future
+
+    def post(self, priority, chat_id, func, *args, **kwargs):
+        """Fire-and-forget submit(); failures are logged instead of raised"""
+        future = self.submit(priority, chat_id, func, *args, **kwargs)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Outbound send failed: {future.exception()}")
+
+    async def call(self, priority, chat_id, func, *args, **kwargs):
+        """submit() and wait for the Bot API result (exceptions are re-raised)"""
+        return await self.submit(priority, chat_id, func, *args, **kwargs)
+
+    def stats(self):
+        return {
+            'pending': sum(len(jobs) for jobs in self._pending.values()),
+            'in_flight': len(self._in_flight),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'flood_waits': self.flood_waits,
+            'global_rate': round(self.global_bucket.rate, 2),
+        }
+
+    # ---- scheduling ------------------------------------------------------
+
+    def _bucket_for(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1.0)
+            else:
+                bucket = TokenBucket(self.private_rate, 3.0)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule_chat(self, chat_id):
+        """Make the chat's next job visible to the dispatcher once its bucket allows it"""
+        if chat_id in self._in_flight or chat_id in self._timers or self._wakeup is None:
+            return
+        jobs = self._pending.get(chat_id)
+        if not jobs:
+            self._pending.pop(chat_id, None)
+            bucket = self._buckets.get(chat_id)
+            if bucket and bucket.is_idle():
+                del self._buckets[chat_id]
+            return
+        wait = self._bucket_for(chat_id).wait_time()
+        if wait > 0:
+            loop = asyncio.get_running_loop()
+            self._timers[chat_id] = loop.call_later(wait, self._timer_fired, chat_id)
+            return
+        head = jobs[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    def _timer_fired(self, chat_id):
+        self._timers.pop(chat_id, None)
+        self._schedule_chat(chat_id)
+
+    def _is_current(self, entry):
+        priority, seq, chat_id = entry
+        jobs = self._pending.get(chat_id)
+        return (chat_id not in self._in_flight and jobs
+                and jobs[0].priority == priority and jobs[0].seq == seq)
+
+    async def _dispatch(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._ready and len(self._in_flight) < self.max_in_flight:
+                entry = self._ready[0]
+                if not self._is_current(entry):
+                    heapq.heappop(self._ready)
+                    continue
+                priority, _, chat_id = entry
+                reserve = PRIORITY_RESERVE.get(priority, 0.0) * (self.global_bucket.capacity - 1)
+                wait = self.global_bucket.wait_time(reserve)
+                if wait > 0:
+                    # Sleep, but wake early if something more urgent arrives
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+                    continue
+                heapq.heappop(self._ready)
+                job = heapq.heappop(self._pending[chat_id])
+                self.global_bucket.take()
+                self._bucket_for(chat_id).take()
+                self._in_flight.add(chat_id)
+                asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        requeue_after = None
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+            self.sent += 1
+            if self.global_bucket.rate < self.global_rate:
+                self.global_bucket.rate = min(self.global_rate,
+                                              self.global_bucket.rate + self.global_rate * OUTBOUND_RECOVERY_SHARE)
+            if not job.future.done():
+                job.future.set_result(result)
+        except RetryAfter as e:
+            requeue_after = float(getattr(e.retry_after, 'total_seconds', lambda: e.retry_after)())
+            self._bucket_for(job.chat_id).block(requeue_after)
+            if job.chat_id > 0:
+                self._flood_wait(requeue_after)
+        except TimedOut as e:
+            # The request may have reached Telegram; retrying could duplicate the message
+            self._fail(job, e)
+        except NetworkError:
+            requeue_after = min(30.0, 0.5 * (2 ** job.attempts))
+            self._bucket_for(job.chat_id).block(requeue_after)
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            if requeue_after is not None:
+                job.attempts += 1
+                if job.attempts >= OUTBOUND_MAX_ATTEMPTS:
+                    self._fail(job, RuntimeError(f"Gave up after {job.attempts} attempts"))
+                else:
+                    self.retried += 1
+                    logger.warning(f"Retrying send to {job.chat_id} in {requeue_after:.1f}s")
+                    # Same seq, so it stays ahead of later sends to this chat
+                    heapq.heappush(self._pending.setdefault(job.chat_id, []), job)
+            self._in_flight.discard(job.chat_id)
+            self._schedule_chat(job.chat_id)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def _flood_wait(self, seconds):
+        """Bot-wide 429: stop every send for `seconds`, then resume at a reduced rate"""
+        self.flood_waits += 1
+        self.global_bucket.block(seconds)
+        self.global_bucket.rate = max(self.global_rate * OUTBOUND_MIN_RATE_SHARE, self.global_bucket.rate / 2)
+        logger.warning(f"Flood wait of {seconds:.1f}s, global rate now {self.global_bucket.rate:.1f}/s")
+
+    def _fail(self, job, error):
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
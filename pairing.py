@@ -0,0 +1,286 @@
+"""
+In-memory pairing registry: who is chatting with whom, and who is waiting
+
+The registry is the source of truth for routing, so relaying a message
+resolves the partner with a dict lookup. Every change is written behind to
+the database (users.chat_partner / looking_for_chat and chat_sessions) by a
+background task, in the order it happened, and the registry is rebuilt
+from the active chat_sessions rows at startup. While the database is down
+the writes go to its journal (see write_journal.py); without a journal they
+stay queued, in order, until it is back.
+
+In multi-worker mode (shared=True) other workers look for partners in the
+database, so waiting users are written through immediately and a partner
+is claimed there with a conditional update. Pairs that span two workers
+are announced to the other worker by the bot (see TelegramBot.announce_pairing).
+
+Waiting users are held in a MatchIndex (see matching.py), which prefers
+partners from the same country and age range, widens with wait time
+(re-checked for users already waiting by widen_waiting) and serves the
+highest priority (wait, VIP, filter) first. Users are not
+matched again with anyone in their recent partners (see recent_partners.py).
+The database claim used in shared mode matches on gender only, VIPs first,
+then longest wait.
+
+The registry also remembers when each paired user last sent a message, so
+the bot's reaper (TelegramBot.reap_loop) can end idle sessions and expire
+searches nobody answered.
+
+Configuration:
+    SESSION_IDLE_TIMEOUT  seconds without messages before a chat is ended (default 1800)
+    WAITING_TIMEOUT       seconds before an unanswered search expires (default 1800)
+    REAPER_INTERVAL       seconds between reaper sweeps (default 60)
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from matching import MatchIndex, vip_active
+from recent_partners import RecentPartners
+
+logger = logging.getLogger(__name__)
+
+SESSION_IDLE_TIMEOUT = float(os.getenv('SESSION_IDLE_TIMEOUT', '1800'))
+WAITING_TIMEOUT = float(os.getenv('WAITING_TIMEOUT', '1800'))
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', '60'))
+WRITE_RETRY_INTERVAL = 1.0     # seconds between write-behind attempts while the database is down
+
+
+class PairingRegistry:
+    def __init__(self, db, shared=False):
+        self.db = db
+        self.shared = shared
+        self.partners = {}      # user_id -> partner_id, stored in both directions
+        self.last_active = {}   # paired user_id -> monotonic time of their last message
+        self.recent = RecentPartners()
+        self.waiting = MatchIndex(avoid=self.recent.avoid)   # waiting users by gender, country and age (see matching.py)
+        self.persisted = 0
+        self._writes = deque()  # (Database method, args) not yet written
+        self._wakeup = None
+        self._flusher = None
+
+    # ---- lifecycle -------------------------------------------------------
+
+    def load(self):
+        """Rebuild pairs from active chat_sessions and waiting users from looking_for_chat"""
+        self.partners.clear()
+        self.last_active.clear()
+        self.recent = RecentPartners.from_env()
+        self.recent.load()
+        self.waiting = MatchIndex(avoid=self.recent.avoid)
+        for user1_id, user2_id in self.db.get_active_sessions():
+            # Sessions come oldest first; a user found in a later session belongs to that one
+            self._forget(user1_id)
+            self._forget(user2_id)
+            self.partners[user1_id] = user2_id
+            self.partners[user2_id] = user1_id
+        # Loaded sessions count as active from now on
+        now = time.monotonic()
+        self.last_active = dict.fromkeys(self.partners, now)
+        for user in self.db.get_waiting_users():
+            if user['user_id'] not in self.partners:
+                # Oldest first, so each bucket stays in arrival order
+                since = now - max(0.0, float(user['waited'] or 0))
+                self.waiting.add(user['user_id'], user['gender'], None, user['country'], user['age'],
+                                 vip_active(user), since)
+        logger.info(f"Pairing registry loaded: {len(self.partners) // 2} pairs, {len(self.waiting)} waiting")
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stop the background writer and persist everything still queued"""
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        self._wakeup = None
+        self._drain()
+        if self._writes:
+            logger.error(f"Database unavailable: {len(self._writes)} write-behind changes not persisted")
+        self.recent.save()
+
+    # ---- lookups ---------------------------------------------------------
+
+    def partner_of(self, user_id):
+        return self.partners.get(user_id)
+
+    def is_waiting(self, user_id):
+        return user_id in self.waiting
+
+    def idle_pairs(self, timeout=SESSION_IDLE_TIMEOUT):
+        """(user_id, partner_id) of every pair where neither side has sent anything for timeout seconds"""
+        cutoff = time.monotonic() - timeout
+        return [
+            (user_id, partner_id) for user_id, partner_id in self.partners.items()
+            if user_id < partner_id and self._last_activity(user_id, partner_id) < cutoff
+        ]
+
+    def is_idle(self, user_id, timeout=SESSION_IDLE_TIMEOUT):
+        partner_id = self.partners.get(user_id)
+        return partner_id is not None and self._last_activity(user_id, partner_id) < time.monotonic() - timeout
+
+    def _last_activity(self, user_id, partner_id):
+        return max(self.last_active.get(user_id, 0), self.last_active.get(partner_id, 0))
+
+    def find_partner(self, user_id, gender=None, gender_filter=None, country=None, age=None, vip=False):
+        """Take the best compatible waiting user off the waiting list, or None"""
+        if self.shared:
+            candidate = self.db.claim_chat_partner(user_id, gender_filter)
+        else:
+            since = self.waiting.waiting_since(user_id)
+            candidate = self.waiting.find(user_id, gender, gender_filter, country, age, since)
+        if candidate is None:
+            return None
+        if candidate in self.waiting:
+            self.waiting.record_match(candidate)
+        self.waiting.record_match(user_id, gender_filter, vip)
+        if self.shared:
+            self.waiting.remove(candidate)
+        else:
+            # Claimed: same effect as the database claim in shared mode
+            self.remove_waiting(candidate)
+        return candidate
+
+    # ---- changes ---------------------------------------------------------
+
+    def add_waiting(self, user_id, gender, gender_filter=None, country=None, age=None, vip=False):
+        self.waiting.add(user_id, gender, gender_filter, country, age, vip)
+        self._write_waiting(user_id, True)
+
+    def remove_waiting(self, user_id):
+        if self.waiting.remove(user_id) is None:
+            return False
+        self._write_waiting(user_id, False)
+        return True
+
+    def pair(self, user_id, partner_id):
+        self.waiting.remove(user_id)
+        self.waiting.remove(partner_id)
+        self._link(user_id, partner_id)
+        self._persist('start_chat_session', user_id, partner_id)
+
+    def match_waiting(self):
+        """Pair the whole waiting pool at once (batch mode); returns the new (user_id, partner_id) pairs"""
+        return self._pair_all(self.waiting.batch())
+
+    def widen_waiting(self):
+        """Pair waiters whose preferences just widened (instant mode); returns the new pairs"""
+        return self._pair_all(self.waiting.sweep())
+
+    def _pair_all(self, pairs):
+        for user_id, partner_id in pairs:
+            self.waiting.record_match(user_id)
+            self.waiting.record_match(partner_id)
+            self.waiting.remove(user_id)
+            self.waiting.remove(partner_id)
+            self._link(user_id, partner_id)
+        if pairs:
+            self._persist('start_chat_sessions', pairs)
+        return pairs
+
+    def expire_waiting(self, timeout=WAITING_TIMEOUT):
+        """Drop searches older than timeout; returns their users.
+
+        Their looking_for_chat flags are cleared by the caller in one
+        set-based update (Database.clear_stale_waiting), not one by one.
+        """
+        stale = self.waiting.expired(time.monotonic() - timeout)
+        for user_id in stale:
+            self.waiting.remove(user_id)
+        return stale
+
+    def touch(self, user_id):
+        """Note that a paired user sent (or was sent) a message"""
+        if user_id in self.partners:
+            self.last_active[user_id] = time.monotonic()
+
+    def unpair(self, user_id):
+        """End the user's chat; returns the former partner or None"""
+        partner_id = self._forget(user_id)
+        if partner_id is not None:
+            self._persist('end_chat_session', user_id, partner_id)
+        return partner_id
+
+    def adopt(self, user_id, partner_id):
+        """Record a pair another worker created (and persists)"""
+        self.waiting.remove(user_id)
+        self._link(user_id, partner_id)
+
+    def drop(self, user_id):
+        """Forget a pair another worker ended (and persists)"""
+        return self._forget(user_id)
+
+    def _link(self, user_id, partner_id):
+        self.partners[user_id] = partner_id
+        self.partners[partner_id] = user_id
+        self.last_active[user_id] = self.last_active[partner_id] = time.monotonic()
+        self.recent.add(user_id, partner_id)
+
+    def _forget(self, user_id):
+        partner_id = self.partners.pop(user_id, None)
+        self.last_active.pop(user_id, None)
+        if partner_id is not None and self.partners.get(partner_id) == user_id:
+            del self.partners[partner_id]
+            self.last_active.pop(partner_id, None)
+        return partner_id
+
+    # ---- write-behind ----------------------------------------------------
+
+    def _write_waiting(self, user_id, looking):
+        if self.shared:
+            self.db.set_user_looking_for_chat(user_id, looking)
+        else:
+            self._persist('set_user_looking_for_chat', user_id, looking)
+
+    def _persist(self, method, *args):
+        self._writes.append((method, args))
+        if self._wakeup is None:
+            # Not started (scripts, shutdown): write through
+            self._drain()
+        else:
+            self._wakeup.set()
+
+    def _drain(self):
+        while self._writes and self._write_next():
+            pass
+
+    def _write_next(self):
+        """Write the oldest queued change; False when the database is down and it stays queued"""
+        method, args = self._writes[0]
+        try:
+            getattr(self.db, method)(*args)
+        except Exception as e:
+            if not self.db.available:
+                # Cut off by the outage before it was written or journaled
+                return False
+            logger.error(f"Write-behind {method}{args} failed: {e}")
+        else:
+            if not self.db.available and self.db.journal is None:
+                # Skipped with nowhere to journal it; every write-behind change is safe to repeat
+                return False
+            self.persisted += 1
+        self._writes.popleft()
+        return True
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._writes:
+                if not self._write_next():
+                    await asyncio.sleep(WRITE_RETRY_INTERVAL)
+                    continue
+                # Let relays run between writes
+                await asyncio.sleep(0)
+
+    @property
+    def pending_writes(self):
+        return len(self._writes)
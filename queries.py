@@ -0,0 +1,397 @@
+"""
+Query catalog: every SQL statement the Database class runs, by name.
+
+Statements are written once with a few tokens and compiled per dialect when
+this module is imported:
+    {p}       parameter placeholder (? for SQLite, %s for PostgreSQL)
+    {true}    boolean literals (1/0 for SQLite, TRUE/FALSE for PostgreSQL)
+    {false}
+Where the dialects really differ, a statement is a dict with one text per
+dialect; a dialect without an entry simply has no such statement.
+
+The hot statements in PREPARED are PREPAREd server-side on PostgreSQL, so
+each call only sends EXECUTE name (params) and skips parse/plan.
+"""
+
+import re
+import itertools
+
+SQLITE = 'sqlite'
+POSTGRES = 'postgres'
+
+TOKENS = {
+    SQLITE: {'true': '1', 'false': '0'},
+    POSTGRES: {'true': 'TRUE', 'false': 'FALSE'},
+}
+
+MARKERS = {SQLITE: '?', POSTGRES: '%s'}
+
+STATEMENTS = {
+    # ---- users -----------------------------------------------------------
+    'get_user': 'SELECT * FROM users WHERE user_id = {p}',
+    'add_user': '''
+        INSERT INTO users (user_id, username, first_name, last_name, referred_by)
+        VALUES ({p}, {p}, {p}, {p}, {p})
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = EXCLUDED.username,
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            updated_at = CURRENT_TIMESTAMP
+    ''',
+    'update_terms': '''
+        UPDATE users SET agreed_terms = {p}, updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {p}
+    ''',
+    'insert_user_terms': '''
+        INSERT INTO users (user_id, agreed_terms, profile_completed, created_at, updated_at)
+        VALUES ({p}, {p}, {false}, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO NOTHING
+    ''',
+    'insert_user_profile': '''
+        INSERT INTO users (user_id, gender, country, age, profile_completed, created_at, updated_at)
+        VALUES ({p}, {p}, {p}, {p}, {true}, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO NOTHING
+    ''',
+    'block_user': 'UPDATE users SET is_blocked = {true}, updated_at = CURRENT_TIMESTAMP WHERE user_id = {p}',
+    'unblock_user': 'UPDATE users SET is_blocked = {false}, updated_at = CURRENT_TIMESTAMP WHERE user_id = {p}',
+    'set_vip': '''
+        UPDATE users SET is_vip = {true}, vip_until = {p}, updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {p}
+    ''',
+    'expire_vip': {
+        SQLITE: "UPDATE users SET is_vip = 0 WHERE user_id = ? AND datetime(vip_until) < datetime('now')",
+        POSTGRES: 'UPDATE users SET is_vip = FALSE WHERE user_id = %s AND vip_until < CURRENT_TIMESTAMP',
+    },
+    'increment_referrals': '''
+        UPDATE users SET referral_count = referral_count + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {p}
+    ''',
+    # A search already running keeps its start time; stopping clears it
+    'set_looking_for_chat': '''
+        UPDATE users SET looking_for_chat = {p}, updated_at = CURRENT_TIMESTAMP,
+            search_started_at = CASE
+                WHEN looking_for_chat = {true} AND search_started_at IS NOT NULL THEN search_started_at
+                ELSE CURRENT_TIMESTAMP END
+        WHERE user_id = {p}
+    ''',
+    'update_partner_filter': '''
+        UPDATE users SET partner_filter = {p}, updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {p}
+    ''',
+    'get_all_users': 'SELECT user_id FROM users WHERE is_blocked = {false}',
+    'delete_user': 'DELETE FROM users WHERE user_id = {p}',
+
+    # ---- referrals -------------------------------------------------------
+    'insert_referral_event': '''
+        INSERT INTO referral_events (referrer_id, referred_id) VALUES ({p}, {p})
+        ON CONFLICT (referred_id) DO NOTHING
+    ''',
+    'get_pending_referrals': '''
+        SELECT id, referrer_id FROM referral_events
+        WHERE processed_at IS NULL
+        ORDER BY id
+        LIMIT {p}
+    ''',
+    'claim_referral_event': '''
+        UPDATE referral_events SET processed_at = CURRENT_TIMESTAMP
+        WHERE id = {p} AND processed_at IS NULL
+    ''',
+    # PostgreSQL claims the event and counts it in one statement; SQLite runs
+    # the same two steps in one transaction (see Database.apply_referral)
+    'apply_referral': {
+        POSTGRES: '''
+            WITH claimed AS (
+                UPDATE referral_events SET processed_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND processed_at IS NULL
+                RETURNING referrer_id
+            )
+            UPDATE users SET referral_count = referral_count + 1, updated_at = CURRENT_TIMESTAMP
+            FROM claimed
+            WHERE users.user_id = claimed.referrer_id
+        ''',
+    },
+    'get_referral_counts': 'SELECT user_id, referral_count FROM users WHERE referral_count > 0',
+
+    # ---- matching --------------------------------------------------------
+    # Fallback for shared (multi-worker) mode: VIPs first, then the longest
+    # wait; see matching.py for the in-memory scheduler
+    'find_partner': '''
+        SELECT user_id FROM users
+        WHERE user_id != {p}
+        AND chat_partner IS NULL
+        AND looking_for_chat = {true}
+        AND is_blocked = {false}
+        AND profile_completed = {true}
+        AND agreed_terms = {true}
+        AND gender IS NOT NULL
+        ORDER BY is_vip DESC, search_started_at, user_id
+        LIMIT 1
+    ''',
+    'find_partner_by_gender': '''
+        SELECT user_id FROM users
+        WHERE user_id != {p}
+        AND chat_partner IS NULL
+        AND looking_for_chat = {true}
+        AND is_blocked = {false}
+        AND profile_completed = {true}
+        AND gender = {p}
+        AND agreed_terms = {true}
+        AND gender IS NOT NULL
+        ORDER BY is_vip DESC, search_started_at, user_id
+        LIMIT 1
+    ''',
+    'find_random_partner': '''
+        SELECT user_id FROM users
+        WHERE user_id != {p}
+        AND profile_completed = {true}
+        AND agreed_terms = {true}
+        AND is_blocked = {false}
+        AND chat_partner IS NULL
+        AND looking_for_chat = {true}
+        ORDER BY RANDOM() LIMIT 1
+    ''',
+    'find_random_partner_by_gender': '''
+        SELECT user_id FROM users
+        WHERE user_id != {p}
+        AND profile_completed = {true}
+        AND agreed_terms = {true}
+        AND is_blocked = {false}
+        AND chat_partner IS NULL
+        AND looking_for_chat = {true}
+        AND gender = {p}
+        ORDER BY RANDOM() LIMIT 1
+    ''',
+    # Takes a waiting user out of the pool; rowcount 0 means someone else got there first
+    'claim_waiting_user': '''
+        UPDATE users SET looking_for_chat = {false}, updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {p} AND looking_for_chat = {true} AND chat_partner IS NULL
+    ''',
+    # Reaper: searches older than the given number of seconds, in one statement
+    'clear_stale_waiting': {
+        SQLITE: '''
+            UPDATE users SET looking_for_chat = 0
+            WHERE looking_for_chat = 1 AND chat_partner IS NULL
+            AND search_started_at < datetime('now', '-' || ? || ' seconds')
+        ''',
+        POSTGRES: '''
+            UPDATE users SET looking_for_chat = FALSE
+            WHERE looking_for_chat = TRUE AND chat_partner IS NULL
+            AND search_started_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+        ''',
+    },
+    # waited: seconds since the search started
+    'get_waiting_users': {
+        SQLITE: '''
+            SELECT user_id, gender, country, age, is_vip, vip_until,
+                (julianday('now') - julianday(search_started_at)) * 86400 AS waited
+            FROM users
+            WHERE looking_for_chat = 1 AND chat_partner IS NULL AND is_blocked = 0
+            ORDER BY search_started_at
+        ''',
+        POSTGRES: '''
+            SELECT user_id, gender, country, age, is_vip, vip_until,
+                EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - search_started_at) AS waited
+            FROM users
+            WHERE looking_for_chat = TRUE AND chat_partner IS NULL AND is_blocked = FALSE
+            ORDER BY search_started_at
+        ''',
+    },
+
+    # ---- chat sessions ---------------------------------------------------
+    # PostgreSQL starts and ends a session in one statement each; SQLite runs
+    # the same steps inside one transaction (see Database.start_chat_session)
+    'start_chat_session': {
+        POSTGRES: '''
+            WITH session AS (
+                INSERT INTO chat_sessions (user1_id, user2_id)
+                SELECT {p}, {p}
+                WHERE NOT EXISTS (SELECT 1 FROM users WHERE user_id = {p} AND chat_partner = {p})
+                RETURNING id, user1_id, user2_id
+            )
+            UPDATE users SET
+                chat_partner = CASE WHEN users.user_id = session.user1_id
+                                    THEN session.user2_id ELSE session.user1_id END,
+                active_session_id = session.id,
+                looking_for_chat = FALSE,
+                updated_at = CURRENT_TIMESTAMP
+            FROM session
+            WHERE users.user_id IN (session.user1_id, session.user2_id)
+        ''',
+    },
+    'end_chat_session': {
+        POSTGRES: '''
+            WITH me AS (
+                SELECT user_id, chat_partner, active_session_id FROM users
+                WHERE user_id = {p} AND chat_partner = COALESCE({p}, chat_partner)
+                FOR UPDATE
+            ), closed AS (
+                UPDATE chat_sessions SET ended_at = CURRENT_TIMESTAMP, is_active = FALSE
+                FROM me
+                WHERE chat_sessions.id = me.active_session_id AND chat_sessions.is_active = TRUE
+            ), cleared AS (
+                UPDATE users SET chat_partner = NULL, active_session_id = NULL,
+                    looking_for_chat = FALSE, updated_at = CURRENT_TIMESTAMP
+                FROM me
+                WHERE users.user_id = me.user_id
+                OR (users.user_id = me.chat_partner AND users.chat_partner = me.user_id)
+            )
+            SELECT chat_partner, active_session_id FROM me
+        ''',
+    },
+    'get_active_sessions': 'SELECT user1_id, user2_id FROM chat_sessions WHERE is_active = {true} ORDER BY id',
+    'insert_chat_session': 'INSERT INTO chat_sessions (user1_id, user2_id) VALUES ({p}, {p})',
+    'set_chat_session': '''
+        UPDATE users SET chat_partner = {p}, active_session_id = {p}, looking_for_chat = {false},
+            updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {p}
+    ''',
+    'get_chat_session': 'SELECT chat_partner, active_session_id FROM users WHERE user_id = {p}',
+    'close_chat_session': '''
+        UPDATE chat_sessions SET ended_at = CURRENT_TIMESTAMP, is_active = {false}
+        WHERE id = {p} AND is_active = {true}
+    ''',
+    # Sessions started before users.active_session_id existed can only be found by scanning
+    'close_chat_sessions': '''
+        UPDATE chat_sessions
+        SET ended_at = CURRENT_TIMESTAMP, is_active = {false}
+        WHERE (user1_id = {p} OR user2_id = {p})
+        AND is_active = {true}
+    ''',
+    'clear_chat_partner': '''
+        UPDATE users SET chat_partner = NULL, active_session_id = NULL, looking_for_chat = {false},
+            updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {p}
+    ''',
+    # Clears the partner only while it still points back at the user ending the chat
+    'release_chat_partner': '''
+        UPDATE users SET chat_partner = NULL, active_session_id = NULL, looking_for_chat = {false},
+            updated_at = CURRENT_TIMESTAMP
+        WHERE user_id = {p} AND chat_partner = {p}
+    ''',
+    'backfill_active_sessions': '''
+        UPDATE users SET active_session_id = (
+            SELECT MAX(id) FROM chat_sessions
+            WHERE is_active = {true} AND (user1_id = users.user_id OR user2_id = users.user_id)
+        )
+        WHERE chat_partner IS NOT NULL
+    ''',
+    'backfill_search_started': '''
+        UPDATE users SET search_started_at = updated_at WHERE looking_for_chat = {true}
+    ''',
+    'delete_user_sessions': 'DELETE FROM chat_sessions WHERE user1_id = {p} OR user2_id = {p}',
+
+    # ---- message logs ----------------------------------------------------
+    'log_message': '''
+        INSERT INTO message_logs (sender_id, receiver_id, message_type, message_content)
+        VALUES ({p}, {p}, {p}, {p})
+    ''',
+    'delete_user_messages': 'DELETE FROM message_logs WHERE sender_id = {p} OR receiver_id = {p}',
+    # Ranked full-text search; every word must match. Params: query, user (x3),
+    # since (x2), limit, offset. SQLite uses the FTS5 table kept by triggers,
+    # PostgreSQL the GIN expression index, so both need the exact same expression.
+    'search_messages': {
+        SQLITE: '''
+            SELECT m.id, m.sender_id, m.receiver_id, m.message_type,
+                   snippet(message_logs_fts, 0, '«', '»', '…', 16), m.sent_at
+            FROM message_logs_fts JOIN message_logs m ON m.id = message_logs_fts.rowid
+            WHERE message_logs_fts MATCH ?
+              AND (? IS NULL OR m.sender_id = ? OR m.receiver_id = ?)
+              AND (? IS NULL OR m.sent_at >= ?)
+            ORDER BY message_logs_fts.rank, m.id DESC
+            LIMIT ? OFFSET ?
+        ''',
+        POSTGRES: '''
+            SELECT m.id, m.sender_id, m.receiver_id, m.message_type,
+                   ts_headline('simple', m.message_content, q, 'StartSel=«, StopSel=», MaxWords=16, MinWords=8'),
+                   m.sent_at
+            FROM message_logs m, plainto_tsquery('simple', %s) q
+            WHERE to_tsvector('simple', COALESCE(m.message_content, '')) @@ q
+              AND (%s IS NULL OR m.sender_id = %s OR m.receiver_id = %s)
+              AND (%s IS NULL OR m.sent_at >= %s)
+            ORDER BY ts_rank(to_tsvector('simple', COALESCE(m.message_content, '')), q) DESC, m.id DESC
+            LIMIT %s OFFSET %s
+        ''',
+    },
+
+    # ---- admins and force join -------------------------------------------
+    'is_admin': 'SELECT 1 FROM admins WHERE user_id = {p}',
+    'add_admin': 'INSERT INTO admins (user_id, promoted_by) VALUES ({p}, {p}) ON CONFLICT (user_id) DO NOTHING',
+    'remove_admin': 'DELETE FROM admins WHERE user_id = {p}',
+    'get_admins': 'SELECT * FROM admins',
+    'add_force_join_group': '''
+        INSERT INTO force_join_groups (group_id, group_link, added_by)
+        VALUES ({p}, {p}, {p})
+        ON CONFLICT (group_id) DO UPDATE SET
+            group_link = EXCLUDED.group_link,
+            added_by = EXCLUDED.added_by,
+            added_at = CURRENT_TIMESTAMP
+    ''',
+    'remove_force_join_group': 'DELETE FROM force_join_groups WHERE group_id = {p}',
+    'get_force_join_groups': 'SELECT * FROM force_join_groups',
+
+    # ---- statistics ------------------------------------------------------
+    'count_agreed_users': 'SELECT COUNT(*) FROM users WHERE agreed_terms = {true}',
+    'count_agreed_users_by_gender': 'SELECT COUNT(*) FROM users WHERE gender = {p} AND agreed_terms = {true}',
+    'count_users_in_chat': 'SELECT COUNT(*) FROM users WHERE chat_partner IS NOT NULL',
+    'count_messages': 'SELECT COUNT(*) FROM message_logs',
+    'count_vip_users': {
+        SQLITE: "SELECT COUNT(*) FROM users WHERE is_vip = 1 AND datetime(vip_until) > datetime('now')",
+        POSTGRES: 'SELECT COUNT(*) FROM users WHERE is_vip = TRUE AND vip_until > CURRENT_TIMESTAMP',
+    },
+    'count_blocked_users': 'SELECT COUNT(*) FROM users WHERE is_blocked = {true}',
+    'count_looking_by_gender': 'SELECT COUNT(*) FROM users WHERE looking_for_chat = {true} AND gender = {p}',
+    'count_completed_profiles': 'SELECT COUNT(*) FROM users WHERE profile_completed = {true}',
+    'sum_referrals': 'SELECT SUM(referral_count) FROM users',
+}
+
+# Statements on the relay/matching hot path, PREPAREd on PostgreSQL
+PREPARED = (
+    'get_user',
+    'find_partner',
+    'find_partner_by_gender',
+    'start_chat_session',
+    'end_chat_session',
+    'log_message',
+)
+
+# Writes nobody reads back on the hot path; the tuned SQLite writer may
+# commit them with a later batch instead of making the caller wait
+DEFERRABLE = (
+    'log_message',
+)
+
+
+class QueryCatalog:
+    """All statements compiled for one dialect"""
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.sql = {}           # name -> statement with driver placeholders
+        self.prepare_sql = {}   # name -> PREPARE statement (PostgreSQL only)
+        self.execute_sql = {}   # name -> EXECUTE statement with driver placeholders
+        for name, text in STATEMENTS.items():
+            if isinstance(text, dict):
+                text = text.get(dialect)
+                if text is None:
+                    continue
+            text = ' '.join(text.split())
+            self.sql[name] = self._compile(text, lambda: MARKERS[dialect])
+            if dialect == POSTGRES and name in PREPARED:
+                counter = itertools.count(1)
+                body = self._compile(text, lambda: f"${next(counter)}")
+                params = next(counter) - 1
+                self.prepare_sql[name] = f"PREPARE {name} AS {body}"
+                if params:
+                    self.execute_sql[name] = f"EXECUTE {name} ({', '.join(['%s'] * params)})"
+                else:
+                    self.execute_sql[name] = f"EXECUTE {name}"
+
+    def _compile(self, text, marker):
+        text = re.sub(r'\{p\}', lambda _: marker(), text)
+        return text.format(**TOKENS[self.dialect])
+
+    def is_prepared(self, name):
+        return name in self.execute_sql
+
+
+CATALOGS = {dialect: QueryCatalog(dialect) for dialect in (SQLITE, POSTGRES)}
@@ -0,0 +1,142 @@
+"""
+Recent partners: who each user was last paired with, so matching can skip them
+
+Each user gets a fixed-size ring of their last RECENT_PARTNERS_SIZE partners.
+The rings are slots in one flat array('q'), so a user costs SIZE * 8 bytes
+plus one dict entry, and a membership test reads at most SIZE integers.
+At most RECENT_PARTNERS_USERS users are kept; the one matched least
+recently gives up their slot first.
+
+The history is saved to RECENT_PARTNERS_PATH on shutdown and loaded at
+startup as fixed-size binary records (user id, ring position, partners),
+least recently matched first, so the eviction order survives a restart.
+
+Configuration:
+    RECENT_PARTNERS_SIZE   partners remembered per user (default 5)
+    RECENT_PARTNERS_USERS  users remembered at most (default 1000000)
+    RECENT_PARTNERS_PATH   history file (default recent_partners.bin; empty disables saving)
+"""
+
+import os
+import struct
+import logging
+from array import array
+from collections import OrderedDict
+
+MAGIC = b'RPv1'
+HEADER = struct.Struct('<4sB')
+EMPTY = 0
+
+logger = logging.getLogger(__name__)
+
+
+class RecentPartners:
+    def __init__(self, size=5, capacity=1_000_000, path=None):
+        self.size = size
+        self.capacity = capacity
+        self.path = path
+        self.slots = OrderedDict()      # user_id -> slot, least recently matched first
+        self.rings = array('q')         # slot * size .. slot * size + size - 1
+        self.cursors = array('B')       # per slot: where the next partner is written
+        self.skipped = 0
+
+    @classmethod
+    def from_env(cls):
+        """Read at call time: each worker of a multi-worker node gets its own file"""
+        return cls(
+            size=int(os.getenv('RECENT_PARTNERS_SIZE', '5')),
+            capacity=int(os.getenv('RECENT_PARTNERS_USERS', '1000000')),
+            path=os.getenv('RECENT_PARTNERS_PATH', 'recent_partners.bin') or None,
+        )
+
+    def __len__(self):
+        return len(self.slots)
+
+    def contains(self, user_id, partner_id):
+        slot = self.slots.get(user_id)
+        if slot is None:
+            return False
+        start = slot * self.size
+        for i in range(start, start + self.size):
+            if self.rings[i] == partner_id:
+                return True
+        return False
+
+    def avoid(self, user_id, candidate_id):
+        """Matching predicate: whether either user recently chatted with the other"""
+        if self.contains(user_id, candidate_id) or self.contains(candidate_id, user_id):
+            self.skipped += 1
+            return True
+        return False
+
+    def add(self, user_id, partner_id):
+        """Remember the pair for both users"""
+        self._push(user_id, partner_id)
+        self._push(partner_id, user_id)
+
+    def _push(self, user_id, partner_id):
+        slot = self.slots.get(user_id)
+        if slot is None:
+            slot = self._allocate(user_id)
+        else:
+            self.slots.move_to_end(user_id)
+            if self.contains(user_id, partner_id):
+                return
+        cursor = self.cursors[slot]
+        self.rings[slot * self.size + cursor] = partner_id
+        self.cursors[slot] = (cursor + 1) % self.size
+
+    def _allocate(self, user_id):
+        if len(self.slots) < self.capacity:
+            slot = len(self.slots)
+            if slot * self.size >= len(self.rings):
+                self.rings.extend([EMPTY] * self.size)
+                self.cursors.append(0)
+        else:
+            _, slot = self.slots.popitem(last=False)
+            start = slot * self.size
+            self.rings[start:start + self.size] = array('q', [EMPTY] * self.size)
+            self.cursors[slot] = 0
+        self.slots[user_id] = slot
+        return slot
+
+    # ---- persistence -----------------------------------------------------
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                magic, size = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC:
+                    raise ValueError("not a recent partners file")
+                record = struct.Struct(f'<qB{size}q')
+                while True:
+                    data = f.read(record.size)
+                    if len(data) < record.size:
+                        break
+                    user_id, cursor, *partners = record.unpack(data)
+                    # Replay oldest first so a changed RECENT_PARTNERS_SIZE keeps the latest ones
+                    for i in range(size):
+                        partner_id = partners[(cursor + i) % size]
+                        if partner_id != EMPTY:
+                            self._push(user_id, partner_id)
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f"Could not load recent partners from {self.path}: {e}")
+            return
+        logger.info(f"Loaded recent partners for {len(self.slots)} users")
+
+    def save(self):
+        if not self.path:
+            return
+        record = struct.Struct(f'<qB{self.size}q')
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, self.size))
+                for user_id, slot in self.slots.items():
+                    start = slot * self.size
+                    f.write(record.pack(user_id, self.cursors[slot], *self.rings[start:start + self.size]))
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.error(f"Could not save recent partners to {self.path}: {e}")
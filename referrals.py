@@ -0,0 +1,128 @@
+"""
+Referral rewards off the /start path, and a precomputed referrer leaderboard
+
+/start only records a row in the referral_events ledger (one per referred
+user, so a referral can never be counted twice) and wakes the worker. The
+worker claims pending events oldest first; the claim and the referrer's
+referral_count increment commit together (Database.apply_referral), so
+each event is counted exactly once even with several workers. It then
+grants the VIP day and sends the notification. Events left pending by a
+crash are picked up by the next poll.
+
+The leaderboard holds every referrer sorted by (count desc, user id), so
+the top N is a slice and a rank is one bisect. It is loaded at startup,
+updated for each event this process applies, and reloaded every
+LEADERBOARD_REFRESH seconds to pick up events applied by other workers.
+
+Configuration:
+    REFERRAL_POLL_INTERVAL  seconds between checks for pending events (default 5)
+    REFERRAL_VIP_DAYS       VIP days granted per referral (default 1)
+    LEADERBOARD_REFRESH     seconds between full leaderboard reloads (default 300)
+"""
+
+import os
+import time
+import asyncio
+import logging
+from bisect import bisect_left, insort
+
+logger = logging.getLogger(__name__)
+
+REFERRAL_POLL_INTERVAL = float(os.getenv('REFERRAL_POLL_INTERVAL', '5'))
+REFERRAL_VIP_DAYS = int(os.getenv('REFERRAL_VIP_DAYS', '1'))
+LEADERBOARD_REFRESH = float(os.getenv('LEADERBOARD_REFRESH', '300'))
+REFERRAL_BATCH = 100
+
+
+class Leaderboard:
+    def __init__(self):
+        self.counts = {}        # referrer user_id -> referral count
+        self.ranking = []       # (-count, user_id), best first
+        self.loaded_at = 0
+
+    def load(self, rows):
+        """Replace everything with (user_id, count) rows"""
+        self.counts = {user_id: count for user_id, count in rows if count}
+        self.ranking = sorted((-count, user_id) for user_id, count in self.counts.items())
+        self.loaded_at = time.monotonic()
+
+    def increment(self, user_id):
+        count = self.counts.get(user_id, 0)
+        if count:
+            del self.ranking[bisect_left(self.ranking, (-count, user_id))]
+        self.counts[user_id] = count + 1
+        insort(self.ranking, (-(count + 1), user_id))
+
+    def top(self, limit=10):
+        """[(user_id, count)], best first"""
+        return [(user_id, -negative) for negative, user_id in self.ranking[:limit]]
+
+    def rank(self, user_id):
+        """1-based position among referrers, or None without referrals"""
+        count = self.counts.get(user_id)
+        if not count:
+            return None
+        return bisect_left(self.ranking, (-count, user_id)) + 1
+
+    def __len__(self):
+        return len(self.ranking)
+
+
+class ReferralWorker:
+    def __init__(self, db, on_reward, vip_days=REFERRAL_VIP_DAYS):
+        self.db = db
+        self.on_reward = on_reward      # async on_reward(referrer_id), after the reward is applied
+        self.vip_days = vip_days
+        self.leaderboard = Leaderboard()
+        self.applied = 0
+        self._wakeup = None
+        self._task = None
+
+    async def start(self):
+        self.leaderboard.load(self.db.get_referral_counts())
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._wakeup = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), REFERRAL_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.process_pending()
+                if time.monotonic() - self.leaderboard.loaded_at > LEADERBOARD_REFRESH:
+                    self.leaderboard.load(self.db.get_referral_counts())
+            except Exception as e:
+                logger.error(f"Referral worker pass failed: {e}")
+
+    async def process_pending(self):
+        while True:
+            events = self.db.get_pending_referrals(REFERRAL_BATCH)
+            for event_id, referrer_id in events:
+                if not self.db.apply_referral(event_id, referrer_id):
+                    continue    # claimed by another worker, or the database went away
+                self.db.set_vip_status(referrer_id, self.vip_days)
+                self.leaderboard.increment(referrer_id)
+                self.applied += 1
+                try:
+                    await self.on_reward(referrer_id)
+                except Exception as e:
+                    logger.error(f"Error notifying referrer {referrer_id}: {e}")
+            if len(events) < REFERRAL_BATCH:
+                return
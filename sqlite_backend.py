@@ -0,0 +1,197 @@
+"""
+Tuned SQLite backend: WAL journaling, one writer thread, a pool of readers
+
+SQLite allows a single writer at a time, and every commit costs a journal
+sync. The writer thread owns the only read-write connection: it takes every
+queued write, runs each inside its own SAVEPOINT (so one failing write only
+rolls back itself) and commits the whole batch as one transaction. Under
+load many small writes share a single commit.
+
+Reads never wait for the writer: WAL lets read-only connections see the
+last committed state while a write transaction is open.
+
+Configuration:
+    SQLITE_MODE        tuned (default) or basic (one autocommit connection)
+    SQLITE_READERS     read-only connections in the pool (default 4)
+    SQLITE_BATCH_SIZE  most writes committed together (default 500)
+"""
+
+import os
+import queue
+import atexit
+import sqlite3
+import pathlib
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+SQLITE_MODE = os.getenv('SQLITE_MODE', 'tuned').lower()
+SQLITE_READERS = int(os.getenv('SQLITE_READERS', '4'))
+SQLITE_BATCH_SIZE = int(os.getenv('SQLITE_BATCH_SIZE', '500'))
+
+# Applied to every connection; journal_mode is stored in the file itself
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),          # WAL stays consistent; only the last commits can be lost on power failure
+    ('busy_timeout', '5000'),           # ms to wait for another process's lock
+    ('cache_size', '-65536'),           # 64 MB page cache (negative = KiB)
+    ('mmap_size', '268435456'),         # read through a 256 MB memory map
+    ('temp_store', 'MEMORY'),
+)
+
+
+def open_connection(path, readonly=False):
+    if readonly:
+        uri = pathlib.Path(path).absolute().as_uri() + '?mode=ro'
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+    else:
+        connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    for name, value in PRAGMAS:
+        if readonly and name == 'journal_mode':
+            continue
+        connection.execute(f'PRAGMA {name} = {value}')
+    return connection
+
+
+class SQLiteWriter:
+    """Runs write operations on one connection, committing them in batches"""
+
+    def __init__(self, path, batch_size=SQLITE_BATCH_SIZE):
+        self.connection = open_connection(path)
+        self.batch_size = batch_size
+        self.batches = 0
+        self.writes = 0
+        self._pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name='sqlite-writer', daemon=True)
+        atexit.register(self.close)
+
+    def start(self):
+        """Start the writer thread; until then the connection may be used directly (schema setup)"""
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def is_usable(self):
+        """True before start() (direct use) and while the thread runs"""
+        return self._thread.ident is None or self._thread.is_alive()
+
+    def submit(self, op):
+        """Queue op(connection); returns a Future resolved once its batch is committed"""
+        future = Future()
+        self._queue.put((op, future))
+        return future
+
+    def run(self, op):
+        """submit() and wait for the result (exceptions are re-raised)"""
+        return self.submit(op).result()
+
+    def post(self, op):
+        """Fire-and-forget submit(); failures are printed instead of raised"""
+        self.submit(op).add_done_callback(_print_failure)
+
+    def flush(self):
+        """Wait until everything queued so far is committed"""
+        if self.is_alive():
+            self.run(lambda connection: None)
+
+    def close(self):
+        if self._pid != os.getpid() or not self.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self.connection.close()
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        connection = self.connection
+        results = []
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            for op, future in batch:
+                connection.execute('SAVEPOINT write_op')
+                try:
+                    result = op(connection)
+                    connection.execute('RELEASE write_op')
+                    results.append((future, result, None))
+                except Exception as e:
+                    connection.execute('ROLLBACK TO write_op')
+                    connection.execute('RELEASE write_op')
+                    results.append((future, None, e))
+            connection.execute('COMMIT')
+        except Exception as e:
+            # The transaction itself failed (e.g. locked past busy_timeout): nothing was written
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.writes += len(batch)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def _print_failure(future):
+    if future.exception() is not None:
+        print(f"SQLite write failed: {future.exception()}")
+
+
+class SQLiteReaderPool:
+    """Read-only connections handed out one per concurrent reader"""
+
+    def __init__(self, path, size=SQLITE_READERS):
+        self.path = path
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        connection = self._checkout()
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._opened) < self.size:
+                connection = open_connection(self.path, readonly=True)
+                self._opened.append(connection)
+                return connection
+        return self._idle.get()
+
+    def close(self):
+        for connection in self._opened:
+            connection.close()
+        self._opened.clear()
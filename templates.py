@@ -0,0 +1,408 @@
+"""
+Message templates and reply keyboards, built once at startup
+
+Static texts and InlineKeyboardMarkup objects are created per locale when
+the registry is built and shared by every update (keyboards are immutable
+in python-telegram-bot, so sharing them is safe). The few texts with
+dynamic fields (match notices, referral dashboard, admin stats) are
+rendered with str.format_map; their results are cached, since most of
+them repeat (a match notice only varies by gender, age and match type).
+
+Localization: each file <language>.json in TEMPLATE_LOCALES_DIR may
+override any text by name and any keyboard's labels (a list of rows of
+labels, same shape as the English keyboard). Lookups fall back from
+"pt-br" to "pt" to English.
+
+Configuration:
+    TEMPLATE_LOCALES_DIR  directory of <language>.json overrides (optional)
+"""
+
+import os
+import json
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import callbacks
+
+DEFAULT_LOCALE = 'en'
+RENDER_CACHE_SIZE = 4096
+
+TEXTS = {
+    'degraded': "⚠️ We're having a temporary technical problem. Please try again in a minute.",
+    'start_first': "❌ Please start the bot first with /start",
+    'blocked': "❌ You are blocked from using this bot.",
+    'agree_first': "❌ Please agree to terms first with /start",
+    'complete_profile': "❌ Please complete your profile first.",
+    'referral_reward': "🎉 Someone started the bot through your referral link! You've been granted VIP status for 24 hours.",
+    'terms': """
+╔══════════════════════════════════╗
+║   🌟 **PREMIUM ANONYMOUS CHAT** 🌟   ║
+╚══════════════════════════════════╝
+
+💎 **Welcome to the Elite Dating Experience!** 💎
+
+┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+┃ 📜 **Terms & Conditions** 📜
+┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+┃ 🔸 Premium anonymous chat platform
+┃ 🔸 Zero tolerance for harassment
+┃ 🔸 Respectful communication only
+┃ 🔸 No external links permitted
+┃ 🔸 VIP group membership required
+┃ 🔸 Admin decisions are absolute
+┃ 🔸 All chats monitored for safety
+┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+✨ **By agreeing, you join our exclusive community** ✨
+""",
+    'terms_agreed': "🎉 **WELCOME TO THE ELITE!** 🎉\n\n💎 Let's create your premium profile...",
+    'terms_declined': "💔 **ACCESS DENIED** 💔\n\n🚫 Elite membership requires agreement to our terms.\n\n👋 See you later!",
+    'setup_gender': """
+╔═══════════════════════════════╗
+║   🎭 **PROFILE CREATION** 🎭   ║
+╚═══════════════════════════════╝
+
+💫 **Step 1: Choose Your Identity** 💫
+
+🌟 Select your gender to begin your premium experience
+""",
+    'setup_country': """
+╔═══════════════════════════════╗
+║   🌍 **LOCATION SETUP** 🌍   ║
+╚═══════════════════════════════╝
+
+💫 **Step 2: Choose Your Territory** 💫
+
+🗺️ Select your country for premium matching
+""",
+    'setup_age': """
+╔═══════════════════════════════╗
+║   📅 **AGE SELECTION** 📅   ║
+╚═══════════════════════════════╝
+
+💫 **Step 3: Choose Your Era** 💫
+
+🎂 Select your age group for perfect matching
+""",
+    'gender_set': "🎉 **PERFECT CHOICE!** 🎉\n\n✨ {gender} profile activated",
+    'country_set': "🌍 **LOCATION CONFIRMED!** 🌍\n\n✨ {country} selected as your territory",
+    'age_set': "🎂 **AGE VERIFIED!** 🎂\n\n✨ {age} age category locked in",
+    'force_join': """
+╔══════════════════════════════════╗
+║  🔒 **GROUP ACCESS REQUIRED** 🔒  ║
+╚══════════════════════════════════╝
+
+👑 **ELITE MEMBERSHIP VERIFICATION** 👑
+
+🚫 You must join all premium groups to access the platform
+
+✨ **Click below to join and unlock full access** ✨
+""",
+    'force_join_button': "🌟 JOIN ELITE GROUP {number}",
+    'main_menu': """
+╔══════════════════════════════════╗
+║  💎 **PREMIUM DATING PLATFORM** 💎  ║
+╚══════════════════════════════════╝
+
+🌟 **WELCOME TO YOUR ELITE EXPERIENCE** 🌟
+
+┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+┃          🎯 **MAIN MENU** 🎯
+┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+┃ 💬 `/chat` ➤ Find Your Match
+┃ 🛑 `/end` ➤ End Current Session
+┃ 👑 `/vip` ➤ Upgrade to Premium
+┃ 🔗 `/refer` ➤ Invite & Earn
+┃ 👤 `/profile` ➤ Manage Profile
+┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+✨ **Start your premium anonymous dating journey!** ✨
+""",
+    'already_in_chat': "❌ **ALREADY CONNECTED** ❌\n\n🔗 You are currently in a chat session\n🛑 Use `/end` to terminate current session",
+    'already_connected': "❌ **ALREADY CONNECTED** ❌\n\n🔗 You are currently in a premium chat\n🛑 Use `/end` to terminate session",
+    'matching': """
+╔════════════════════════════════╗
+║  🎯 **ELITE MATCHING SYSTEM** 🎯  ║
+╚════════════════════════════════╝
+
+💫 **Choose Your Premium Experience** 💫
+
+🌟 Select your preferred matching type below
+""",
+    'searching': "⏳ **SEARCHING...** ⏳\n\n🔍 No{gender_text} chat partner available right now\n💫 You'll be connected as soon as someone joins\n🛑 Use `/end` to stop searching",
+    'searching.Female': " female",
+    'searching.Male': " male",
+    'matching_error': "❌ **MATCHING ERROR** ❌\n\n🔄 System error occurred\n💫 Please try again",
+    'match_type.Female': " (You requested girls only)",
+    'match_type.Male': " (You requested boys only)",
+    'match_type.random': " (Random match)",
+    'match_found': """
+╔══════════════════════════════════╗
+║  🎉 **MATCH FOUND!** 🎉   ║
+╚══════════════════════════════════╝
+
+💫 **CONNECTION ESTABLISHED**{match_type} 💫
+
+┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+┃ 👤 Gender: {gender}
+┃ 📅 Age: {age}
+┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+✨ **Start your premium conversation now!** ✨
+""",
+    'search_stopped': "🛑 **SEARCH STOPPED** 🛑\n\n💫 Use `/chat` to start matching again!",
+    'session_ended': "🎯 **SESSION ENDED** 🎯\n\n✨ Chat session successfully terminated\n💫 Use `/chat` to find a new premium match!",
+    'partner_ended': "💔 **SESSION ENDED** 💔\n\n🌟 Your chat partner has ended the session\n✨ Use `/chat` to find a new premium match!",
+    'session_idle': "⏰ **SESSION ENDED** ⏰\n\n💤 No messages for a while, so this chat was closed\n✨ Use `/chat` to find a new premium match!",
+    'search_expired': "⏰ **SEARCH EXPIRED** ⏰\n\n💤 No match turned up for a while, so your search was stopped\n💫 Use `/chat` to start matching again!",
+    'no_session': "❌ **NO ACTIVE SESSION** ❌\n\n🎯 You are not currently in a chat session\n💫 Use `/chat` to start matching!",
+    'not_in_chat': "❌ You are not in a chat session. Use /chat to find a partner.",
+    'send_failed': "❌ Failed to send message. Your partner may have left the chat.",
+    'unsupported_type': "❌ This message type can't be sent in chats.",
+    'vip': """
+╔══════════════════════════════════╗
+║   👑 **EXCLUSIVE VIP LOUNGE** 👑   ║
+╚══════════════════════════════════╝
+
+✨ **UNLOCK PREMIUM FEATURES** ✨
+
+┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+┃ 🎯 **VIP BENEFITS:**
+┃ • 💃 Match with specific genders
+┃ • 🎲 Priority matching algorithm
+┃ • 🌟 Enhanced profile visibility
+┃ • 💎 Exclusive VIP support
+┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+💫 **Choose your path to elite status** 💫
+""",
+    'vip_exclusive': "🔒 **VIP EXCLUSIVE** 🔒\n\n👑 This feature requires VIP membership\n💎 Use `/vip` to unlock premium features",
+    'referral': """
+╔══════════════════════════════════╗
+║  🌟 **REFERRAL EMPIRE** 🌟   ║
+╚══════════════════════════════════╝
+
+💰 **YOUR EXCLUSIVE INVITE LINK** 💰
+🔗 `{link}`
+
+┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+┃ 📊 **REFERRAL DASHBOARD:**
+┃ 👥 Elite Members Invited: {count}
+┃ 💎 VIP Hours Earned: {hours}
+┃ 🏆 Leaderboard Rank: {rank}
+┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+┃ 🎯 **REFERRAL REWARDS:**
+┃ • 24 Hours VIP per invite
+┃ • Unlimited earning potential
+┃ • Instant VIP activation
+┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+✨ **Share and earn your way to permanent VIP!** ✨
+""",
+    'vip_purchase': """
+╔══════════════════════════════════╗
+║  💎 **PREMIUM PACKAGES** 💎   ║
+╚══════════════════════════════════╝
+
+🌟 **CHOOSE YOUR ELITE EXPERIENCE** 🌟
+
+┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+┃ 💫 **ALL PACKAGES INCLUDE:**
+┃ • 💃 Gender-specific matching
+┃ • 🎯 Priority algorithm access
+┃ • 🌟 Enhanced profile features
+┃ • 💎 Exclusive VIP support
+┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+✨ **Select your premium duration below** ✨
+""",
+    'payment_success': "🎉 Payment successful! You now have VIP access for {days} days.",
+    'profile_options': "👤 **Profile Options:**",
+    'update_menu': "✏️ **Choose what to update:**",
+    'filter_menu': "🔍 **Select Partner Filter:**",
+    'filter_updated': "🎯 **FILTER UPDATED!** 🎯\n\n✨ Partner preference: **{filter}**",
+    'select_gender': "🚹 **Select your gender:**",
+    'select_country': "🌍 **Select your country:**",
+    'select_age': "🎂 **Select your age group:**",
+    'gender_updated': "🎭 **PROFILE UPDATED!** 🎭\n\n✨ Gender changed to: **{gender}**",
+    'country_updated': "🌍 **LOCATION UPDATED!** 🌍\n\n✨ Territory changed to: **{country}**",
+    'age_updated': "🎂 **AGE UPDATED!** 🎂\n\n✨ Age category changed to: **{age}**",
+    'admin_stats': """
+╔══════════════════════════════════╗
+║  📊 **ADMIN DASHBOARD** 📊   ║
+╚══════════════════════════════════╝
+
+🎯 **SYSTEM OVERVIEW** 🎯
+
+┏━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┓
+┃ 👥 **USER STATISTICS:**
+┃ • Total Users: {total_users}
+┃ • 👨 Male Users: {male_users}
+┃ • 👩 Female Users: {female_users}
+┃ • ✅ Completed Profiles: {completed_profiles}
+┃ • ❌ Blocked Users: {blocked_users}
+┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+┃ 🟢 **LIVE ACTIVITY:**
+┃ • 👨 Live Male Users: {live_male_users}
+┃ • 👩 Live Female Users: {live_female_users}
+┃ • 📱 Total Online: {live_users}
+┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+┃ 💬 **CHAT METRICS:**
+┃ • Active Sessions: {active_chats}
+┃ • Total Messages: {total_messages}
+┃ • Time to Match (p50/p95): {time_to_match}
+┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+┃ 👑 **PREMIUM DATA:**
+┃ • VIP Users: {vip_users}
+┃ • Total Referrals: {total_referrals}
+┣━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┫
+┃ 🔒 **SYSTEM CONFIG:**
+┃ • Force Join Groups: {force_join_groups}
+┃ • Moderation Hits: {moderation_hits}
+┃ • Database Circuit: {circuit_state} ({circuit_trips} trips)
+┃ • Journaled Writes: {journal_recorded} ({journal_replayed} replayed)
+┗━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━┛
+
+⏰ **Last Updated:** {updated}
+""",
+}
+
+# Rows of (label, callback action, *action args); see callbacks.py
+KEYBOARDS = {
+    'terms': [
+        [("💎 ✅ JOIN ELITE COMMUNITY", 'terms_agree')],
+        [("🚫 ❌ DECLINE ACCESS", 'terms_disagree')],
+    ],
+    'setup_gender': [
+        [("💪 👨 GENTLEMAN", 'set_gender', 'Male')],
+        [("💃 👩 LADY", 'set_gender', 'Female')],
+    ],
+    'setup_country': [
+        [("🇺🇸 USA", 'set_country', 'USA'), ("🇬🇧 UK", 'set_country', 'UK')],
+        [("🇮🇳 India", 'set_country', 'India'), ("🇨🇦 Canada", 'set_country', 'Canada')],
+        [("🇦🇺 Australia", 'set_country', 'Australia'), ("🇩🇪 Germany", 'set_country', 'Germany')],
+        [("🇫🇷 France", 'set_country', 'France'), ("🇯🇵 Japan", 'set_country', 'Japan')],
+        [("🌍 ✨ OTHER LOCATION", 'set_country', 'Other')],
+    ],
+    'setup_age': [
+        [("🌱 18-25 YOUNG", 'set_age', 22), ("💫 26-35 PRIME", 'set_age', 30)],
+        [("🌟 36-45 MATURE", 'set_age', 40), ("👑 46+ ELITE", 'set_age', 50)],
+    ],
+    'matching': [
+        [("💃 👑 MATCH WITH LADIES (VIP)", 'match_girls')],
+        [("💪 👑 MATCH WITH GENTLEMEN (VIP)", 'match_boys')],
+        [("🎲 ✨ RANDOM MATCH (FREE)", 'match_random')],
+    ],
+    'vip': [
+        [("🌟 💰 REFER & EARN VIP", 'vip_refer')],
+        [("💎 🛒 PURCHASE PREMIUM", 'vip_purchase')],
+    ],
+    'vip_purchase': [
+        [("⚡ 1 DAY TRIAL - 10 ⭐", 'buy_vip', 1)],
+        [("🌟 5 DAYS POPULAR - 25 ⭐", 'buy_vip', 5)],
+        [("💫 12 DAYS PREMIUM - 50 ⭐", 'buy_vip', 12)],
+        [("👑 1 MONTH ELITE - 100 ⭐", 'buy_vip', 30)],
+    ],
+    'profile_options': [
+        [("✏️ Update Profile", 'update_profile')],
+        [("🔍 Partner Filter (VIP)", 'partner_filter')],
+    ],
+    'update_menu': [
+        [("🚹 Change Gender", 'edit_gender')],
+        [("🌍 Change Country", 'edit_country')],
+        [("🎂 Change Age", 'edit_age')],
+        [("🔙 Back to Profile", 'back_to_profile')],
+    ],
+    'filter_menu': [
+        [("🧑🏻‍🦰 Male Only", 'set_filter', 'Male')],
+        [("👱🏻‍♀ Female Only", 'set_filter', 'Female')],
+        [("🔄 Any Gender", 'set_filter', 'any')],
+    ],
+    'select_gender': [
+        [("👨 Male", 'update_gender', 'Male')],
+        [("👩 Female", 'update_gender', 'Female')],
+        [("🔙 Back", 'update_profile')],
+    ],
+    'select_country': [
+        [("🇵🇰 Pakistan", 'update_country', 'Pakistan')],
+        [("🇮🇳 India", 'update_country', 'India')],
+        [("🇺🇸 USA", 'update_country', 'USA')],
+        [("🇬🇧 UK", 'update_country', 'UK')],
+        [("🇨🇦 Canada", 'update_country', 'Canada')],
+        [("🌍 Other", 'update_country', 'Other')],
+        [("🔙 Back", 'update_profile')],
+    ],
+    'select_age': [
+        [(f"{age}-{age + 1}", 'update_age', age)] for age in range(18, 36, 2)
+    ] + [[("🔙 Back", 'update_profile')]],
+}
+
+
+class TemplateRegistry:
+    def __init__(self, overrides=None):
+        """overrides: {locale: {'texts': {name: text}, 'keyboards': {name: [[label, ...], ...]}}}"""
+        self.texts = {DEFAULT_LOCALE: dict(TEXTS)}
+        self.keyboards = {DEFAULT_LOCALE: {name: _build_keyboard(rows) for name, rows in KEYBOARDS.items()}}
+        for locale, override in (overrides or {}).items():
+            locale = locale.lower()
+            self.texts[locale] = {**TEXTS, **override.get('texts', {})}
+            keyboards = dict(self.keyboards[DEFAULT_LOCALE])
+            for name, labels in override.get('keyboards', {}).items():
+                if name in KEYBOARDS:
+                    keyboards[name] = _build_keyboard(_relabel(KEYBOARDS[name], labels))
+            self.keyboards[locale] = keyboards
+        self._locales = {}          # language_code -> locale with templates
+        self._rendered = {}
+
+    @classmethod
+    def from_env(cls):
+        overrides = {}
+        directory = os.getenv('TEMPLATE_LOCALES_DIR')
+        if directory and os.path.isdir(directory):
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith('.json'):
+                    with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                        overrides[filename[:-5]] = json.load(f)
+        return cls(overrides)
+
+    def locale(self, language_code):
+        """Best available locale for a Telegram language_code ("pt-br" -> "pt" -> "en")"""
+        found = self._locales.get(language_code)
+        if found is None:
+            code = (language_code or '').lower()
+            found = code if code in self.texts else code.split('-')[0]
+            if found not in self.texts:
+                found = DEFAULT_LOCALE
+            self._locales[language_code] = found
+        return found
+
+    def text(self, name, language_code=None):
+        return self.texts[self.locale(language_code)][name]
+
+    def keyboard(self, name, language_code=None):
+        return self.keyboards[self.locale(language_code)][name]
+
+    def render(self, name, language_code=None, **fields):
+        """Fill a text's {fields}; results are cached"""
+        locale = self.locale(language_code)
+        key = (locale, name, *fields.items())
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            if len(self._rendered) >= RENDER_CACHE_SIZE:
+                self._rendered.clear()
+            rendered = self._rendered[key] = self.texts[locale][name].format_map(fields)
+        return rendered
+
+
+def _build_keyboard(rows):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=callbacks.encode(*action)) for label, *action in row]
+        for row in rows
+    ])
+
+
+def _relabel(rows, labels):
+    """English rows with their labels replaced by a locale's, position by position"""
+    return [
+        [(labels[i][j] if i < len(labels) and j < len(labels[i]) else label, *action) for j, (label, *action) in enumerate(row)]
+        for i, row in enumerate(rows)
+    ]
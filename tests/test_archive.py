@@ -0,0 +1,74 @@
+import os
+import asyncio
+
+from archive import BLOCK, ConversationArchive, conversation_key
+
+
+def open_archive(root, writer, **kwargs):
+    archive = ConversationArchive(root=str(root), writer=writer, **kwargs)
+    archive.open()
+    return archive
+
+
+def close(archive):
+    asyncio.run(archive.stop())
+
+
+def contents(messages):
+    return [(message.sender_id, message.receiver_id, message.content) for message in messages]
+
+
+def test_transcript_covers_buffered_and_flushed_messages(tmp_path):
+    archive = open_archive(tmp_path, 'main')
+    archive.append(1, 2, 'text', 'hello')
+    archive.append(3, 4, 'text', 'other chat')
+    archive.flush()
+    archive.append(2, 1, 'text', 'hi')
+    assert contents(archive.transcript(2, 1)) == [(1, 2, 'hello'), (2, 1, 'hi')]
+    assert archive.conversations(1) == [2]
+    close(archive)
+
+
+def test_index_survives_a_restart(tmp_path):
+    archive = open_archive(tmp_path, 'main')
+    archive.append(1, 2, 'text', 'hello')
+    archive.flush()
+    close(archive)
+    reopened = open_archive(tmp_path, 'main')
+    assert contents(reopened.transcript(1, 2)) == [(1, 2, 'hello')]
+    close(reopened)
+
+
+def test_other_writers_are_cached_and_read_incrementally(tmp_path):
+    shard0 = open_archive(tmp_path, 'shard0')
+    shard1 = open_archive(tmp_path, 'shard1')
+    shard1.append(2, 1, 'text', 'first')
+    shard1.flush()
+    assert contents(shard0.transcript(1, 2)) == [(2, 1, 'first')]
+    reader = shard0._readers[str(tmp_path / 'shard1')]
+    shard1.append(2, 1, 'text', 'second')
+    shard1.flush()
+    assert contents(shard0.transcript(1, 2)) == [(2, 1, 'first'), (2, 1, 'second')]
+    assert shard0._readers[str(tmp_path / 'shard1')] is reader
+    assert len(reader.index[conversation_key(1, 2)]) == 2
+    assert shard0.conversations(2) == [1]
+    close(shard0)
+    close(shard1)
+
+
+def test_corrupt_and_truncated_blocks_are_skipped(tmp_path):
+    archive = open_archive(tmp_path, 'main')
+    for content in ('one', 'two', 'three'):
+        archive.append(1, 2, 'text', content)
+        archive.flush()
+    offsets = [offset for _, offset in archive.index[(1, 2)]]
+    close(archive)
+    path = os.path.join(archive.directory, '00000000.seg')
+    with open(path, 'r+b') as f:
+        # Garble the second block's payload and cut the third one short
+        f.seek(offsets[1] + BLOCK.size)
+        f.write(b'\xff' * 4)
+        f.truncate(offsets[2] + BLOCK.size + 2)
+    reopened = open_archive(tmp_path, 'main')
+    assert contents(reopened.transcript(1, 2)) == [(1, 2, 'one')]
+    close(reopened)
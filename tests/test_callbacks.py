@@ -0,0 +1,60 @@
+import pytest
+
+from callbacks import ACTIONS, CallbackDataError, decode, encode
+
+
+def test_codes_are_unique():
+    assert len({action.code for action in ACTIONS}) == len(ACTIONS)
+
+
+@pytest.mark.parametrize('name, args', [
+    ('terms_agree', ()),
+    ('set_gender', ('Female',)),
+    ('set_country', ('United States',)),
+    ('set_age', (30,)),
+    ('set_filter', ('any',)),
+    ('search_page', (123456,)),
+])
+def test_round_trip(name, args):
+    assert decode(encode(name, *args)) == (name, args)
+
+
+def test_encoded_ints_are_base36():
+    assert encode('set_age', 30) == '1e:u'
+
+
+@pytest.mark.parametrize('data', [
+    '', '1', '1e', '1e:', '1e:u:v', '1?:u', '1eu',
+    '1w:-1', '1e:+z', '1e: 1', '1e:1_0', '1e:U', '1c:2', '1c:-0',
+])
+def test_malformed_data_is_rejected(data):
+    with pytest.raises(CallbackDataError):
+        decode(data)
+
+
+def test_encode_rejects_what_it_cannot_decode():
+    with pytest.raises(CallbackDataError):
+        encode('search_page', -1)
+    with pytest.raises(CallbackDataError):
+        encode('set_country', 'a:b')
+    with pytest.raises(CallbackDataError):
+        encode('set_country', 'x' * 70)
+
+
+@pytest.mark.parametrize('data, expected', [
+    ('terms_agree', ('terms_agree', ())),
+    ('gender_Male', ('set_gender', ('Male',))),
+    ('update_gender_Female', ('update_gender', ('Female',))),
+    ('country_United_States', ('set_country', ('United_States',))),
+    ('age_30', ('set_age', (30,))),
+    ('buy_vip_7_100', ('buy_vip', (7,))),
+    ('filter_any', ('set_filter', ('any',))),
+])
+def test_legacy_data(data, expected):
+    assert decode(data) == expected
+
+
+@pytest.mark.parametrize('data', ['age_30_1', 'age_-1', 'gender_Other', 'buy_vip_x', 'unknown'])
+def test_bad_legacy_data_is_rejected(data):
+    with pytest.raises(CallbackDataError):
+        decode(data)
@@ -0,0 +1,57 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import database
+
+
+class FakeBreaker:
+    def __init__(self):
+        self.tripped = []
+
+    def allow(self):
+        return not self.tripped
+
+    def trip(self, reason=None):
+        self.tripped.append(reason)
+
+
+class DroppedConnection:
+    """A PostgreSQL connection that goes away during the next statement"""
+
+    def __init__(self):
+        self.closed = False
+        self.cursors = []
+
+    def cursor(self):
+        cursor = SimpleNamespace(closed=False)
+        cursor.close = lambda: setattr(cursor, 'closed', True)
+        self.cursors.append(cursor)
+        return cursor
+
+
+def postgres_database(connection):
+    db = object.__new__(database.Database)
+    db._pid = os.getpid()
+    db.is_sqlite = False
+    db._writer = None
+    db.connection = connection
+    db.breaker = FakeBreaker()
+    return db
+
+
+def test_log_messages_failure_closes_the_cursor_and_trips_the_breaker(monkeypatch):
+    connection = DroppedConnection()
+
+    def execute_values(cursor, sql, entries):
+        connection.closed = True
+        raise ConnectionError("server closed the connection")
+
+    monkeypatch.setattr(database, 'psycopg2', SimpleNamespace(extras=SimpleNamespace(execute_values=execute_values)))
+    db = postgres_database(connection)
+    with pytest.raises(ConnectionError):
+        db.log_messages([(1, 2, 'text', 'hi')])
+    assert connection.cursors[0].closed
+    assert len(db.breaker.tripped) == 1
+    assert not db.available
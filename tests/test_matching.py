@@ -0,0 +1,59 @@
+from matching import MatchIndex
+
+
+def make_index(**kwargs):
+    return MatchIndex(widen_after=(15, 45), vip_boost=0, strict_boost=0, **kwargs)
+
+
+def test_nothing_tracked_for_sweeps_until_the_first_sweep():
+    index = make_index()
+    for user_id in range(1000):
+        index.add(user_id, 'Male', since=1000.0 + user_id)
+        index.remove(user_id)
+    assert index._crossing is None
+
+
+def test_first_sweep_covers_users_already_waiting():
+    index = make_index()
+    index.add(1, 'Male', country='DE', age=20, since=1000.0)
+    index.add(2, 'Female', country='FR', age=40, since=1001.0)
+    assert index.sweep(now=1010.0) == []
+    assert index.sweep(now=1046.0) == [(1, 2)]
+
+
+def test_sweep_queues_stay_bounded_by_the_thresholds():
+    index = make_index()
+    index.sweep(now=1000.0)
+    for user_id in range(1000):
+        index.add(user_id, 'Male', since=1000.0 + user_id * 0.1)
+        index.remove(user_id)
+    index.sweep(now=1200.0)
+    assert [len(queue) for queue in index._crossing] == [0, 0]
+
+
+def test_searching_again_keeps_the_place_in_the_bucket():
+    index = make_index()
+    index.add(1, 'Male', since=1000.0)
+    index.add(2, 'Male', since=1001.0)
+    index.add(1, 'Male', since=1002.0)
+    assert list(index.buckets[('Male', None, None, None, False)]) == [1, 2]
+    assert index.waiting_since(1) == 1000.0
+    assert index.expired(1000.5) == [1]
+
+
+def test_moving_bucket_keeps_the_wait_and_the_order():
+    index = make_index()
+    index.add(1, 'Male', country='DE', since=1000.0)
+    index.add(2, 'Male', country='FR', since=1001.0)
+    index.add(1, 'Male', country='FR', since=1005.0)
+    assert list(index.buckets[('Male', None, 'FR', None, False)]) == [1, 2]
+    assert index.expired(1000.5) == [1]
+
+
+def test_find_prefers_the_same_country_and_age():
+    index = make_index()
+    index.add(1, 'Female', country='FR', age=20, since=1000.0)
+    index.add(2, 'Female', country='DE', age=20, since=1001.0)
+    assert index.find(3, 'Male', country='DE', age=20, now=1002.0) == 2
+    assert index.find(3, 'Male', country='IT', age=20, now=1002.0) is None
+    assert index.find(3, 'Male', country='IT', age=20, now=1050.0) == 1
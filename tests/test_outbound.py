@@ -0,0 +1,53 @@
+import outbound
+from outbound import OutboundScheduler, TokenBucket
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_refills_at_its_rate(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(outbound.time, 'monotonic', clock)
+    bucket = TokenBucket(rate=10, capacity=10)
+    for _ in range(10):
+        assert bucket.wait_time() == 0.0
+        bucket.take()
+    assert bucket.wait_time() == 0.1
+    clock.now += 0.5
+    assert bucket.wait_time() == 0.0
+    assert bucket.tokens == 5
+
+
+def test_block_refills_only_after_it_lifts(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(outbound.time, 'monotonic', clock)
+    bucket = TokenBucket(rate=30, capacity=30)
+    bucket.block(2)
+    clock.now += 1
+    assert bucket.wait_time() == 1.0
+    assert not bucket.is_idle()
+    clock.now += 1
+    # Nothing was credited for the blocked period
+    assert bucket.wait_time() == 1 / 30
+    clock.now += 0.1
+    assert bucket.wait_time() == 0.0
+    assert round(bucket.tokens) == 3
+
+
+def test_flood_wait_blocks_and_slows_the_global_bucket(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(outbound.time, 'monotonic', clock)
+    scheduler = OutboundScheduler(global_rate=30)
+    scheduler._flood_wait(2)
+    assert scheduler.flood_waits == 1
+    assert scheduler.global_bucket.rate == 15
+    clock.now += 2
+    assert scheduler.global_bucket.wait_time() > 0
+    for _ in range(3):
+        scheduler._flood_wait(1)
+    assert scheduler.global_bucket.rate == 30 * outbound.OUTBOUND_MIN_RATE_SHARE
@@ -0,0 +1,28 @@
+from templates import DEFAULT_LOCALE, TemplateRegistry
+
+OVERRIDES = {
+    'de': {'texts': {'match_found': "Partner gefunden: {gender}, {age}{match_type}"}},
+    'PT': {'texts': {'match_found': "Parceiro encontrado: {gender}, {age}{match_type}"}},
+}
+
+
+def test_locale_falls_back_to_the_language_then_the_default():
+    templates = TemplateRegistry(OVERRIDES)
+    assert templates.locale('de') == 'de'
+    assert templates.locale('pt-br') == 'pt'
+    assert templates.locale('fr') == DEFAULT_LOCALE
+    assert templates.locale(None) == DEFAULT_LOCALE
+
+
+def test_render_uses_each_users_locale():
+    templates = TemplateRegistry(OVERRIDES)
+    german = templates.render('match_found', 'de', match_type="", gender='Female', age=30)
+    portuguese = templates.render('match_found', 'pt-br', match_type="", gender='Male', age=25)
+    assert german == "Partner gefunden: Female, 30"
+    assert portuguese == "Parceiro encontrado: Male, 25"
+    assert templates.render('match_found', 'de', match_type="", gender='Female', age=30) is german
+
+
+def test_untranslated_texts_fall_back_to_english():
+    templates = TemplateRegistry(OVERRIDES)
+    assert templates.text('blocked', 'de') == templates.text('blocked')
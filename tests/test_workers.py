@@ -0,0 +1,88 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import workers
+from workers import ShardBus, shard_for
+
+
+class FakeQueue(list):
+    def put(self, payload):
+        self.append(payload)
+
+
+class PublishError(Exception):
+    pass
+
+
+class FlakyBus:
+    """Bus whose first send to another node fails"""
+    errors = (PublishError,)
+
+    def __init__(self):
+        self.sent = []
+        self.failures = 1
+
+    def send_update(self, update):
+        if self.failures:
+            self.failures -= 1
+            raise PublishError("connection lost")
+        self.sent.append(update.update_id)
+
+
+class FakeBot:
+    def __init__(self, batches):
+        self.batches = batches
+        self.offsets = []
+
+    async def initialize(self):
+        pass
+
+    async def delete_webhook(self):
+        pass
+
+    async def get_updates(self, offset=None, **kwargs):
+        self.offsets.append(offset)
+        if not self.batches:
+            raise asyncio.CancelledError
+        return self.batches.pop(0)
+
+
+def test_shard_for_routes_by_user_id():
+    assert shard_for(None, 4) == 0
+    assert shard_for(7, 4) == 3
+    assert shard_for(8, 4) == 0
+
+
+def test_bus_sends_local_shards_to_their_queue():
+    queues = {0: FakeQueue(), 1: FakeQueue()}
+    bus = ShardBus(queues, 2)
+    assert not bus.has_remote
+    assert bus.errors == ()
+    bus.send_event(3, {'type': 'unpair'})
+    assert queues[0] == []
+    assert json.loads(queues[1][0]) == {'kind': 'event', 'data': {'type': 'unpair'}}
+
+
+def test_failed_handoff_leaves_the_update_unacknowledged(monkeypatch):
+    updates = [SimpleNamespace(update_id=10), SimpleNamespace(update_id=11)]
+    fake_bot = FakeBot([list(updates), list(updates)])
+    monkeypatch.setattr(workers, 'Bot', lambda token: fake_bot)
+
+    async def no_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(workers.asyncio, 'sleep', no_sleep)
+    bus = FlakyBus()
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(workers._poll_updates(bus))
+    assert fake_bot.offsets == [None, None, 12]
+    assert bus.sent == [10, 11]
+
+
+def test_watch_workers_returns_the_dead_one():
+    alive = SimpleNamespace(is_alive=lambda: True)
+    dead = SimpleNamespace(is_alive=lambda: False)
+    assert asyncio.run(workers._watch_workers([alive, dead])) is dead
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from write_journal import WriteJournal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = WriteJournal(str(tmp_path / 'journal.jsonl'), fsync_interval=0.01)
+    yield journal
+    journal.close()
+
+
+def defer(journal, op, *args):
+    assert journal.defer(op, args, lambda: False)
+
+
+def test_writes_go_straight_through_while_nothing_is_pending(journal):
+    assert not journal.defer('block_user', (1,), lambda: True)
+    assert not journal.pending
+
+
+def test_replay_hands_over_runs_of_the_same_op_in_order(journal):
+    for user_id in (1, 2, 3):
+        defer(journal, 'set_user_looking_for_chat', user_id, True)
+    defer(journal, 'end_chat_session', 1, 2)
+    defer(journal, 'set_user_looking_for_chat', 1, False)
+    calls = []
+    assert journal.replay(lambda op, args_list: calls.append((op, args_list)) or True) == 5
+    assert calls == [
+        ('set_user_looking_for_chat', [[1, True], [2, True], [3, True]]),
+        ('end_chat_session', [[1, 2]]),
+        ('set_user_looking_for_chat', [[1, False]]),
+    ]
+    assert not journal.pending
+    assert os.path.getsize(journal.path) == 0
+
+
+def test_new_writes_queue_behind_a_pending_replay(journal):
+    defer(journal, 'block_user', 1)
+    assert journal.defer('unblock_user', (1,), lambda: True)
+
+
+def test_interrupted_replay_resumes_after_the_last_applied_run(journal):
+    defer(journal, 'block_user', 1)
+    defer(journal, 'block_user', 2)
+    defer(journal, 'end_chat_session', 1, None)
+    defer(journal, 'unblock_user', 1)
+    calls = []
+
+    def apply(op, args_list):
+        calls.append(op)
+        return op != 'end_chat_session'
+
+    assert journal.replay(apply) == 2
+    assert journal.pending
+    calls.clear()
+    assert journal.replay(lambda op, args_list: calls.append(op) or True) == 2
+    assert calls == ['end_chat_session', 'unblock_user']
+
+
+def test_offset_is_written_once_per_chunk(journal, monkeypatch):
+    for user_id in range(20):
+        defer(journal, 'block_user' if user_id % 2 else 'unblock_user', user_id)
+    writes = []
+    write_offset = journal._write_offset
+    monkeypatch.setattr(journal, '_write_offset', lambda offset: writes.append(offset) or write_offset(offset))
+    assert journal.replay(lambda op, args_list: True) == 20
+    # One for the chunk, one when the emptied journal is reset
+    assert len(writes) == 2
+
+
+def test_torn_last_record_is_left_for_later(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    path.write_text('{"op": "block_user", "args": [1], "at": ""}\n{"op": "unbl')
+    journal = WriteJournal(str(path))
+    try:
+        calls = []
+        assert journal.replay(lambda op, args_list: calls.append(op) or True) == 1
+        assert calls == ['block_user']
+    finally:
+        journal.close()
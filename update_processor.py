@@ -0,0 +1,91 @@
+"""
+Update processor that keeps each user's updates in order while different
+users run fully in parallel.
+
+concurrent_updates(True) lets two messages from the same user race each
+other, so they can reach the partner out of order and /end can race a relay.
+Here every user gets a lightweight serial queue (an asyncio.Lock that exists
+only while the user has updates in flight), and relays/ends additionally
+serialize on the chat pair through pair_lock().
+"""
+
+import os
+import asyncio
+from contextlib import asynccontextmanager
+
+from telegram.ext import BaseUpdateProcessor
+
+# Updates executing at once across all users
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '256'))
+# Updates accepted (running or waiting on their user's queue) before the
+# application stops pulling new ones; bounds memory under a flood
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', '4096'))
+
+
+class _KeyedLocks:
+    """asyncio.Lock per key, dropped as soon as nobody holds or waits for it"""
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Serial per user, parallel across users, capped at max_concurrent_updates"""
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, max_pending_updates=MAX_PENDING_UPDATES):
+        # The base class semaphore bounds pending updates; ours bounds running ones
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._user_locks = _KeyedLocks()
+        self._pair_locks = _KeyedLocks()
+
+    @staticmethod
+    def _key_for(update):
+        user = getattr(update, 'effective_user', None)
+        if user:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key_for(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        # Wait for the user's turn before taking a running slot, so one
+        # flooding user queues behind itself instead of starving others
+        async with self._user_locks.hold(key):
+            async with self._running:
+                await coroutine
+
+    def pair_lock(self, user_id, partner_id):
+        """Serialize work on one chat pair (relays in both directions, /end)"""
+        return self._pair_locks.hold((min(user_id, partner_id), max(user_id, partner_id)))
+
+    @property
+    def active_queues(self):
+        return len(self._user_locks)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,377 @@
+"""
+Multi-worker mode: one ingress process polls Telegram and shards updates by
+user_id to N worker processes, each running the regular TelegramBot handlers.
+
+Node layout is configured through the environment:
+    BOT_WORKERS       worker processes on this node (sharded mode when > 1)
+    BOT_SHARDS        total shards across all nodes (defaults to BOT_WORKERS)
+    BOT_SHARD_OFFSET  first shard index served by this node (defaults to 0)
+    BOT_INGRESS       1 if this node runs the Telegram poller (defaults to 1)
+
+Shards on the same node talk over multiprocessing queues. Shards on other
+nodes are reached through PostgreSQL: messages are written to shard_inbox
+and the owning worker is woken with LISTEN/NOTIFY. A dropped connection is
+reopened on both sides; messages wait in shard_inbox meanwhile.
+
+If a worker process dies the node stops its other workers and exits with
+status 1, so the process supervisor restarts it whole instead of ingress
+filling a queue nobody reads.
+"""
+
+import os
+import json
+import time
+import asyncio
+import select
+import logging
+import threading
+import multiprocessing
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+BOT_SHARDS = int(os.getenv('BOT_SHARDS', str(BOT_WORKERS)))
+BOT_SHARD_OFFSET = int(os.getenv('BOT_SHARD_OFFSET', '0'))
+BOT_INGRESS = os.getenv('BOT_INGRESS', '1') == '1'
+
+# How often a worker drains shard_inbox even without a NOTIFY (missed wakeups)
+INBOX_POLL_SECONDS = 5
+INBOX_BATCH_SIZE = 500
+# Longest wait between attempts to reopen a dropped LISTEN connection
+INBOX_RECONNECT_MAX_DELAY = 30
+
+
+def shard_for(user_id, total=None):
+    """Shard that owns a user; updates without a user go to shard 0"""
+    if user_id is None:
+        return 0
+    return user_id % (total or BOT_SHARDS)
+
+
+def _update_user_id(update):
+    user = update.effective_user
+    return user.id if user else None
+
+
+class PostgresShardInbox:
+    """Cross-node transport: rows in shard_inbox plus a NOTIFY per shard channel"""
+
+    def __init__(self):
+        from database import connect_postgres, _load_psycopg2
+        self._connect = connect_postgres
+        self.Error = _load_psycopg2().Error
+        self.connection = connect_postgres()
+        self.connection.autocommit = True
+        self._lock = threading.Lock()
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shard_inbox (
+                id BIGSERIAL PRIMARY KEY,
+                shard INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_shard_inbox_shard ON shard_inbox (shard, id)')
+        cursor.close()
+
+    @staticmethod
+    def channel(shard):
+        return f"bot_shard_{shard}"
+
+    def publish(self, shard, payload):
+        """Queue a message for a shard; a dropped connection is reopened and the insert retried once"""
+        with self._lock:
+            try:
+                self._publish(shard, payload)
+            except self.Error as e:
+                logger.warning(f"Publishing to shard {shard} failed, reconnecting: {e}")
+                self._reopen()
+                self._publish(shard, payload)
+
+    def _publish(self, shard, payload):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('''
+                WITH queued AS (
+                    INSERT INTO shard_inbox (shard, payload) VALUES (%s, %s) RETURNING id
+                )
+                SELECT pg_notify(%s, id::text) FROM queued
+            ''', (shard, payload, self.channel(shard)))
+        finally:
+            cursor.close()
+
+    def _reopen(self):
+        try:
+            self.connection.close()
+        except self.Error:
+            pass
+        self.connection = self._connect()
+        self.connection.autocommit = True
+
+    def listen(self, shard, deliver, stop):
+        """Blocking loop (run in a thread): LISTEN on the shard channel and drain the inbox
+
+        Survives a dropped connection: it reconnects with backoff, and the
+        first drain picks up whatever was queued in the meantime.
+        """
+        delay = 1
+        while not stop.is_set():
+            connection = None
+            try:
+                connection = self._connect()
+                connection.autocommit = True
+                cursor = connection.cursor()
+                cursor.execute(f"LISTEN {self.channel(shard)}")
+                delay = 1
+                while not stop.is_set():
+                    self._drain(cursor, shard, deliver)
+                    if select.select([connection], [], [], INBOX_POLL_SECONDS) != ([], [], []):
+                        connection.poll()
+                        connection.notifies.clear()
+            except (self.Error, OSError, ValueError) as e:
+                # ValueError: select() on a connection that was closed under it
+                logger.error(f"Shard {shard} inbox listener failed, reconnecting in {delay}s: {e}")
+                stop.wait(delay)
+                delay = min(INBOX_RECONNECT_MAX_DELAY, delay * 2)
+            finally:
+                if connection is not None and not connection.closed:
+                    connection.close()
+
+    @staticmethod
+    def _drain(cursor, shard, deliver):
+        while True:
+            cursor.execute('''
+                DELETE FROM shard_inbox WHERE id IN (
+                    SELECT id FROM shard_inbox WHERE shard = %s
+                    ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+                ) RETURNING id, payload
+            ''', (shard, INBOX_BATCH_SIZE))
+            rows = sorted(cursor.fetchall())
+            for _, payload in rows:
+                deliver(payload)
+            if len(rows) < INBOX_BATCH_SIZE:
+                return
+
+
+class ShardBus:
+    """Routes JSON messages (updates and cross-shard events) to the shard that owns them"""
+
+    def __init__(self, local_queues, total_shards):
+        self.local_queues = local_queues
+        self.total_shards = total_shards
+        self.has_remote = any(shard not in local_queues for shard in range(total_shards))
+        self._remote = None
+        self._remote_pid = None
+        if self.has_remote:
+            self.remote  # create shard_inbox before the workers fork
+
+    @property
+    def remote(self):
+        """Per-process PostgreSQL transport (connections must not cross a fork)"""
+        if self._remote_pid != os.getpid():
+            if self._remote is not None:
+                from database import _inherited_connections
+                _inherited_connections.append(self._remote)
+            self._remote = PostgresShardInbox()
+            self._remote_pid = os.getpid()
+        return self._remote
+
+    @property
+    def errors(self):
+        """Exceptions a failed send to another node raises (none without remote shards)"""
+        return (self.remote.Error,) if self.has_remote else ()
+
+    def send(self, shard, message):
+        payload = json.dumps(message)
+        local = self.local_queues.get(shard)
+        if local is not None:
+            local.put(payload)
+        else:
+            self.remote.publish(shard, payload)
+
+    def send_update(self, update):
+        shard = shard_for(_update_user_id(update), self.total_shards)
+        self.send(shard, {'kind': 'update', 'data': update.to_dict()})
+
+    def send_event(self, user_id, event):
+        self.send(shard_for(user_id, self.total_shards), {'kind': 'event', 'data': event})
+
+
+class ShardContext:
+    """What a worker's TelegramBot knows about sharding (exposed as bot.shard)"""
+
+    def __init__(self, index, bus):
+        self.index = index
+        self.bus = bus
+
+    def owns(self, user_id):
+        return shard_for(user_id, self.bus.total_shards) == self.index
+
+    def publish_event(self, user_id, event):
+        self.bus.send_event(user_id, event)
+
+
+async def _run_worker(index, bus, extra_error_handlers):
+    import bot as bot_module
+
+    telegram_bot = bot_module.TelegramBot()
+    telegram_bot.shard = ShardContext(index, bus)
+    application = telegram_bot.application
+    for handler in extra_error_handlers:
+        application.add_error_handler(handler)
+
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+    stop = threading.Event()
+
+    def deliver(payload):
+        loop.call_soon_threadsafe(inbox.put_nowait, payload)
+
+    def read_local():
+        queue = bus.local_queues[index]
+        while not stop.is_set():
+            payload = queue.get()
+            deliver(payload)
+            if payload is None:
+                return
+
+    threading.Thread(target=read_local, daemon=True).start()
+    if bus.has_remote:
+        threading.Thread(target=bus.remote.listen, args=(index, deliver, stop), daemon=True).start()
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Worker for shard {index} started")
+
+    try:
+        while True:
+            payload = await inbox.get()
+            if payload is None:
+                break
+            message = json.loads(payload)
+            if message['kind'] == 'update':
+                await application.update_queue.put(Update.de_json(message['data'], application.bot))
+            else:
+                application.create_task(telegram_bot.handle_shard_event(message['data']))
+    finally:
+        stop.set()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
+def _worker_main(index, bus, extra_error_handlers):
+    # One write journal per shard: the forked Database reopens with this path
+    journal_path = os.getenv('WRITE_JOURNAL_PATH', 'write_journal.jsonl')
+    if journal_path:
+        os.environ['WRITE_JOURNAL_PATH'] = f"{journal_path}.shard{index}"
+    # Same for the recent partners history (read when the pairing registry loads)
+    recent_path = os.getenv('RECENT_PARTNERS_PATH', 'recent_partners.bin')
+    if recent_path:
+        os.environ['RECENT_PARTNERS_PATH'] = f"{recent_path}.shard{index}"
+    # And its own directory in the conversation archive (see archive.py)
+    os.environ['ARCHIVE_WRITER'] = f"shard{index}"
+    try:
+        asyncio.run(_run_worker(index, bus, extra_error_handlers))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _poll_updates(bus):
+    """Ingress: long-poll Telegram and hand every update to its shard"""
+    bot = Bot(os.getenv('BOT_TOKEN'))
+    await bot.initialize()
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"Polling error: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            try:
+                bus.send_update(update)
+            except bus.errors as e:
+                # Not acknowledged: the next get_updates fetches it (and the rest) again
+                logger.error(f"Could not hand update {update.update_id} to its shard: {e}")
+                await asyncio.sleep(1)
+                break
+            offset = update.update_id + 1
+
+
+async def _watch_workers(processes):
+    """Return the first worker process that exits"""
+    while True:
+        for process in processes:
+            if not process.is_alive():
+                return process
+        await asyncio.sleep(1)
+
+
+async def _run_ingress(bus, processes):
+    """Poll Telegram until a worker dies; returns that worker"""
+    poller = asyncio.create_task(_poll_updates(bus))
+    watcher = asyncio.create_task(_watch_workers(processes))
+    try:
+        await asyncio.wait((poller, watcher), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        poller.cancel()
+        watcher.cancel()
+    if poller.done() and not poller.cancelled():
+        poller.result()     # the poller failed: raise its error
+    return watcher.result()
+
+
+def run_sharded(extra_error_handlers=(), on_started=None):
+    """Start this node's workers (and the ingress poller, if enabled) and block.
+
+    on_started runs once every worker has forked, so threads it starts
+    (e.g. the Flask uptime server) are never copied into a worker.
+    """
+    local_shards = range(BOT_SHARD_OFFSET, BOT_SHARD_OFFSET + BOT_WORKERS)
+    # fork: workers inherit the loaded modules; Database reconnects per process
+    mp = multiprocessing.get_context('fork')
+    local_queues = {shard: mp.Queue() for shard in local_shards}
+    bus = ShardBus(local_queues, BOT_SHARDS)
+
+    processes = []
+    for shard in local_shards:
+        process = mp.Process(target=_worker_main, args=(shard, bus, list(extra_error_handlers)),
+                             name=f"bot-shard-{shard}", daemon=True)
+        process.start()
+        processes.append(process)
+    print(f"Started {len(processes)} workers for shards {local_shards.start}-{local_shards.stop - 1} of {BOT_SHARDS}")
+    if on_started:
+        on_started()
+
+    dead = None
+    try:
+        if BOT_INGRESS:
+            dead = asyncio.run(_run_ingress(bus, processes))
+        else:
+            while dead is None:
+                time.sleep(1)
+                dead = next((process for process in processes if not process.is_alive()), None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in local_queues.values():
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=10)
+    if dead is not None:
+        logger.error(f"Worker {dead.name} exited with code {dead.exitcode}; stopping this node")
+        # Not sys.exit: the uptime server thread would keep the process alive
+        os._exit(1)
@@ -0,0 +1,179 @@
+"""
+Write journal for database outages
+
+While the database circuit is open (see circuit_breaker.py) journaled writes
+are appended to a local JSONL file instead of being dropped. Lines reach the
+OS at once and are fsynced in batches by a background thread, every
+JOURNAL_FSYNC_INTERVAL seconds. Once the database is back, the journal is
+replayed in order in one background pass, REPLAY_CHUNK records at a time:
+consecutive records of the same write are handed over together, so the
+database can apply a run of them in one round trip. Until the replay catches up, new
+journaled writes are appended behind the old ones rather than written
+directly, so an older write never lands after a newer one. That includes
+starting a chat; claiming a waiting user (multi-worker mode) reads the
+database, so it is held off until the replay has caught up.
+
+Only writes that are safe to apply twice are journaled: upserts, updates to
+absolute values, starting a chat (nothing happens for a pair that is
+already linked) and ending one. An end records the partner it was meant
+for and only ends a chat with that partner, so it never closes a later
+session. The
+byte offset of the last applied record is saved next to the journal once
+per chunk, so a replay that is interrupted resumes where it stopped (at
+worst re-applying part of a chunk, which is harmless).
+
+Configuration:
+    WRITE_JOURNAL_PATH      journal file (default write_journal.jsonl; empty disables it)
+    JOURNAL_FSYNC_INTERVAL  seconds between fsyncs of new records (default 0.1)
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from itertools import groupby
+
+logger = logging.getLogger(__name__)
+
+WRITE_JOURNAL_PATH = os.getenv('WRITE_JOURNAL_PATH', 'write_journal.jsonl')
+JOURNAL_FSYNC_INTERVAL = float(os.getenv('JOURNAL_FSYNC_INTERVAL', '0.1'))
+REPLAY_CHUNK = 500
+
+
+class WriteJournal:
+    def __init__(self, path, fsync_interval=JOURNAL_FSYNC_INTERVAL):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.fsync_interval = fsync_interval
+        self.recorded = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() and not self._ends_with_newline():
+            # Terminate a record cut short by a crash so the next one stays readable
+            self._file.write('\n')
+            self._file.flush()
+        self._dirty = False
+        self._replayer = None       # thread running replay(), if any
+        size = os.path.getsize(path)
+        if self._read_offset() > size:
+            # Crashed between emptying the journal and resetting the offset
+            self._write_offset(0)
+        self._pending = size > self._read_offset()
+        self._syncer = threading.Thread(target=self._sync_loop, name='journal-fsync', daemon=True)
+        self._syncer.start()
+
+    @property
+    def pending(self):
+        """True while records are waiting to be replayed"""
+        return self._pending
+
+    def defer(self, op, args, available):
+        """Journal op(*args) if the database is down or a replay is still catching up.
+
+        available() is checked under the journal lock, so a write either goes
+        behind everything already journaled or straight to the database.
+        Returns True when the write was journaled.
+        """
+        if self._replayer == threading.get_ident():
+            return False
+        with self._lock:
+            if not self._pending and available():
+                return False
+            record = {'op': op, 'args': list(args), 'at': datetime.now().isoformat()}
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            self._dirty = True
+            self._pending = True
+            self.recorded += 1
+        return True
+
+    def replay(self, apply):
+        """Apply every journaled record in order with apply(op, [args, ...]), then empty the journal.
+
+        Each call gets a run of consecutive records of the same op. apply()
+        returns False when the database went away again; the replay stops
+        there and the rest stays journaled for the next one.
+        """
+        if self._replayer is not None:
+            return 0
+        self._replayer = threading.get_ident()
+        applied = 0
+        try:
+            while True:
+                with self._lock:
+                    offset = self._read_offset()
+                    records, end = self._read_records(offset)
+                    if not records:
+                        # Caught up: later writes go to the database again
+                        self._file.truncate(0)
+                        self._write_offset(0)
+                        self._pending = False
+                        break
+                done = offset
+                for op, run in groupby(records, key=lambda entry: entry[1]['op']):
+                    run = list(run)
+                    if not apply(op, [record['args'] for _, record in run]):
+                        if done != offset:
+                            self._write_offset(done)
+                        return applied
+                    applied += len(run)
+                    done = run[-1][0]
+                self._write_offset(end)
+        finally:
+            self._replayer = None
+            self.replayed += applied
+        if applied:
+            logger.info(f"Replayed {applied} journaled writes")
+        return applied
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _read_records(self, offset):
+        """Up to REPLAY_CHUNK (end position, record) pairs after offset, and where reading stopped"""
+        records = []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while len(records) < REPLAY_CHUNK:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break   # end of file, or a record cut short by a crash
+                offset = f.tell()
+                try:
+                    records.append((offset, json.loads(line)))
+                except ValueError:
+                    logger.warning(f"Skipping unreadable journal record at byte {offset}")
+        return records, offset
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        with open(self.offset_path, 'w') as f:
+            f.write(str(offset))
+
+    def _sync(self):
+        if self._dirty and not self._file.closed:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def _sync_loop(self):
+        while not self._file.closed:
+            time.sleep(self.fsync_interval)
+            if self._dirty:
+                with self._lock:
+                    self._sync()